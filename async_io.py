@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, TypeVar
+
+import course_completions
+import learner_record
+from config import mysql_pool_size, pg_pool_size
+from log import get_logger
+
+logger = get_logger('async_io')
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# The database drivers are blocking, so every call runs on this executor. It has a thread per pooled connection:
+# more threads would only wait for a connection.
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=mysql_pool_size + pg_pool_size, thread_name_prefix='async-io')
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+async def run_blocking(fn: Callable[..., R], *args, **kwargs) -> R:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def to_async(fn: Callable[..., R]) -> Callable[..., Awaitable[R]]:
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(fn, *args, **kwargs)
+    return wrapper
+
+
+_END = object()
+
+
+async def iterate(items: Iterable[T]) -> AsyncIterator[T]:
+    # Advances a blocking iterator, e.g. a streaming query, on the executor
+    items = iter(items)
+    try:
+        while True:
+            item = await run_blocking(next, items, _END)
+            if item is _END:
+                return
+            yield item
+    finally:
+        close = getattr(items, 'close', None)
+        if close:
+            await run_blocking(close)
+
+
+async def map_in_flight(fn: Callable[[T], Awaitable[R]], items: Iterable[T], in_flight: int) -> AsyncIterator[R]:
+    # Keeps up to in_flight calls running while yielding results in item order, like batching.prefetch
+    items = iter(items)
+    tasks = deque(asyncio.ensure_future(fn(item)) for _, item in zip(range(in_flight), items))
+    try:
+        while tasks:
+            task = tasks.popleft()
+            for item in items:
+                tasks.append(asyncio.ensure_future(fn(item)))
+                break
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# Async equivalents of the learner_record and course_completions queries and writes
+
+insert_learner_record_events = to_async(learner_record.insert_learner_record_events)
+get_learner_record_watermarks = to_async(learner_record.get_learner_record_watermarks)
+get_course_record_keys_updated_between = to_async(learner_record.get_course_record_keys_updated_between)
+get_learner_record_keys_created_between = to_async(learner_record.get_learner_record_keys_created_between)
+get_learner_records_for_keys = to_async(learner_record.get_learner_records_for_keys)
+count_learner_records = to_async(learner_record.count_learner_records)
+count_incomplete_course_records = to_async(learner_record.count_incomplete_course_records)
+
+get_course_completion_watermark = to_async(course_completions.get_course_completion_watermark)
+get_course_completion_keys_between = to_async(course_completions.get_course_completion_keys_between)
+get_course_completions_for_keys = to_async(course_completions.get_course_completions_for_keys)
+count_course_completions = to_async(course_completions.count_course_completions)
+
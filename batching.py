@@ -0,0 +1,242 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, TypeVar
+
+from log import get_logger
+
+logger = get_logger('batching')
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def chunks(items: List[T], size: int):
+    for _i in range(0, len(items), size):
+        yield items[_i:_i + size]
+
+
+def prefetch(executor: Executor, fn: Callable[[T], R], items: Iterable[T], depth: int):
+    # Keeps up to depth calls in flight on the executor while yielding results in submission order,
+    # so the caller can work on batch N while batch N+1 onwards are being fetched
+    items = iter(items)
+    futures = deque(executor.submit(fn, item) for _, item in zip(range(depth), items))
+    while futures:
+        future = futures.popleft()
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            break
+        yield future.result()
+
+
+_DONE = object()
+
+
+class _Failure:
+    __slots__ = ('error',)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def pipeline(source: Iterable[T], stages: List[Callable], depth: int = 1, name: str = 'pipeline'):
+    # Runs the source and each stage in its own thread, connected by queues of at most depth items, and yields the
+    # output of the last stage in source order. Every stage works on a different item at the same time, and a slow
+    # stage blocks the ones before it once its queue is full, so memory is bounded by depth items per stage.
+    # An exception in any thread is raised in the caller, and closing the generator stops every thread.
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    stopped = threading.Event()
+
+    def put(q: queue.Queue, item):
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q: queue.Queue):
+        while not stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def read():
+        items = iter(source)
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+            put(queues[0], _DONE)
+        except BaseException as e:
+            put(queues[0], _Failure(e))
+        finally:
+            close = getattr(items, 'close', None)
+            if close:
+                close()
+
+    def run_stage(fn: Callable, inbox: queue.Queue, outbox: queue.Queue):
+        while True:
+            item = get(inbox)
+            if item is _DONE or isinstance(item, _Failure):
+                put(outbox, item)
+                return
+            try:
+                result = fn(item)
+            except BaseException as e:
+                put(outbox, _Failure(e))
+                return
+            if not put(outbox, result):
+                return
+
+    threads = [threading.Thread(target=read, name=f"{name}-source", daemon=True)]
+    threads += [threading.Thread(target=run_stage, args=(fn, queues[i], queues[i + 1]), name=f"{name}-stage-{i + 1}",
+                                 daemon=True) for i, fn in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+
+def read_ahead(pages: Iterable[List[T]], depth: int = 1, name: str = 'read-ahead'):
+    # Reads pages of a blocking stream in their own thread, at most depth pages ahead of the caller, and yields their
+    # items, so the stream's round-trips overlap with whatever the caller reads or does between items
+    pages = pipeline(pages, [], depth, name)
+    try:
+        for page in pages:
+            yield from page
+    finally:
+        pages.close()
+
+
+def with_retries(fn: Callable[..., R], *args, attempts: int, description: str, backoff_seconds: float = 1.0) -> R:
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == attempts:
+                logger.error(f"{description} failed after {attempts} attempts: {e}")
+                raise
+            logger.warning(f"{description} failed on attempt {attempt} of {attempts}, retrying: {e}")
+            time.sleep(backoff_seconds * attempt)
+
+
+# MySQL errors that a smaller batch can get past: lock wait timeout and deadlock, which hold fewer locks for less time
+# with fewer rows, packet too large from the server (1153) or the client (2020), and server gone away, which a
+# statement over max_allowed_packet can cause but so can a restart or a dropped connection
+LOCK_ERRORS = {1205, 1213}
+PACKET_TOO_LARGE_ERRORS = {1153, 2020}
+SERVER_GONE_ERRORS = {2006}
+RETRYABLE_ERRORS = LOCK_ERRORS | PACKET_TOO_LARGE_ERRORS | SERVER_GONE_ERRORS
+
+
+class AdaptiveBatcher:
+    # Sizes batches so that each takes about target_seconds: after every batch the size moves to the number of rows the
+    # last batch's throughput would fit in the target, by at most a factor of 2 each way. On lock or packet errors the
+    # size is halved and the failed batch retried in smaller batches. Packet too large errors also cap the size, so it
+    # doesn't grow back into them; server gone away doesn't, as it isn't necessarily caused by the batch size. With a
+    # target_seconds of 0 the size is fixed and errors are raised.
+    def __init__(self, name: str, size: int, target_seconds: float = 0, min_size: int = 1, max_size: int = None,
+                 backoff_seconds: float = 1.0):
+        self.name = name
+        self.size = size
+        self.target_seconds = target_seconds
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size or size, size)
+        self.backoff_seconds = backoff_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def adaptive(self):
+        return self.target_seconds > 0
+
+    def observe(self, rows: int, seconds: float):
+        if not self.adaptive or not rows:
+            return
+        with self._lock:
+            old_size = self.size
+            fitted = rows * self.target_seconds / seconds if seconds > 0 else self.max_size
+            self.size = int(max(self.min_size, old_size // 2, min(self.max_size, old_size * 2, fitted)))
+        if self.size != old_size:
+            logger.info(f"{self.name}: {rows} rows took {seconds:.3f}s (target {self.target_seconds}s), "
+                        f"batch size {old_size} -> {self.size}")
+
+    @contextmanager
+    def timed(self, rows: int):
+        started = time.perf_counter()
+        yield
+        self.observe(rows, time.perf_counter() - started)
+
+    # Returns whether the failed batch of rows should be retried at the new, smaller size
+    def back_off(self, error: Exception, rows: int):
+        errno = getattr(error, 'errno', None)
+        if not self.adaptive or errno not in RETRYABLE_ERRORS or rows <= self.min_size:
+            return False
+        with self._lock:
+            self.size = max(self.min_size, min(self.size, rows) // 2)
+            if errno in PACKET_TOO_LARGE_ERRORS:
+                self.max_size = self.size
+        logger.warning(f"{self.name}: batch of {rows} rows failed with {errno}, retrying in batches of {self.size}: "
+                       f"{error}")
+        if errno in LOCK_ERRORS:
+            time.sleep(self.backoff_seconds)
+        return True
+
+    def batches(self, items: List[T]):
+        # Each batch is sized when it is taken, so sizes follow what observe has learned so far
+        start = 0
+        while start < len(items):
+            batch = items[start:start + self.size]
+            yield batch
+            start += len(batch)
+
+    def run(self, items: List[T], fn: Callable[[List[T]], None]):
+        # Calls fn on consecutive batches of items, timing each and retrying failed batches in smaller ones.
+        # fn must commit or roll back each batch on its own, so that a failed batch can be retried.
+        start = 0
+        while start < len(items):
+            batch = items[start:start + self.size]
+            try:
+                with self.timed(len(batch)):
+                    fn(batch)
+            except Exception as e:
+                if not self.back_off(e, len(batch)):
+                    raise
+                continue
+            start += len(batch)
+
+
+_batchers: Dict[str, AdaptiveBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(name: str, size: int, target_seconds: float = 0, min_size: int = 1, max_size: int = None):
+    # Adaptive batchers are shared by name, so every call of a loop starts from the size the previous ones arrived at.
+    # Fixed size batchers aren't shared, so callers can each use their own size.
+    if target_seconds <= 0:
+        return AdaptiveBatcher(name, size)
+    with _batchers_lock:
+        if name not in _batchers:
+            _batchers[name] = AdaptiveBatcher(name, size, target_seconds, min_size, max_size)
+        return _batchers[name]
+
+
+def get_batch_sizes():
+    with _batchers_lock:
+        return {name: batcher.size for name, batcher in _batchers.items()}
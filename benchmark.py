@@ -0,0 +1,400 @@
+import argparse
+import gc
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import islice
+
+from batching import pipeline
+from bulk_writer import bulk_writers, get_bulk_writer
+from config import mysql_connection, bulk_writer, course_record_lookup_strategy, workers
+from course_completions import CourseCompletion
+from engine import merge_course_completions, find_course_completion_events, find_non_completion_events, \
+    collect_events
+from learner_record import get_learner_records_pages, get_incomplete_course_records_with_records, \
+    course_record_lookup_strategies, insert_learner_records, insert_learner_record_events, LearnerRecord, \
+    LearnerRecordEvent, MOVE_TO_LEARNING_PLAN, LearnerRecordWithEvents, CourseRecord, BasicCourseRecord
+from load_generator import load_synthetic_data, teardown_synthetic_data
+from log import get_logger
+from metrics import metrics
+from models import CourseRecordBase, KeyIndex, course_records_to_map
+from report import run_fast_report
+from script import run
+
+logger = get_logger('benchmark')
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_lookup(records: int, repeats: int):
+    learner_records = [lr for page in islice(get_learner_records_pages(records), 1) for lr in page]
+    logger.info(f"Benchmarking incomplete course record lookups for {len(learner_records)} learner records")
+    for strategy in course_record_lookup_strategies.keys():
+        timings = []
+        found = 0
+        for _ in range(repeats):
+            result, elapsed = timed(get_incomplete_course_records_with_records, learner_records, strategy)
+            found = len(result)
+            timings.append(elapsed)
+        best = min(timings)
+        logger.info(f"{strategy}: best {best:.3f}s over {repeats} runs, {found} course records, "
+                    f"{len(learner_records) / best:.0f} keys/sec")
+
+
+BENCHMARK_COURSE_PREFIX = "BENCHMARK_COURSE_"
+
+
+def get_benchmark_learner_record_ids():
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT id FROM learner_records WHERE resource_id like %s",
+                       (f"{BENCHMARK_COURSE_PREFIX}%",))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def teardown_benchmark_events(learner_record_ids):
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            for _i in range(0, len(learner_record_ids), 1000):
+                batch = learner_record_ids[_i:_i + 1000]
+                ids_in = ",".join(["%s"] * len(batch))
+                cursor.execute(f"DELETE FROM learner_record_events WHERE learner_record_id in ({ids_in})", batch)
+        conn.commit()
+
+
+def teardown_benchmark_rows():
+    teardown_benchmark_events(get_benchmark_learner_record_ids())
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM learner_records WHERE resource_id like %s", (f"{BENCHMARK_COURSE_PREFIX}%",))
+        conn.commit()
+
+
+def benchmark_writers(rows: int, batch_size: int):
+    # Writes synthetic rows into learner_records and learner_record_events with each backend and removes them
+    # afterwards. load_data needs local_infile enabled on the server and BULK_WRITER=load_data in the environment.
+    created = datetime(2024, 1, 1, 10, 0, 0)
+    learner_records = [LearnerRecord(f"{BENCHMARK_COURSE_PREFIX}{i}", f"BENCHMARK_USER_{i}", 0, created)
+                       for i in range(rows)]
+    for name, writer_class in bulk_writers.items():
+        teardown_benchmark_rows()
+        writer = writer_class(batch_size)
+        _, elapsed = timed(insert_learner_records, learner_records, writer)
+        logger.info(f"{name}: inserted {rows} learner records in {elapsed:.3f}s, {rows / elapsed:.0f} rows/sec")
+
+        events = [LearnerRecordEvent(lr_id, MOVE_TO_LEARNING_PLAN, created) for lr_id in
+                  get_benchmark_learner_record_ids()]
+        _, elapsed = timed(insert_learner_record_events, events, writer)
+        logger.info(f"{name}: inserted {len(events)} learner record events in {elapsed:.3f}s, "
+                    f"{len(events) / elapsed:.0f} rows/sec")
+    teardown_benchmark_rows()
+
+
+def benchmark_event_dedup(rows: int, batch_size: int):
+    # Compares the plain event insert with the deduplicating insert, both into an empty table and as a rerun where
+    # every event already exists
+    created = datetime(2024, 1, 1, 10, 0, 0)
+    teardown_benchmark_rows()
+    insert_learner_records([LearnerRecord(f"{BENCHMARK_COURSE_PREFIX}{i}", f"BENCHMARK_USER_{i}", 0, created)
+                            for i in range(rows)])
+    learner_record_ids = get_benchmark_learner_record_ids()
+    events = [LearnerRecordEvent(lr_id, MOVE_TO_LEARNING_PLAN, created) for lr_id in learner_record_ids]
+    writer = get_bulk_writer(batch_size=batch_size)
+
+    _, plain = timed(insert_learner_record_events, events, writer, skip_existing=False)
+    logger.info(f"plain insert: {len(events)} events in {plain:.3f}s, {len(events) / plain:.0f} rows/sec")
+    teardown_benchmark_events(learner_record_ids)
+
+    _, dedup = timed(insert_learner_record_events, events, writer)
+    logger.info(f"dedup insert into empty table: {len(events)} events in {dedup:.3f}s, "
+                f"{len(events) / dedup:.0f} rows/sec ({100 * (dedup - plain) / plain:.0f}% overhead)")
+
+    _, rerun = timed(insert_learner_record_events, events, writer)
+    logger.info(f"dedup rerun with every event existing: {len(events)} events in {rerun:.3f}s, "
+                f"{len(events) / rerun:.0f} rows/sec")
+    teardown_benchmark_rows()
+
+
+SAMPLE_ATTRIBUTE_VALUES = {
+    "course_id": "c3a1b6e2-5f0d-4e0a-9a57-0c6b2c1f3d4e",
+    "user_id": "9f8e7d6c-5b4a-4c3d-8e2f-1a0b9c8d7e6f",
+    "lr_id": 123456789,
+    "learner_record_id": 123456789,
+    "event_id": MOVE_TO_LEARNING_PLAN,
+    "created_timestamp": datetime(2024, 1, 1, 10, 0, 0),
+    "created_at": datetime(2024, 1, 1, 10, 0, 0),
+    "last_updated": datetime(2024, 1, 1, 10, 0, 0),
+    "event_timestamp": datetime(2024, 1, 1, 10, 0, 0),
+    "state": "ARCHIVED",
+    "preference": "LIKED",
+    "events": list,
+    "has_completions": False,
+}
+
+
+def get_slot_attributes(cls):
+    return [name for klass in reversed(cls.__mro__) for name in getattr(klass, "__slots__", ())]
+
+
+def measure_bytes_per_record(cls, attributes, records: int):
+    # Attribute values are shared between records (apart from the per-record events list) so that only the
+    # record objects themselves are measured, not the ids and timestamps they point to
+    values = [(name, SAMPLE_ATTRIBUTE_VALUES[name]) for name in attributes]
+    gc.collect()
+    tracemalloc.start()
+    objects = []
+    for _ in range(records):
+        obj = cls.__new__(cls)
+        for name, value in values:
+            setattr(obj, name, value() if callable(value) else value)
+        objects.append(obj)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current - sys.getsizeof(objects)) / records
+
+
+def benchmark_memory(records: int):
+    for cls in (LearnerRecordWithEvents, LearnerRecordEvent, BasicCourseRecord, CourseRecord, CourseCompletion):
+        attributes = get_slot_attributes(cls)
+        # Equivalent class without __slots__, i.e. how the models were stored before
+        dict_backed = type(f"DictBacked{cls.__name__}", (), {})
+        before = measure_bytes_per_record(dict_backed, attributes, records)
+        after = measure_bytes_per_record(cls, attributes, records)
+        logger.info(f"{cls.__name__}: {before:.0f} bytes/record with __dict__, {after:.0f} bytes/record with "
+                    f"__slots__ ({100 * (before - after) / before:.0f}% smaller)")
+
+
+def benchmark_keys(records: int):
+    # Synthetic dataset of records spread over a fixed set of courses, with ~20 courses per user
+    courses = [f"course-{i:08d}-0000-0000-0000-000000000000" for i in range(5000)]
+    users = [f"user-{i:010d}-0000-0000-0000-000000000000" for i in range(max(1, records // 20))]
+    learner_records = [CourseRecordBase(courses[i % len(courses)], users[i // 20]) for i in range(records)]
+    probes = [CourseRecordBase(r.course_id, r.user_id) for r in learner_records]
+    logger.info(f"Benchmarking map build and lookup loop over {records} records")
+
+    def probe_string_keys(_map):
+        return sum(1 for probe in probes if _map.get(probe.get_id()) is not None)
+
+    def probe_interned_keys(_map, key_index):
+        return sum(1 for probe in probes if _map.get(key_index.lookup_of(probe)) is not None)
+
+    _map, build = timed(course_records_to_map, learner_records)
+    found, probe = timed(probe_string_keys, _map)
+    key_bytes = sum(sys.getsizeof(key) for key in _map.keys())
+    logger.info(f"get_id string keys: build {build:.2f}s, lookup {probe:.2f}s ({records / probe:.0f} lookups/sec), "
+                f"{found} found, {key_bytes / records:.0f} key bytes/record")
+    del _map
+
+    key_index = KeyIndex()
+    _map, build = timed(course_records_to_map, learner_records, key_index)
+    found, probe = timed(probe_interned_keys, _map, key_index)
+    # The interned ids themselves are already referenced by the records, so only the index dicts are extra
+    key_bytes = sum(sys.getsizeof(key) for key in _map.keys()) + sys.getsizeof(key_index.course_ids) + \
+        sys.getsizeof(key_index.user_ids)
+    logger.info(f"KeyIndex packed int keys: build {build:.2f}s, lookup {probe:.2f}s "
+                f"({records / probe:.0f} lookups/sec), {found} found, {key_bytes / records:.0f} key bytes/record")
+
+
+def generate_synthetic_event_sources(records: int, page_size: int):
+    # Learner record pages and course completions in (course_id, user_id) order, with a course completion for every
+    # third record and the course records the non-completion lookup would return for the rest
+    created = datetime(2024, 1, 1, 10, 0, 0)
+    users_per_course = 100
+    learner_records = [LearnerRecordWithEvents(f"course-{i // users_per_course:06d}",
+                                               f"user-{i % users_per_course:08d}", i, created) for i in range(records)]
+    completions = [CourseCompletion(lr.course_id, lr.user_id, datetime(2024, 6, 1, 10, 0, 0))
+                   for lr in learner_records[::3]]
+    states = [(None, 'LIKED'), (None, 'DISLIKED'), ('ARCHIVED', None)]
+    course_records = {(lr.course_id, lr.user_id): CourseRecord(lr.course_id, lr.user_id, *states[lr.lr_id % 3],
+                                                               datetime(2024, 3, 1, 10, 0, 0))
+                      for lr in learner_records}
+    pages = [learner_records[_i:_i + page_size] for _i in range(0, records, page_size)]
+    return pages, completions, course_records
+
+
+def benchmark_pipeline(records: int, page_size: int, depth: int, lookup_latency: float, insert_latency: float):
+    # End to end event extraction over synthetic data, with the non-completion lookup and the insert replaced by sleeps
+    # of the given latencies per page, run serially and pipelined
+    def run_extraction(pipelined: bool, pages, completions, course_records):
+        key_index = KeyIndex()
+
+        def join(page):
+            return find_course_completion_events(page[0], page[1], key_index)
+
+        def classify(_map):
+            time.sleep(lookup_latency)
+            incomplete = [course_records[(lr.course_id, lr.user_id)] for lr in _map.values() if not lr.has_completions]
+            _map = find_non_completion_events(_map, incomplete, key_index)
+            return _map, collect_events(_map)
+
+        merged = merge_course_completions(pages, completions, key_index)
+        results = pipeline(merged, [join, classify], depth) if pipelined else (classify(join(page)) for page in merged)
+        events = 0
+        for _map, page_events in results:
+            time.sleep(insert_latency)
+            events += len(page_events)
+        return events
+
+    for pipelined in (False, True):
+        # The maps are filled with events by each run, so every run gets freshly generated sources
+        sources = generate_synthetic_event_sources(records, page_size)
+        events, elapsed = timed(run_extraction, pipelined, *sources)
+        logger.info(f"{'pipelined' if pipelined else 'serial'}: {events} events from {records} learner records in "
+                    f"{elapsed:.2f}s, {records / elapsed:.0f} learner records/sec")
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous: dict, current: dict, tolerance: float):
+    # Phases that took more than tolerance longer than in the previous result for the same dataset
+    regressions = []
+    for name, stats in current["phases"].items():
+        before = previous["phases"].get(name)
+        if before and before["seconds"] and stats["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append({"phase": name, "previous_seconds": before["seconds"], "seconds": stats["seconds"],
+                                "change": round(stats["seconds"] / before["seconds"] - 1, 3)})
+    return regressions
+
+
+def get_previous_result(results_dir: str, records: int):
+    paths = sorted(glob.glob(os.path.join(results_dir, f"suite-{records}-*.json")))
+    if not paths:
+        return None
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def benchmark_suite(records: int, courses_per_user: int, seed: int, results_dir: str, tolerance: float,
+                    keep_data: bool):
+    # Loads a synthetic dataset, times the fast report and an execute run of both migration phases on it, and stores
+    # the timings in results_dir, comparing them with the previous result for the same number of records.
+    # Runs against the whole of the configured databases, so only point it at a benchmark database.
+    teardown_synthetic_data()
+    try:
+        with metrics.phase("load"):
+            load_synthetic_data(records, courses_per_user, seed)
+        with metrics.phase("fast_report"):
+            run_fast_report(["learner_records", "events"])
+        run(["learner_records", "events"], execute=True)
+    finally:
+        if not keep_data:
+            teardown_synthetic_data()
+
+    result = metrics.report({
+        "records": records,
+        "courses_per_user": courses_per_user,
+        "seed": seed,
+        "git_commit": get_git_commit(),
+        "config": {"bulk_writer": bulk_writer, "course_record_lookup_strategy": course_record_lookup_strategy,
+                   "workers": workers},
+    })
+    previous = get_previous_result(results_dir, records)
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"suite-{records}-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    for name, stats in result["phases"].items():
+        logger.info(f"{name}: {stats['seconds']:.2f}s, {stats['rows_per_second']:.0f} rows/sec")
+    logger.info(f"Results written to {path}")
+
+    if previous is None:
+        logger.info(f"No previous result for {records} records to compare with")
+        return []
+    regressions = compare_results(previous, result, tolerance)
+    for regression in regressions:
+        logger.warning(f"Regression in {regression['phase']}: {regression['previous_seconds']:.2f}s -> "
+                       f"{regression['seconds']:.2f}s ({100 * regression['change']:.0f}% slower) since "
+                       f"{previous.get('git_commit')}")
+    if not regressions:
+        logger.info(f"No phase more than {100 * tolerance:.0f}% slower than {previous.get('git_commit')}")
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark migration components against the configured databases")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    lookup = subparsers.add_parser("lookup", help="Compare incomplete course record lookup strategies")
+    lookup.add_argument("--records", type=int, default=100000, help="Number of learner records to look up")
+    lookup.add_argument("--repeats", type=int, default=3, help="Number of runs per strategy")
+
+    writers = subparsers.add_parser("writers", help="Compare bulk insert backends")
+    writers.add_argument("--rows", type=int, default=100000, help="Number of rows to insert per backend")
+    writers.add_argument("--batch-size", type=int, default=1000, help="Rows per insert batch")
+
+    dedup = subparsers.add_parser("dedup", help="Compare the plain event insert with the deduplicating insert")
+    dedup.add_argument("--rows", type=int, default=100000, help="Number of events to insert")
+    dedup.add_argument("--batch-size", type=int, default=1000, help="Rows per insert batch")
+
+    pipelined = subparsers.add_parser("pipeline", help="Compare serial and pipelined event extraction on synthetic "
+                                                       "data")
+    pipelined.add_argument("--records", type=int, default=1000000, help="Number of synthetic learner records")
+    pipelined.add_argument("--page-size", type=int, default=50000, help="Learner records per page")
+    pipelined.add_argument("--depth", type=int, default=2, help="Pages queued between pipeline stages")
+    pipelined.add_argument("--lookup-latency", type=float, default=0.2,
+                           help="Simulated seconds per page of the incomplete course record lookup")
+    pipelined.add_argument("--insert-latency", type=float, default=0.2,
+                           help="Simulated seconds per page of the event insert")
+
+    suite = subparsers.add_parser("suite", help="Load a synthetic dataset, time every phase on it and compare the "
+                                                "results with the previous run")
+    suite.add_argument("--records", type=int, default=1000000, help="Number of synthetic course records to load")
+    suite.add_argument("--courses-per-user", type=int, default=20, help="Course records per synthetic user")
+    suite.add_argument("--seed", type=int, default=0, help="Seed of the synthetic dataset")
+    suite.add_argument("--results-dir", default="benchmark_results", help="Directory the results are stored in")
+    suite.add_argument("--tolerance", type=float, default=0.2,
+                       help="Fraction a phase may slow down by before it is reported as a regression")
+    suite.add_argument("--keep-data", action="store_true", help="Leave the synthetic dataset in the databases")
+    suite.add_argument("--fail-on-regression", action="store_true", help="Exit with an error on a regression")
+
+    load = subparsers.add_parser("load", help="Only load a synthetic dataset")
+    load.add_argument("--records", type=int, default=1000000, help="Number of synthetic course records to load")
+    load.add_argument("--courses-per-user", type=int, default=20, help="Course records per synthetic user")
+    load.add_argument("--seed", type=int, default=0, help="Seed of the synthetic dataset")
+
+    subparsers.add_parser("unload", help="Remove the synthetic dataset")
+
+    memory = subparsers.add_parser("memory", help="Compare bytes per record of the record models")
+    memory.add_argument("--records", type=int, default=1000000, help="Number of records to create per model")
+
+    keys = subparsers.add_parser("keys", help="Compare get_id string keys with KeyIndex keys in the join maps")
+    keys.add_argument("--records", type=int, default=10000000, help="Number of synthetic records")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.benchmark == "lookup":
+        benchmark_lookup(args.records, args.repeats)
+    elif args.benchmark == "writers":
+        benchmark_writers(args.rows, args.batch_size)
+    elif args.benchmark == "dedup":
+        benchmark_event_dedup(args.rows, args.batch_size)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(args.records, args.page_size, args.depth, args.lookup_latency, args.insert_latency)
+    elif args.benchmark == "suite":
+        if benchmark_suite(args.records, args.courses_per_user, args.seed, args.results_dir, args.tolerance,
+                           args.keep_data) and args.fail_on_regression:
+            sys.exit(1)
+    elif args.benchmark == "load":
+        load_synthetic_data(args.records, args.courses_per_user, args.seed)
+    elif args.benchmark == "unload":
+        teardown_synthetic_data()
+    elif args.benchmark == "memory":
+        benchmark_memory(args.records)
+    elif args.benchmark == "keys":
+        benchmark_keys(args.records)
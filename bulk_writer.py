@@ -0,0 +1,95 @@
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+from batching import get_batcher
+from config import mysql_connection, bulk_writer, bulk_insert_batch_size, adaptive_batching
+from log import get_logger
+from metrics import metrics
+
+logger = get_logger('bulk_writer')
+
+
+class BulkWriter:
+    name = None
+
+    def __init__(self, batch_size: int = bulk_insert_batch_size):
+        self.batch_size = batch_size
+
+    # set_expressions are SQL expressions for columns that are the same (or generated) for every row,
+    # e.g. {'learner_record_uid': 'UUID()'}. on_batch_committed is called with the number of rows committed so far.
+    # batch_size is the starting size of the table's adaptive batcher when ADAPTIVE_BATCH_TARGET_SECONDS is set.
+    def write(self, table: str, columns: List[str], rows: List[tuple], ignore: bool = False,
+              set_expressions: Optional[Dict[str, str]] = None,
+              on_batch_committed: Optional[Callable[[int], None]] = None):
+        set_expressions = set_expressions or {}
+        rows_committed = 0
+
+        def write_batch(batch: List[tuple]):
+            nonlocal rows_committed
+            logger.info(f"Writing {len(batch)} rows to {table} with {self.name}")
+            with mysql_connection() as connection, metrics.db_call(f"insert_{table}_{self.name}"):
+                with connection.cursor() as cursor:
+                    self._write_batch(cursor, table, columns, batch, ignore, set_expressions)
+                connection.commit()
+            rows_committed += len(batch)
+            if on_batch_committed:
+                on_batch_committed(rows_committed)
+
+        get_batcher(f"insert_{table}", self.batch_size, **adaptive_batching).run(rows, write_batch)
+
+    def _write_batch(self, cursor, table: str, columns: List[str], batch: List[tuple], ignore: bool,
+                     set_expressions: Dict[str, str]):
+        raise NotImplementedError
+
+
+class ExecuteManyWriter(BulkWriter):
+    name = "executemany"
+
+    # mysql-connector rewrites executemany of a single-row INSERT into one multi-row INSERT per batch,
+    # with every value escaped by the driver
+    def _write_batch(self, cursor, table, columns, batch, ignore, set_expressions):
+        insert_columns = ", ".join(columns + list(set_expressions.keys()))
+        placeholders = ", ".join(["%s"] * len(columns) + list(set_expressions.values()))
+        sql = f"INSERT {'IGNORE ' if ignore else ''}INTO {table} ({insert_columns}) VALUES ({placeholders})"
+        cursor.executemany(sql, batch)
+
+
+# MySQL LOAD DATA and Postgres COPY text format share the same escaping
+def to_tsv_field(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+class LoadDataWriter(BulkWriter):
+    name = "load_data"
+
+    # Requires local_infile to be enabled on the MySQL server
+    def _write_batch(self, cursor, table, columns, batch, ignore, set_expressions):
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", suffix=".tsv") as buffer:
+            for row in batch:
+                buffer.write("\t".join(to_tsv_field(value) for value in row))
+                buffer.write("\n")
+            buffer.flush()
+            set_sql = ""
+            if set_expressions:
+                set_sql = "SET " + ", ".join(f"{column} = {expression}"
+                                             for column, expression in set_expressions.items())
+            sql = f"""
+                LOAD DATA LOCAL INFILE %s {'IGNORE ' if ignore else ''}INTO TABLE {table}
+                FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+                LINES TERMINATED BY '\\n'
+                ({", ".join(columns)})
+                {set_sql}
+            """
+            cursor.execute(sql, (buffer.name,))
+
+
+bulk_writers = {
+    ExecuteManyWriter.name: ExecuteManyWriter,
+    LoadDataWriter.name: LoadDataWriter,
+}
+
+
+def get_bulk_writer(name: str = bulk_writer, batch_size: int = bulk_insert_batch_size) -> BulkWriter:
+    return bulk_writers[name](batch_size)
@@ -0,0 +1,46 @@
+import json
+import os
+import threading
+
+from log import get_logger
+
+logger = get_logger('checkpoint')
+
+
+class Checkpoint:
+    # Per-phase progress of an execute run, saved to a local JSON file after every committed batch so that a
+    # failed run can be restarted with --resume from the last committed batch rather than from the beginning
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = {}
+        if resume:
+            if os.path.exists(path):
+                with open(path) as f:
+                    self.state = json.load(f)
+                logger.info(f"Resuming from checkpoint {path}: {self.state}")
+            else:
+                logger.warning(f"Checkpoint {path} doesn't exist. Starting from the beginning")
+
+    def get(self, phase: str) -> dict:
+        with self._lock:
+            return dict(self.state.get(phase, {}))
+
+    def is_complete(self, phase: str) -> bool:
+        return self.get(phase).get('complete', False)
+
+    def update(self, phase: str, **progress):
+        with self._lock:
+            self.state.setdefault(phase, {}).update(progress)
+            self._save()
+
+    def complete(self, phase: str):
+        self.update(phase, complete=True)
+        logger.info(f"Phase {phase} complete")
+
+    def _save(self):
+        # Write to a temporary file and rename it so a crash mid-write can't leave a corrupt checkpoint
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, default=str)
+        os.replace(tmp_path, self.path)
@@ -1,35 +1,107 @@
 import os
+import threading
+from contextlib import contextmanager
 
 import dotenv
-import mysql.connector
-import psycopg2
+
+from pool import MySQLPool, PostgresPool
 
 os.environ['TZ'] = 'UTC'
 
 dotenv.load_dotenv()
 
 event_source_id = os.environ['EVENT_SOURCE_ID']
-course_record_page_size = os.getenv('COURSE_RECORD_PAGE_SIZE', 200000)
+course_record_page_size = int(os.getenv('COURSE_RECORD_PAGE_SIZE', 200000))
+course_record_lookup_strategy = os.getenv('COURSE_RECORD_LOOKUP_STRATEGY', 'temp_table')
+missing_record_batch_size = int(os.getenv('MISSING_RECORD_BATCH_SIZE', 2000))
+workers = int(os.getenv('WORKERS', 1))
+pipeline_depth = int(os.getenv('PIPELINE_DEPTH', 2))
+batch_retries = int(os.getenv('BATCH_RETRIES', 3))
+checkpoint_file = os.getenv('CHECKPOINT_FILE', 'migration_checkpoint.json')
+metrics_file = os.getenv('METRICS_FILE', 'migration_report.json')
+prometheus_file = os.getenv('PROMETHEUS_FILE')
+watermark_file = os.getenv('WATERMARK_FILE', 'migration_watermarks.json')
+teardown_chunk_size = int(os.getenv('TEARDOWN_CHUNK_SIZE', 10000))
+teardown_throttle_seconds = float(os.getenv('TEARDOWN_THROTTLE_SECONDS', 0))
+snapshot_dir = os.getenv('SNAPSHOT_DIR', 'snapshot')
+module_record_index = os.getenv('MODULE_RECORD_INDEX', 'false').lower() == 'true'
+module_record_index_overlap_seconds = float(os.getenv('MODULE_RECORD_INDEX_OVERLAP_SECONDS', 3600))
 
 # DB
 
-batch_size = 1000
+batch_size = int(os.getenv('BATCH_SIZE', 1000))
+bulk_writer = os.getenv('BULK_WRITER', 'executemany')
+bulk_insert_batch_size = int(os.getenv('BULK_INSERT_BATCH_SIZE', batch_size))
+# Batch sizes adapt towards this many seconds per batch when it is set, between the min and max sizes
+adaptive_batching = {
+    "target_seconds": float(os.getenv('ADAPTIVE_BATCH_TARGET_SECONDS', 0)),
+    "min_size": int(os.getenv('ADAPTIVE_BATCH_MIN_SIZE', 100)),
+    "max_size": int(os.getenv('ADAPTIVE_BATCH_MAX_SIZE', 20000)),
+}
+mysql_pool_size = int(os.getenv('MYSQL_POOL_SIZE', 4))
+pg_pool_size = int(os.getenv('PG_POOL_SIZE', 2))
+
+_pools = {}
+_pools_lock = threading.Lock()
 
 
-def get_mysql_connection():
-    return mysql.connector.connect(
+def _create_mysql_pool():
+    return MySQLPool(
+        'learner_record',
+        mysql_pool_size,
         database='learner_record',
         host=os.environ['MYSQL_HOST'],
         user=os.environ['MYSQL_USER'],
-        password=os.environ['MYSQL_PASSWORD']
+        password=os.environ['MYSQL_PASSWORD'],
+        allow_local_infile=bulk_writer == 'load_data'
     )
 
 
-def get_pg_connection():
-    return psycopg2.connect(
+def _create_pg_pool():
+    return PostgresPool(
+        'reporting',
+        pg_pool_size,
         dbname='reporting',
         host=os.environ['PG_HOST'],
         password=os.environ['PG_PASSWORD'],
         port=5432,
         user=os.environ['PG_USER']
     )
+
+
+_pool_factories = {
+    'mysql': _create_mysql_pool,
+    'pg': _create_pg_pool,
+}
+
+
+def _get_pool(name: str):
+    # Pools are created on first use so that processes which only need one database don't connect to both
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = _pool_factories[name]()
+        return _pools[name]
+
+
+@contextmanager
+def mysql_connection():
+    with _get_pool('mysql').connection() as conn:
+        yield conn
+
+
+@contextmanager
+def pg_connection():
+    with _get_pool('pg').connection() as conn:
+        yield conn
+
+
+def get_pool_metrics():
+    with _pools_lock:
+        return {name: pool.metrics.as_dict() for name, pool in _pools.items()}
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
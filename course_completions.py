@@ -1,26 +1,124 @@
-from config import get_pg_connection
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from config import pg_connection, course_record_page_size
 from log import get_logger
-from models import CourseRecordBase
+from metrics import metrics
+from models import CourseCompletion
+from sharding import Shard
 
 logger = get_logger('course_completions')
 
 
-class CourseCompletion(CourseRecordBase):
-    def __init__(self, course_id, user_id, event_timestamp):
-        super().__init__(course_id, user_id)
-        self.event_timestamp = event_timestamp
+# Streams completions through a named (server-side) cursor, fetching itersize rows per round-trip.
+# Rows are ordered by (course_id, user_id) in byte order ("C" collation) to match
+# learner_record.get_learner_records_ordered_pages, so the two can be merge-joined.
+# after_key (course_id, user_id) starts the stream after that key, for resuming a run.
+# Yields the completions in lists of itersize, one per round-trip
+def get_course_completion_pages(itersize: int = course_record_page_size, after_key: Optional[Tuple[str, str]] = None,
+                                shard: Optional[Shard] = None):
+    logger.info("Fetching course completions" + (f" after {after_key}" if after_key else "") +
+                (f" for {shard}" if shard else ""))
+    with pg_connection() as conn, conn.cursor(name='course_completions') as cursor:
+        cursor.itersize = itersize
+        after = 'and (cce.course_id collate "C", cce.user_id collate "C") > (%s, %s)' if after_key else ""
+        sharded = f"and {shard.pg_condition('cce.user_id')}" if shard else ""
+        sql = f"""
+            select cce.course_id, cce.user_id, cce.event_timestamp
+            from course_completion_events cce
+            where cce.user_id is not NULL
+            {after}
+            {sharded}
+            -- handle duplicates
+            group by cce.course_id, cce.user_id, cce.event_timestamp
+            order by cce.course_id collate "C", cce.user_id collate "C", cce.event_timestamp
+        """
+        with metrics.db_call("get_course_completions"):
+            cursor.execute(sql, after_key)
+        while True:
+            # Each fetchmany on a named cursor is one round-trip for itersize rows
+            with metrics.db_call("get_course_completions_page"):
+                rows = cursor.fetchmany(itersize)
+            if not rows:
+                return
+            yield [CourseCompletion(row[0], row[1], row[2]) for row in rows]
 
 
-def get_course_completions():
-    logger.info("Fetching course completions")
-    conn = get_pg_connection()
-    with conn.cursor() as cursor:
+def get_course_completions(itersize: int = course_record_page_size, after_key: Optional[Tuple[str, str]] = None,
+                           shard: Optional[Shard] = None):
+    for page in get_course_completion_pages(itersize, after_key, shard):
+        yield from page
+
+
+# Incremental runs
+
+def get_course_completion_watermark():
+    with pg_connection() as conn, conn.cursor() as cursor:
+        with metrics.db_call("get_course_completion_watermark"):
+            cursor.execute("select max(cce.event_timestamp) from course_completion_events cce")
+            return cursor.fetchone()[0]
+
+
+def get_course_completion_keys_between(since: Optional[datetime], until: datetime):
+    with pg_connection() as conn, conn.cursor() as cursor:
+        sql = """
+            select distinct cce.course_id, cce.user_id
+            from course_completion_events cce
+            where cce.user_id is not NULL
+            and cce.event_timestamp > %s and cce.event_timestamp <= %s
+        """
+        with metrics.db_call("get_course_completion_keys_between"):
+            cursor.execute(sql, (since or datetime.min, until))
+            rows = cursor.fetchall()
+        return {(row[0], row[1]) for row in rows}
+
+
+def get_course_completions_for_keys(keys: List[Tuple[str, str]], until: datetime):
+    keys_in = ",".join(["(%s, %s)"] * len(keys))
+    with pg_connection() as conn, conn.cursor() as cursor:
         sql = f"""
             select cce.course_id, cce.user_id, cce.event_timestamp
             from course_completion_events cce
-            where cce.user_id is not NULL
+            where (cce.course_id, cce.user_id) in ({keys_in})
+            and cce.event_timestamp <= %s
             -- handle duplicates
             group by cce.course_id, cce.user_id, cce.event_timestamp
         """
-        cursor.execute(sql)
-        return [CourseCompletion(row[0], row[1], row[2]) for row in cursor.fetchall()]
+        with metrics.db_call("get_course_completions_for_keys"):
+            cursor.execute(sql, [_id for key in keys for _id in key] + [until])
+            rows = cursor.fetchall()
+        return [CourseCompletion(row[0], row[1], row[2]) for row in rows]
+
+
+# Fast report
+
+# Number of distinct completion timestamps per (course_id, user_id), i.e. the COMPLETE_COURSE events each learner record
+# would get, in the same order as get_course_completions
+def get_course_completion_counts(itersize: int = course_record_page_size, shard: Optional[Shard] = None):
+    with pg_connection() as conn, conn.cursor(name='course_completion_counts') as cursor:
+        cursor.itersize = itersize
+        sql = f"""
+            select cce.course_id, cce.user_id, count(distinct cce.event_timestamp)
+            from course_completion_events cce
+            where cce.user_id is not NULL
+            {f"and {shard.pg_condition('cce.user_id')}" if shard else ""}
+            group by cce.course_id, cce.user_id
+            order by cce.course_id collate "C", cce.user_id collate "C"
+        """
+        with metrics.db_call("get_course_completion_counts"):
+            cursor.execute(sql)
+        while True:
+            with metrics.db_call("get_course_completion_counts_page"):
+                rows = cursor.fetchmany(itersize)
+            if not rows:
+                return
+            yield from rows
+
+
+# Snapshots
+
+def count_course_completions():
+    with pg_connection() as conn, conn.cursor() as cursor:
+        with metrics.db_call("count_course_completions"):
+            cursor.execute("select count(*) from course_completion_events cce where cce.user_id is not NULL")
+            return int(cursor.fetchone()[0])
@@ -0,0 +1,223 @@
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from log import get_logger
+from models import KeyIndex, course_records_to_map, CourseCompletion, LearnerRecord, LearnerRecordEvent, \
+    LearnerRecordWithEvents, CourseRecord, CourseRecordBase, COMPLETE_COURSE, MOVE_TO_LEARNING_PLAN, \
+    REMOVE_FROM_LEARNING_PLAN, REMOVE_FROM_SUGGESTIONS
+
+# The event derivation, with no database access: it reads from an EventSource and writes to an EventSink, so it can run
+# against in-memory or exported data. Nothing here imports config or the database drivers.
+
+logger = get_logger('engine')
+
+# Same as the COURSE_RECORD_PAGE_SIZE default
+DEFAULT_PAGE_SIZE = 200000
+
+
+def transform_course_records_into_learner_records(course_records: List[CourseRecord]):
+    return [LearnerRecord(record.course_id, record.user_id, 0, record.created_at) for record in
+            course_records]
+
+
+def _merge_pages(learner_record_pages: Iterable[List[LearnerRecordWithEvents]],
+                 course_completions: Iterable[CourseCompletion]):
+    # Both inputs must be ordered by (course_id, user_id). Each page of learner records is paired with the
+    # completions up to and including its last key, so neither side is ever fully held in memory.
+    completions = iter(course_completions)
+    try:
+        pending = next(completions, None)
+        last_key = None
+        for page in learner_record_pages:
+            if not page:
+                continue
+            page_last_key = (page[-1].course_id, page[-1].user_id)
+            if last_key is not None and page_last_key < last_key:
+                raise ValueError(f"Learner records are not ordered by course_id, user_id at {page_last_key}")
+            last_key = page_last_key
+            page_completions = []
+            while pending is not None and (pending.course_id, pending.user_id) <= last_key:
+                page_completions.append(pending)
+                pending = next(completions, None)
+                if pending is not None and (pending.course_id, pending.user_id) < \
+                        (page_completions[-1].course_id, page_completions[-1].user_id):
+                    raise ValueError(f"Course completions are not ordered by course_id, user_id at {pending.get_id()}")
+            logger.info(f"Merged page of {len(page)} learner records with {len(page_completions)} course completions")
+            yield page, page_completions
+        while pending is not None:
+            logger.warning(f"Learner record with id {pending.get_id()} doesn't exist")
+            pending = next(completions, None)
+    finally:
+        # Stops the completions stream, e.g. a read-ahead thread, when the merge ends early
+        close = getattr(completions, 'close', None)
+        if close:
+            close()
+
+
+def merge_course_completions(learner_record_pages: Iterable[List[LearnerRecordWithEvents]],
+                             course_completions: Iterable[CourseCompletion], key_index: Optional[KeyIndex] = None):
+    for page, page_completions in _merge_pages(learner_record_pages, course_completions):
+        yield course_records_to_map(page, key_index), page_completions
+
+
+def merge_indexed_course_completions(learner_record_pages: Iterable[List[LearnerRecordWithEvents]],
+                                     course_completions: Iterable[CourseCompletion]):
+    # merge_course_completions with each page keyed by a KeyIndex of its own, yielded with the page so that the join
+    # and classification use it too. It's dropped with the page, so no index grows with the ids of the whole stream.
+    for page, page_completions in _merge_pages(learner_record_pages, course_completions):
+        key_index = KeyIndex()
+        yield course_records_to_map(page, key_index), page_completions, key_index
+
+
+def transform_course_record_into_event_id(lr: LearnerRecord, course_record: CourseRecord):
+    if course_record.state == 'ARCHIVED':
+        if lr.created_timestamp != course_record.created_at:
+            return REMOVE_FROM_LEARNING_PLAN
+    elif course_record.state is None:
+        if course_record.preference == 'LIKED':
+            return MOVE_TO_LEARNING_PLAN
+        elif course_record.preference == 'DISLIKED':
+            return REMOVE_FROM_SUGGESTIONS
+    return None
+
+
+# learner_records is keyed by get_id(), or by key_index keys when a key_index is passed
+def find_course_completion_events(learner_records: Dict[str, LearnerRecordWithEvents],
+                                  course_completions: List[CourseCompletion], key_index: Optional[KeyIndex] = None):
+    logger.info(f"Processing {len(course_completions)} course completion events")
+    completions_processed = 0
+    for completion in course_completions:
+        course_record_id = key_index.lookup_of(completion) if key_index else completion.get_id()
+        lr = learner_records.get(course_record_id)
+        if lr:
+            lre = LearnerRecordEvent(lr.lr_id, COMPLETE_COURSE, completion.event_timestamp)
+            lr.events.append(lre)
+            lr.has_completions = True
+            learner_records[course_record_id] = lr
+            completions_processed += 1
+        else:
+            logger.warning(f"Learner record with id {completion.get_id()} doesn't exist")
+    logger.info(f"Processed {completions_processed} out of {len(course_completions)} course completion events")
+    return learner_records
+
+
+def find_non_completion_events(learner_records: Dict[str, LearnerRecordWithEvents],
+                               incomplete_records: List[CourseRecord], key_index: Optional[KeyIndex] = None):
+    logger.info(f"Processing other events for {len(incomplete_records)} incomplete course records")
+    events_processed = 0
+    for incomplete_record in incomplete_records:
+        course_record_id = key_index.lookup_of(incomplete_record) if key_index else incomplete_record.get_id()
+        lr = learner_records.get(course_record_id)
+        if lr:
+            event_id = transform_course_record_into_event_id(lr, incomplete_record)
+            if event_id:
+                lre = LearnerRecordEvent(lr.lr_id, event_id, incomplete_record.last_updated)
+                lr.events.append(lre)
+                learner_records[course_record_id] = lr
+                events_processed += 1
+        else:
+            logger.warning(f"Learner record with id {incomplete_record.get_id()} doesn't exist")
+    logger.info(f"Processed {events_processed} out of {len(incomplete_records)} incomplete course records")
+    return learner_records
+
+
+def collect_events(_map: Dict[str, LearnerRecordWithEvents]):
+    events = []
+    for learner_record in _map.values():
+        learner_record.sort_events()
+        events.extend(learner_record.events)
+    return events
+
+
+class EventSource:
+    # Learner records and course completions must both be ordered by (course_id, user_id) in byte order, which for
+    # str is code point order, so that they can be merge joined. snapshot.Snapshot is also an EventSource.
+    def learner_record_pages(self, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[LearnerRecordWithEvents]]:
+        raise NotImplementedError
+
+    def course_completions(self) -> Iterator[CourseCompletion]:
+        raise NotImplementedError
+
+    # Incomplete (not COMPLETED) course records matching records
+    def get_incomplete_course_records(self, records: List[CourseRecordBase]) -> List[CourseRecord]:
+        raise NotImplementedError
+
+
+class EventSink:
+    def write(self, events: List[LearnerRecordEvent]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def is_incomplete(record: CourseRecord):
+    return record.state != 'COMPLETED'
+
+
+class IncompleteCourseRecords:
+    # Incomplete course records held in memory by (course_id, user_id), for sources with no database to query
+    __slots__ = ('records',)
+
+    def __init__(self, course_records: Iterable[CourseRecord]):
+        self.records = {(record.course_id, record.user_id): record for record in course_records
+                        if is_incomplete(record)}
+
+    def lookup(self, records: List[CourseRecordBase]):
+        keys = {(record.course_id, record.user_id) for record in records}
+        return [self.records[key] for key in keys if key in self.records]
+
+
+class InMemorySource(EventSource):
+    # Sorts its inputs, so they can be in any order
+    def __init__(self, learner_records: Iterable[LearnerRecordWithEvents],
+                 course_completions: Iterable[CourseCompletion], course_records: Iterable[CourseRecord]):
+        self.learner_records = sorted(learner_records, key=lambda r: (r.course_id, r.user_id))
+        self.completions = sorted(course_completions, key=lambda r: (r.course_id, r.user_id))
+        self.course_records = IncompleteCourseRecords(course_records)
+
+    def learner_record_pages(self, page_size: int = DEFAULT_PAGE_SIZE):
+        # Copies, so that events found by one run don't leak into the next
+        for start in range(0, len(self.learner_records), page_size):
+            yield [LearnerRecordWithEvents(lr.course_id, lr.user_id, lr.lr_id, lr.created_timestamp)
+                   for lr in self.learner_records[start:start + page_size]]
+
+    def course_completions(self):
+        return iter(self.completions)
+
+    def get_incomplete_course_records(self, records: List[CourseRecordBase]):
+        return self.course_records.lookup(records)
+
+
+class InMemorySink(EventSink):
+    def __init__(self):
+        self.events: List[LearnerRecordEvent] = []
+
+    def write(self, events: List[LearnerRecordEvent]):
+        self.events.extend(events)
+
+
+class EventTotals:
+    __slots__ = ('learner_records', 'events')
+
+    def __init__(self):
+        self.learner_records = 0
+        self.events = 0
+
+
+def derive_events(source: EventSource, sink: EventSink, page_size: int = DEFAULT_PAGE_SIZE):
+    # Serial equivalent of script.run_events for any source and sink, one page of learner records at a time
+    totals = EventTotals()
+    pages = merge_indexed_course_completions(source.learner_record_pages(page_size), source.course_completions())
+    for _map, page_completions, key_index in pages:
+        _map = find_course_completion_events(_map, page_completions, key_index)
+        non_completion_records = [lr for lr in _map.values() if not lr.has_completions]
+        incomplete_records = source.get_incomplete_course_records(non_completion_records)
+        _map = find_non_completion_events(_map, incomplete_records, key_index)
+        events = collect_events(_map)
+        sink.write(events)
+        totals.learner_records += len(_map)
+        totals.events += len(events)
+        logger.info(f"{len(events)} events derived for page of {len(_map)} learner records")
+    sink.close()
+    logger.info(f"{totals.events} events derived from {totals.learner_records} learner records")
+    return totals
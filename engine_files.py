@@ -0,0 +1,230 @@
+import argparse
+import csv
+import os
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+
+from engine import EventSource, EventSink, IncompleteCourseRecords, DEFAULT_PAGE_SIZE, derive_events
+from log import get_logger
+from metrics import metrics
+from models import CourseCompletion, CourseRecord, CourseRecordBase, LearnerRecordEvent, LearnerRecordWithEvents
+
+# File-backed sources and sinks for the engine, so that the event derivation can be run and profiled against exported
+# data without the databases. A dataset is a directory with a file per table.
+
+logger = get_logger('engine_files')
+
+TABLES = {
+    "learner_records": [("course_id", str), ("user_id", str), ("id", int), ("created_timestamp", datetime)],
+    "course_completions": [("course_id", str), ("user_id", str), ("event_timestamp", datetime)],
+    "course_records": [("course_id", str), ("user_id", str), ("state", str), ("preference", str),
+                       ("last_updated", datetime)],
+    "learner_record_events": [("learner_record_id", int), ("event_id", int), ("event_timestamp", datetime)],
+}
+
+
+def _batches(items: Iterable, size: int):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def _parse_csv_field(value: str, _type):
+    # Empty fields are NULL: ids are never empty, so this is unambiguous for these tables
+    if value == "":
+        return None
+    if _type is datetime:
+        return datetime.fromisoformat(value)
+    return _type(value)
+
+
+class CsvFormat:
+    extension = "csv"
+
+    @staticmethod
+    def read(path: str, columns: list, batch_size: int) -> Iterator[List[tuple]]:
+        types = [_type for _, _type in columns]
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for batch in _batches(reader, batch_size):
+                yield [tuple(_parse_csv_field(value, _type) for value, _type in zip(row, types)) for row in batch]
+
+    class Writer:
+        def __init__(self, path: str, columns: list):
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow([name for name, _ in columns])
+
+        def write(self, rows: List[tuple]):
+            self.writer.writerows(["" if value is None else value.isoformat() if isinstance(value, datetime) else value
+                                   for value in row] for row in rows)
+
+        def close(self):
+            self.file.close()
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet files need pyarrow, which isn't in requirements.txt: pip install pyarrow")
+    return pyarrow
+
+
+class ParquetFormat:
+    extension = "parquet"
+
+    @staticmethod
+    def schema(columns: list):
+        pa = _pyarrow()
+        types = {str: pa.string(), int: pa.int64(), datetime: pa.timestamp('us')}
+        return pa.schema([(name, types[_type]) for name, _type in columns])
+
+    @staticmethod
+    def read(path: str, columns: list, batch_size: int) -> Iterator[List[tuple]]:
+        pa = _pyarrow()
+        names = [name for name, _ in columns]
+        for batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=batch_size, columns=names):
+            yield list(zip(*(batch.column(name).to_pylist() for name in names)))
+
+    class Writer:
+        def __init__(self, path: str, columns: list):
+            self.schema = ParquetFormat.schema(columns)
+            self.writer = _pyarrow().parquet.ParquetWriter(path, self.schema)
+
+        def write(self, rows: List[tuple]):
+            if rows:
+                columns = [list(column) for column in zip(*rows)]
+                self.writer.write_table(_pyarrow().Table.from_arrays(columns, schema=self.schema))
+
+        def close(self):
+            self.writer.close()
+
+
+file_formats = {
+    "csv": CsvFormat,
+    "parquet": ParquetFormat,
+}
+
+
+def table_path(path: str, table: str, file_format: str):
+    return os.path.join(path, f"{table}.{file_formats[file_format].extension}")
+
+
+def read_table(path: str, table: str, file_format: str, batch_size: int = DEFAULT_PAGE_SIZE):
+    return file_formats[file_format].read(table_path(path, table, file_format), TABLES[table], batch_size)
+
+
+def open_table_writer(path: str, table: str, file_format: str):
+    return file_formats[file_format].Writer(table_path(path, table, file_format), TABLES[table])
+
+
+class FileSource(EventSource):
+    # Learner records and course completions are streamed, so their files must already be in (course_id, user_id)
+    # order, as written by export. Incomplete course records are loaded into memory on the first lookup.
+    def __init__(self, path: str, file_format: str = "csv"):
+        self.path = path
+        self.file_format = file_format
+        self.course_records: Optional[IncompleteCourseRecords] = None
+
+    def learner_record_pages(self, page_size: int = DEFAULT_PAGE_SIZE):
+        for rows in read_table(self.path, "learner_records", self.file_format, page_size):
+            yield [LearnerRecordWithEvents(*row) for row in rows]
+
+    def course_completions(self):
+        for rows in read_table(self.path, "course_completions", self.file_format):
+            for row in rows:
+                yield CourseCompletion(*row)
+
+    def get_incomplete_course_records(self, records: List[CourseRecordBase]):
+        if self.course_records is None:
+            self.course_records = IncompleteCourseRecords(
+                CourseRecord(*row) for rows in read_table(self.path, "course_records", self.file_format)
+                for row in rows)
+            logger.info(f"Loaded {len(self.course_records.records)} incomplete course records")
+        return self.course_records.lookup(records)
+
+
+class FileEventSink(EventSink):
+    def __init__(self, path: str, file_format: str = "csv"):
+        self.writer = file_formats[file_format].Writer(path, TABLES["learner_record_events"])
+
+    def write(self, events: List[LearnerRecordEvent]):
+        self.writer.write([(e.learner_record_id, e.event_id, e.event_timestamp) for e in events])
+
+    def close(self):
+        self.writer.close()
+
+
+class CountingSink(EventSink):
+    # Discards events, for profiling the derivation on its own
+    def write(self, events: List[LearnerRecordEvent]):
+        pass
+
+
+def write_sources(path: str, file_format: str, learner_record_pages: Iterable[List[LearnerRecordWithEvents]],
+                  course_completions: Iterable[CourseCompletion], course_record_pages: Iterable[List[CourseRecord]],
+                  page_size: int = DEFAULT_PAGE_SIZE):
+    # Learner records and course completions must be passed in (course_id, user_id) order for FileSource to read
+    os.makedirs(path, exist_ok=True)
+    tables = [
+        ("learner_records", ([(lr.course_id, lr.user_id, lr.lr_id, lr.created_timestamp) for lr in page]
+                             for page in learner_record_pages)),
+        ("course_completions", ([(c.course_id, c.user_id, c.event_timestamp) for c in batch]
+                                for batch in _batches(course_completions, page_size))),
+        ("course_records", ([(cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated) for cr in page]
+                            for page in course_record_pages)),
+    ]
+    for table, pages in tables:
+        writer = open_table_writer(path, table, file_format)
+        rows = 0
+        try:
+            for page in pages:
+                writer.write(page)
+                rows += len(page)
+        finally:
+            writer.close()
+        logger.info(f"Wrote {rows} {table} to {table_path(path, table, file_format)}")
+
+
+def export(path: str, file_format: str, page_size: int = DEFAULT_PAGE_SIZE):
+    # The only part of this module that reads the databases, so they are imported here
+    from course_completions import get_course_completions
+    from learner_record import get_learner_records_ordered_pages, get_incomplete_course_records_pages
+    write_sources(path, file_format, get_learner_records_ordered_pages(page_size), get_course_completions(page_size),
+                  get_incomplete_course_records_pages(page_size), page_size)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Run the event derivation on exported files, without the databases")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    run = subparsers.add_parser("run", help="Derive events from a dataset directory")
+    run.add_argument("--input", required=True, help="Dataset directory")
+    run.add_argument("--output", help="File to write the events to. Events are only counted without it")
+
+    export_parser = subparsers.add_parser("export", help="Export the source tables of the event migration from the "
+                                                         "databases configured in .env to a dataset directory")
+    export_parser.add_argument("--output", required=True, help="Dataset directory")
+
+    for subparser in (run, export_parser):
+        subparser.add_argument("--format", choices=file_formats.keys(), default="csv")
+        subparser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.action == "export":
+        with metrics.phase("export"):
+            export(args.output, args.format, args.page_size)
+    else:
+        sink = FileEventSink(args.output, args.format) if args.output else CountingSink()
+        with metrics.phase("events"):
+            totals = derive_events(FileSource(args.input, args.format), sink, args.page_size)
+            metrics.add_rows("events", totals.learner_records)
+        stats = metrics.report()["phases"]["events"]
+        logger.info(f"{stats['seconds']:.2f}s, {stats['rows_per_second']:.0f} learner records/sec")
@@ -4,11 +4,10 @@ from datetime import datetime
 from typing import Optional, List
 from unittest import TestCase
 
-from config import get_mysql_connection, get_pg_connection
+from config import mysql_connection, pg_connection
 from course_completions import CourseCompletion
 from learner_record import CourseRecord, get_all_learner_records
-from script import insert_course_records_for_missing_users, get_missing_user_ids_to_fetch, fetch_all_lr_map, \
-    apply_course_completion_events, apply_non_completion_events
+from script import insert_missing_course_records, run_events
 
 
 class ModuleRecord:
@@ -41,108 +40,134 @@ def gen_id():
 
 
 def insert_course_record(course_record: TestCourseRecord):
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
-        sql = """
-              INSERT INTO course_record
-                  (course_id, user_id, state, preference, last_updated, course_title)
-              VALUES (%s, %s, %s, %s, %s, %s)
-              """
-
-        vals = (
-            course_record.course_id,
-            course_record.user_id,
-            course_record.state,
-            course_record.preference,
-            course_record.last_updated,
-            f"TEST_COURSE_{course_record.course_id}"
-        )
-
-        cursor.execute(sql, vals)
-
-    conn.commit()
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  INSERT INTO course_record
+                      (course_id, user_id, state, preference, last_updated, course_title)
+                  VALUES (%s, %s, %s, %s, %s, %s)
+                  """
+
+            vals = (
+                course_record.course_id,
+                course_record.user_id,
+                course_record.state,
+                course_record.preference,
+                course_record.last_updated,
+                f"TEST_COURSE_{course_record.course_id}"
+            )
+
+            cursor.execute(sql, vals)
+
+        conn.commit()
     for module_record in course_record.module_records:
         insert_module_record(module_record)
 
 
 def insert_course_completion(course_completion: CourseCompletion):
-    conn = get_pg_connection()
-    with conn.cursor() as cursor:
-        sql = """
-              INSERT INTO public.course_completion_events (external_id, user_id, course_id, course_title,
-                                                           event_timestamp, organisation_id, profession_id)
-              VALUES (%s, %s, %s, %s, %s, %s, %s)
-              """
-
-        vals = (
-            f"MIGRATE_{gen_id()}",
-            course_completion.user_id,
-            course_completion.course_id,
-            f"TEST_COURSE_{course_completion.course_id}",
-            course_completion.event_timestamp,
-            1,
-            1
-        )
-        cursor.execute(sql, vals)
-    conn.commit()
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  INSERT INTO public.course_completion_events (external_id, user_id, course_id, course_title,
+                                                               event_timestamp, organisation_id, profession_id)
+                  VALUES (%s, %s, %s, %s, %s, %s, %s)
+                  """
+
+            vals = (
+                f"MIGRATE_{gen_id()}",
+                course_completion.user_id,
+                course_completion.course_id,
+                f"TEST_COURSE_{course_completion.course_id}",
+                course_completion.event_timestamp,
+                1,
+                1
+            )
+            cursor.execute(sql, vals)
+        conn.commit()
 
 
 def insert_module_record(module_record: ModuleRecord):
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
-        sql = """
-              INSERT INTO module_record (module_id, created_at, course_id, user_id)
-              VALUES (%s, %s, %s, %s)
-              """
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  INSERT INTO module_record (module_id, created_at, course_id, user_id)
+                  VALUES (%s, %s, %s, %s)
+                  """
 
-        vals = (
-            module_record.module_id,
-            module_record.created_at,
-            module_record.course_id,
-            module_record.user_id
-        )
+            vals = (
+                module_record.module_id,
+                module_record.created_at,
+                module_record.course_id,
+                module_record.user_id
+            )
 
-        cursor.execute(sql, vals)
-    conn.commit()
+            cursor.execute(sql, vals)
+        conn.commit()
 
 
 def teardown_course_records():
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
-        sql = """
-              DELETE
-              FROM course_record
-              WHERE course_id like 'MIGRATION_COURSE_%'
-              """
-        cursor.execute(sql)
-    conn.commit()
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  DELETE
+                  FROM course_record
+                  WHERE course_id like 'MIGRATION_COURSE_%'
+                  """
+            cursor.execute(sql)
+        conn.commit()
 
 
 def teardown_learner_records():
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
-        sql = """
-              DELETE
-              FROM learner_records
-              WHERE resource_id like 'MIGRATION_COURSE_%'
-              """
-        cursor.execute(sql)
-    conn.commit()
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  DELETE
+                  FROM learner_records
+                  WHERE resource_id like 'MIGRATION_COURSE_%'
+                  """
+            cursor.execute(sql)
+        conn.commit()
+
+
+def get_learner_record_events(learner_record_id: int):
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT learner_record_event_type, event_timestamp
+                FROM learner_record_events
+                WHERE learner_record_id = %s
+                ORDER BY event_timestamp, id
+            """, (learner_record_id,))
+            return cursor.fetchall()
+
+
+def teardown_learner_record_events():
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  DELETE lre
+                  FROM learner_record_events lre
+                  JOIN learner_records lr ON lr.id = lre.learner_record_id
+                  WHERE lr.resource_id like 'MIGRATION_COURSE_%'
+                  """
+            cursor.execute(sql)
+        conn.commit()
 
 
 def teardown_course_completions():
-    conn = get_pg_connection()
-    with conn.cursor() as cursor:
-        sql = """
-              DELETE
-              FROM course_completion_events
-              WHERE external_id like 'MIGRATE_%'
-              """
-        cursor.execute(sql)
-    conn.commit()
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            sql = """
+                  DELETE
+                  FROM course_completion_events
+                  WHERE external_id like 'MIGRATE_%'
+                  """
+            cursor.execute(sql)
+        conn.commit()
 
 
 def teardown():
+    teardown_learner_record_events()
     teardown_course_records()
     teardown_learner_records()
     teardown_course_completions()
@@ -209,12 +234,11 @@ class IntegrationTests(TestCase):
                    course_record_7):
             insert_course_record(cr)
 
-        missing_ids = [_id for _id in get_missing_user_ids_to_fetch() if _id.startswith('MIGRATION_')]
-        assert len(missing_ids) == 7
-
-        insert_course_records_for_missing_users(missing_ids, True)
+        # The same anti-join and event extraction as a full execute run of learner_records and events
+        insert_missing_course_records(execute=True)
         res = get_all_learner_records()
-        res_map = {lr.get_id(): lr for lr in res}
+        res_map = {lr.get_id(): lr for lr in res if lr.course_id.startswith('MIGRATION_COURSE_')}
+        assert len(res_map) == 7
         assert res_map[course_record_1.get_id()].created_timestamp == datetime_2024
         assert res_map[course_record_2.get_id()].created_timestamp == datetime_2025
         assert res_map[course_record_3.get_id()].created_timestamp == datetime_2025
@@ -223,26 +247,13 @@ class IntegrationTests(TestCase):
         assert res_map[course_record_6.get_id()].created_timestamp == datetime_2024
         assert res_map[course_record_7.get_id()].created_timestamp == datetime_2024
 
-        _map = fetch_all_lr_map()
-        _map = apply_course_completion_events(_map)
-        _map = apply_non_completion_events(_map)
-
-        assert len(_map[course_record_1.get_id()].events) == 0
-
-        assert len(_map[course_record_2.get_id()].events) == 1
-        assert _map[course_record_2.get_id()].events[0].event_id == 1
-
-        assert len(_map[course_record_3.get_id()].events) == 1
-        assert _map[course_record_3.get_id()].events[0].event_id == 3
-
-        assert len(_map[course_record_4.get_id()].events) == 1
-        assert _map[course_record_4.get_id()].events[0].event_id == 4
-
-        assert len(_map[course_record_5.get_id()].events) == 2
-        assert _map[course_record_5.get_id()].events[0].event_id == 4
-        assert _map[course_record_5.get_id()].events[1].event_id == 4
-
-        assert len(_map[course_record_6.get_id()].events) == 1
-        assert _map[course_record_6.get_id()].events[0].event_id == 2
+        run_events(execute=True)
+        events = {_id: [row[0] for row in get_learner_record_events(lr.lr_id)] for _id, lr in res_map.items()}
 
-        assert len(_map[course_record_7.get_id()].events) == 0
+        assert events[course_record_1.get_id()] == []
+        assert events[course_record_2.get_id()] == [1]
+        assert events[course_record_3.get_id()] == [3]
+        assert events[course_record_4.get_id()] == [4]
+        assert events[course_record_5.get_id()] == [4, 4]
+        assert events[course_record_6.get_id()] == [2]
+        assert events[course_record_7.get_id()] == []
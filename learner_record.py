@@ -1,227 +1,588 @@
-from datetime import datetime
-from typing import List, Optional, Set
-
-from config import get_mysql_connection, event_source_id, batch_size
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Set, Tuple
+
+from batching import AdaptiveBatcher, get_batcher
+from bulk_writer import BulkWriter, get_bulk_writer
+from config import mysql_connection, event_source_id, batch_size, course_record_page_size, \
+    course_record_lookup_strategy, missing_record_batch_size, teardown_chunk_size, teardown_throttle_seconds, \
+    module_record_index, adaptive_batching
 from log import get_logger
-from models import CourseRecordBase
+from metrics import metrics
+from module_record_index import MODULE_RECORD_INDEX_TABLE
+from models import CourseRecordBase, LearnerRecord, LearnerRecordEvent, LearnerRecordWithEvents, BasicCourseRecord, \
+    CourseRecord, CombinedRecord, MOVE_TO_LEARNING_PLAN, REMOVE_FROM_LEARNING_PLAN, REMOVE_FROM_SUGGESTIONS, \
+    COMPLETE_COURSE
+from sharding import Shard
 
 logger = get_logger('learner_record')
 
 
-class LearnerRecord(CourseRecordBase):
-    def __init__(self, course_id, user_id, lr_id: int, created_timestamp: datetime):
-        super().__init__(course_id, user_id)
-        self.lr_id = lr_id
-        self.created_timestamp = created_timestamp
-
-
-class LearnerRecordEvent:
-    def __init__(self, learner_record_id, event_id: int, event_timestamp: datetime):
-        self.learner_record_id = learner_record_id
-        self.event_id = event_id
-        self.event_timestamp = event_timestamp
-
-
-class LearnerRecordWithEvents(LearnerRecord):
-    def __init__(self, course_id, user_id, lr_id: int, created_timestamp: datetime,
-                 events: List[LearnerRecordEvent] = None, has_completions: bool = False):
-        super().__init__(course_id, user_id, lr_id, created_timestamp)
-        if events is None:
-            events = []
-        self.events = events
-        self.has_completions = has_completions
-
-    def sort_events(self):
-        self.events.sort(key=lambda x: x.event_timestamp)
-
-
-class BasicCourseRecord(CourseRecordBase):
-    def __init__(self, course_id, user_id, created_at: datetime):
-        super().__init__(course_id, user_id)
-        self.created_at = created_at
-
-
-class CourseRecord(BasicCourseRecord):
-    def __init__(self, course_id, user_id, state: Optional[str], preference: Optional[str], last_updated: datetime):
-        super().__init__(course_id, user_id, last_updated)
-        self.state = state
-        self.preference = preference
-        self.last_updated = last_updated
-
-
-class CombinedRecord(CourseRecordBase):
-    def __init__(self, course_id: str, user_id: str, learner_record_with_events: LearnerRecordWithEvents,
-                 course_record: CourseRecord):
-        super().__init__(course_id, user_id)
-        self.learner_record_with_events = learner_record_with_events
-        self.course_record = course_record
-
-
-def insert_learner_records(learner_records: List[LearnerRecord]):
-    logger.info(f"Inserting {len(learner_records)} total records in batches of {batch_size}")
-    connection = get_mysql_connection()
-    for _i in range(0, len(learner_records), batch_size):
-        batch = learner_records[_i:_i + batch_size]
-        logger.info(f"Inserting {len(batch)} records")
-        values = []
-        for row in batch:
-            values.append(f"(1, UUID(), '{row.user_id}', '{row.course_id}', '{row.created_timestamp}')")
-        value_sql = ",".join(values)
-        sql = f"""
-              INSERT IGNORE INTO learner_records (learner_record_type, learner_record_uid, learner_id, resource_id, created_timestamp)
-              VALUES {value_sql};
-              """
-        with connection.cursor() as cursor:
-            cursor.execute(sql)
-        connection.commit()
-
-
-def delete_learner_records():
+def insert_learner_records(learner_records: List[LearnerRecord], writer: Optional[BulkWriter] = None):
+    writer = writer or get_bulk_writer()
+    logger.info(f"Inserting {len(learner_records)} total records in batches of {writer.batch_size} with {writer.name}")
+    writer.write(
+        "learner_records",
+        ["learner_id", "resource_id", "created_timestamp"],
+        [(row.user_id, row.course_id, row.created_timestamp) for row in learner_records],
+        ignore=True,
+        set_expressions={"learner_record_type": "1", "learner_record_uid": "UUID()"}
+    )
+
+
+def get_id_bounds(table: str):
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        with metrics.db_call(f"get_id_bounds_{table}"):
+            cursor.execute(f"SELECT MIN(id), MAX(id) FROM {table}")
+            return cursor.fetchone()
+
+
+# Deletes rows with ids in [min_id, max_id] in primary key ranges of chunk_size, each in its own transaction, so that
+# no single statement holds locks or undo log for the whole table. condition optionally restricts the rows deleted.
+def delete_in_id_chunks(table: str, min_id: int, max_id: int, chunk_size: int, throttle_seconds: float = 0,
+                        condition: str = "", params: tuple = ()):
+    logger.info(f"Deleting from {table} with ids {min_id} to {max_id} in chunks of {chunk_size}")
+    sql = f"DELETE FROM {table} WHERE id BETWEEN %s AND %s{f' AND {condition}' if condition else ''}"
+    deleted = 0
+    started = time.perf_counter()
+    for chunk_start in range(min_id, max_id + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, max_id)
+        with metrics.batch(f"teardown.{table}"):
+            with mysql_connection() as connection, metrics.db_call(f"delete_{table}"):
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, (chunk_start, chunk_end) + params)
+                    rows = cursor.rowcount
+                connection.commit()
+        deleted += rows
+        metrics.add_rows(f"teardown.{table}", rows)
+        elapsed = time.perf_counter() - started
+        logger.info(f"Deleted {deleted} rows from {table} up to id {chunk_end} "
+                    f"({100 * (chunk_end + 1 - min_id) / (max_id + 1 - min_id):.1f}% of ids, "
+                    f"{deleted / elapsed:.0f} rows/sec)")
+        if throttle_seconds:
+            time.sleep(throttle_seconds)
+    return deleted
+
+
+def delete_learner_records(chunk_size: int = teardown_chunk_size, throttle_seconds: float = teardown_throttle_seconds):
     logger.info("Tearing down learner records")
-    connection = get_mysql_connection()
-    sql = """
-          delete
-          from learner_records; \
-          """
-    with connection.cursor() as cursor:
-        cursor.execute(sql)
-    connection.commit()
+    min_id, max_id = get_id_bounds("learner_records")
+    if min_id is None:
+        logger.info("No learner records to delete")
+        return
+    deleted = delete_in_id_chunks("learner_records", min_id, max_id, chunk_size, throttle_seconds)
+    logger.info(f"Deleted {deleted} learner records")
 
 
-def delete_learner_record_events():
+# With source_only, only events with the migration's EVENT_SOURCE_ID are deleted
+def delete_learner_record_events(chunk_size: int = teardown_chunk_size,
+                                 throttle_seconds: float = teardown_throttle_seconds, source_only: bool = False):
     logger.info("Tearing down learner record events")
-    connection = get_mysql_connection()
-    sql = """
-          delete
-          from learner_record_events; \
-          """
-    with connection.cursor() as cursor:
-        cursor.execute(sql)
-    connection.commit()
-
-
-def insert_learner_record_events(learner_record_events: List[LearnerRecordEvent]):
-    batch_size = 1000
-    logger.info(f"Inserting {len(learner_record_events)} total events in batches of {batch_size}")
-    connection = get_mysql_connection()
-    for _i in range(0, len(learner_record_events), batch_size):
-        batch = learner_record_events[_i:_i + batch_size]
-        logger.info(f"Inserting {len(batch)} events")
-        values = []
-        for row in batch:
-            values.append(f"({row.learner_record_id}, {row.event_id}, {event_source_id}, '{row.event_timestamp}')")
-        value_sql = ",".join(values)
-        sql = f"""
-                INSERT INTO learner_record_events (learner_record_id, learner_record_event_type, learner_record_event_source, event_timestamp)
-                VALUES {value_sql};
-              """
-        with connection.cursor() as cursor:
-            cursor.execute(sql)
-        connection.commit()
+    min_id, max_id = get_id_bounds("learner_record_events")
+    if min_id is None:
+        logger.info("No learner record events to delete")
+        return
+    condition, params = ("learner_record_event_source = %s", (event_source_id,)) if source_only else ("", ())
+    deleted = delete_in_id_chunks("learner_record_events", min_id, max_id, chunk_size, throttle_seconds, condition,
+                                  params)
+    logger.info(f"Deleted {deleted} learner record events")
+
+
+EVENT_KEY_COLUMNS = ["learner_record_id", "learner_record_event_type", "event_timestamp"]
+
+
+class EventTableSchema:
+    __slots__ = ('timestamp_precision', 'has_unique_event_key')
+
+    def __init__(self, timestamp_precision: int, has_unique_event_key: bool):
+        self.timestamp_precision = timestamp_precision
+        self.has_unique_event_key = has_unique_event_key
+
+
+_event_table_schema: Optional[EventTableSchema] = None
+
+
+# The fractional seconds precision of event_timestamp, and whether a unique key covers exactly the event key columns.
+# Read once per process, as the schema doesn't change during a run.
+def get_event_table_schema() -> EventTableSchema:
+    global _event_table_schema
+    if _event_table_schema is None:
+        with mysql_connection() as conn, conn.cursor() as cursor:
+            with metrics.db_call("get_event_table_schema"):
+                cursor.execute("""
+                    SELECT DATETIME_PRECISION FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'learner_record_events'
+                    AND COLUMN_NAME = 'event_timestamp'
+                """)
+                row = cursor.fetchone()
+                cursor.execute("""
+                    SELECT GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'learner_record_events' AND NON_UNIQUE = 0
+                    GROUP BY INDEX_NAME
+                """)
+                unique_keys = [set(columns.split(",")) for columns, in cursor.fetchall()]
+        _event_table_schema = EventTableSchema((row[0] or 0) if row else 0, set(EVENT_KEY_COLUMNS) in unique_keys)
+        logger.info(f"event_timestamp has precision {_event_table_schema.timestamp_precision}, unique event key: "
+                    f"{_event_table_schema.has_unique_event_key}")
+    return _event_table_schema
+
+
+# Rounds to the fractional seconds precision of a DATETIME column the way MySQL does on insert, so that a timestamp
+# with microseconds matches the value that is stored for it
+def normalize_timestamp(timestamp: datetime, precision: int) -> datetime:
+    if timestamp is None or precision >= 6:
+        return timestamp
+    unit = 10 ** (6 - precision)
+    microseconds = (timestamp.microsecond + unit // 2) // unit * unit
+    return timestamp.replace(microsecond=0) + timedelta(microseconds=microseconds)
+
+
+def get_existing_learner_record_event_keys(learner_record_ids: List[int]) -> Set[Tuple[int, int, datetime]]:
+    existing = set()
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        for _i in range(0, len(learner_record_ids), batch_size):
+            batch = learner_record_ids[_i:_i + batch_size]
+            ids_in = ",".join(["%s"] * len(batch))
+            sql = f"""
+                SELECT lre.learner_record_id, lre.learner_record_event_type, lre.event_timestamp
+                FROM learner_record_events lre
+                WHERE lre.learner_record_id in ({ids_in});
+            """
+            with metrics.db_call("get_existing_learner_record_event_keys"):
+                cursor.execute(sql, batch)
+                existing.update((row[0], row[1], row[2]) for row in cursor.fetchall())
+    return existing
+
+
+# Drops events that already exist for their learner record (same type and timestamp), and duplicates within the list.
+# Timestamps are compared at the precision of the column, as that is what is stored for them.
+def remove_existing_learner_record_events(learner_record_events: List[LearnerRecordEvent], precision: int = 0):
+    learner_record_ids = list({event.learner_record_id for event in learner_record_events})
+    seen = get_existing_learner_record_event_keys(learner_record_ids)
+    new_events = []
+    for event in learner_record_events:
+        key = (event.learner_record_id, event.event_id, normalize_timestamp(event.event_timestamp, precision))
+        if key not in seen:
+            seen.add(key)
+            new_events.append(event)
+    logger.info(f"{len(learner_record_events) - len(new_events)} of {len(learner_record_events)} events already exist")
+    return new_events
+
+
+# With skip_existing, events that are already in learner_record_events are not inserted again, so reruns and resumed
+# runs don't duplicate events. When a unique key covers (learner_record_id, learner_record_event_type, event_timestamp)
+# the database skips them with INSERT IGNORE; otherwise the existing events are read and filtered out first.
+def insert_learner_record_events(learner_record_events: List[LearnerRecordEvent], writer: Optional[BulkWriter] = None,
+                                 on_batch_committed: Optional[Callable[[int], None]] = None,
+                                 skip_existing: bool = True):
+    writer = writer or get_bulk_writer()
+    ignore = False
+    precision = 6
+    if skip_existing:
+        schema = get_event_table_schema()
+        precision = schema.timestamp_precision
+        ignore = schema.has_unique_event_key
+        if not ignore:
+            learner_record_events = remove_existing_learner_record_events(learner_record_events, precision)
+    logger.info(f"Inserting {len(learner_record_events)} total events in batches of {writer.batch_size} "
+                f"with {writer.name}")
+    writer.write(
+        "learner_record_events",
+        ["learner_record_id", "learner_record_event_type", "learner_record_event_source", "event_timestamp"],
+        [(row.learner_record_id, row.event_id, event_source_id, normalize_timestamp(row.event_timestamp, precision))
+         for row in learner_record_events],
+        ignore=ignore,
+        on_batch_committed=on_batch_committed
+    )
 
 
 def get_all_learner_records():
     logger.info("Fetching all learner records")
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
+    return [lr for page in get_learner_records_pages() for lr in page]
+
+
+# Keyset pagination on lr.id so only one page of learner records is held in memory at a time
+def get_learner_records_pages(page_size: int = course_record_page_size):
+    last_id = 0
+    while True:
+        logger.info(f"Fetching page of {page_size} learner records after id {last_id}")
+        with mysql_connection() as conn, conn.cursor() as cursor:
+            sql = """
+                SELECT lr.resource_id as 'course_id', lr.learner_id as 'user_id', lr.id, lr.created_timestamp
+                FROM learner_records lr
+                WHERE lr.id > %s
+                ORDER BY lr.id
+                LIMIT %s;
+            """
+            with metrics.db_call("get_learner_records_page"):
+                cursor.execute(sql, (last_id, page_size))
+                rows = cursor.fetchall()
+            page = [LearnerRecordWithEvents(row[0], row[1], row[2], row[3]) for row in rows]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1].lr_id
+
+
+# Streams every learner record over an unbuffered cursor in (course_id, user_id) byte order, matching the order of
+# course_completions.get_course_completions. The connection is held until the stream is exhausted.
+# after_key (course_id, user_id) starts the stream after that key, for resuming a run.
+def get_learner_records_ordered_pages(page_size: int = course_record_page_size,
+                                      after_key: Optional[Tuple[str, str]] = None, shard: Optional[Shard] = None):
+    logger.info(f"Streaming learner records in pages of {page_size}" + (f" after {after_key}" if after_key else "") +
+                (f" for {shard}" if shard else ""))
+    with mysql_connection() as conn, conn.cursor(buffered=False) as cursor:
+        # Allow time for each page to be processed before the next fetch without the server dropping the stream
+        cursor.execute("SET SESSION net_write_timeout = 3600;")
+        conditions = []
+        if after_key:
+            conditions.append("(BINARY lr.resource_id, BINARY lr.learner_id) > (BINARY %s, BINARY %s)")
+        if shard:
+            conditions.append(shard.mysql_condition("lr.learner_id"))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
         sql = f"""
             SELECT lr.resource_id as 'course_id', lr.learner_id as 'user_id', lr.id, lr.created_timestamp
-            FROM learner_records lr;
+            FROM learner_records lr
+            {where}
+            ORDER BY BINARY lr.resource_id, BINARY lr.learner_id;
         """
-        cursor.execute(sql)
-        return [LearnerRecordWithEvents(row[0], row[1], row[2], row[3]) for row in cursor.fetchall()]
+        with metrics.db_call("get_learner_records_ordered"):
+            cursor.execute(sql, after_key)
+        while True:
+            with metrics.db_call("get_learner_records_ordered_page"):
+                rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield [LearnerRecordWithEvents(row[0], row[1], row[2], row[3]) for row in rows]
 
 
-def get_user_learner_record_counts():
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
+def count_non_completed_course_records():
+    with mysql_connection() as conn, conn.cursor() as cursor:
         sql = f"""
-            select lr.learner_id, count(*)
-            from learner_records lr
-            where lr.learner_record_type = 1
-            group by lr.learner_id
-            order by lr.learner_id asc
+            select count(*) from course_record where state != 'COMPLETED'
+        """
+        with metrics.db_call("count_non_completed_course_records"):
+            cursor.execute(sql)
+            return int(cursor.fetchone()[0])
+
+
+# The created_at of a course record is its earliest module record's created_at, or its last_updated if that is earlier
+# or it has no module records. Returns the select expression for it and the join it needs. With use_index the earliest
+# module record is looked up in the table built by module_record_index. Otherwise it is a correlated lookup on the
+# module_record key rather than a grouped join of every module record, which spilled to disk for users with many
+# module records.
+def _course_record_created_at(use_index: bool):
+    if use_index:
+        return ("LEAST(COALESCE(f.first_created_at, cr.last_updated), cr.last_updated)",
+                f"LEFT OUTER JOIN {MODULE_RECORD_INDEX_TABLE} f "
+                f"ON f.course_id = cr.course_id AND f.user_id = cr.user_id")
+    return ("""LEAST(COALESCE((
+                SELECT MIN(mr.created_at)
+                FROM learner_record.module_record mr
+                WHERE mr.course_id = cr.course_id AND mr.user_id = cr.user_id
+            ), cr.last_updated), cr.last_updated)""", "")
+
+
+# Anti-join of course_record against learner_records, streamed over an unbuffered cursor in batches of exactly the
+# (course_id, user_id) pairs that don't have a learner record yet.
+# changed_since (course_record.last_updated, module_record.created_at) watermarks limit the diff to course records
+# updated, or with module records created, after them.
+# Each batch is as large as batcher's size when it is fetched, so callers that time their work on the batches with the
+# batcher adapt the batch size to it.
+def get_missing_course_record_keys(batch_size: int = missing_record_batch_size,
+                                   changed_since: Optional[Tuple[datetime, datetime]] = None,
+                                   shard: Optional[Shard] = None, batcher: Optional[AdaptiveBatcher] = None):
+    batcher = batcher or get_batcher("missing_course_records", batch_size, **adaptive_batching)
+    logger.info(f"Streaming missing course record keys in batches of {batcher.size}" +
+                (f" changed since {changed_since}" if changed_since else "") + (f" for {shard}" if shard else ""))
+    course_records = "course_record cr"
+    if changed_since:
+        course_records = """(
+                SELECT course_id, user_id FROM course_record WHERE last_updated > %s
+                UNION
+                SELECT course_id, user_id FROM module_record WHERE created_at > %s
+            ) changed
+            JOIN course_record cr ON cr.course_id = changed.course_id AND cr.user_id = changed.user_id"""
+    with mysql_connection() as conn, conn.cursor(buffered=False) as cursor:
+        cursor.execute("SET SESSION net_write_timeout = 3600;")
+        sql = f"""
+            SELECT cr.course_id, cr.user_id
+            FROM {course_records}
+            LEFT OUTER JOIN learner_records lr
+                ON lr.resource_id = cr.course_id AND lr.learner_id = cr.user_id AND lr.learner_record_type = 1
+            WHERE lr.id is null
+            {f"AND {shard.mysql_condition('cr.user_id')}" if shard else ""};
+        """
+        with metrics.db_call("get_missing_course_record_keys"):
+            cursor.execute(sql, changed_since)
+        while True:
+            with metrics.db_call("get_missing_course_record_keys_page"):
+                rows = cursor.fetchmany(batcher.size)
+            if not rows:
+                return
+            yield [(row[0], row[1]) for row in rows]
+
+
+def get_course_records_for_keys(keys: List[Tuple[str, str]], use_index: bool = module_record_index):
+    logger.info(f"Fetching course records for {len(keys)} keys")
+    keys_in = ",".join(["(%s, %s)"] * len(keys))
+    created_at, join = _course_record_created_at(use_index)
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        sql = f"""
+            SELECT cr.course_id, cr.user_id, {created_at} as 'created_at'
+            from learner_record.course_record cr
+            {join}
+            WHERE (cr.course_id, cr.user_id) in ({keys_in});
         """
-        cursor.execute(sql)
-        return {str(row[0]): int(row[1]) for row in cursor.fetchall()}
+        with metrics.db_call("get_course_records_for_keys"):
+            cursor.execute(sql, [_id for key in keys for _id in key])
+            rows = cursor.fetchall()
+        return [BasicCourseRecord(row[0], row[1], row[2]) for row in rows]
 
 
-# Events
+# Incremental runs
 
-MOVE_TO_LEARNING_PLAN = 1
-REMOVE_FROM_LEARNING_PLAN = 2
-REMOVE_FROM_SUGGESTIONS = 3
-COMPLETE_COURSE = 4
+def get_learner_record_watermarks():
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        sql = """
+            SELECT (SELECT MAX(last_updated) FROM course_record),
+                   (SELECT MAX(created_at) FROM module_record),
+                   (SELECT MAX(id) FROM learner_records);
+        """
+        with metrics.db_call("get_learner_record_watermarks"):
+            cursor.execute(sql)
+            row = cursor.fetchone()
+        return {
+            "course_record_last_updated": row[0],
+            "module_record_created_at": row[1],
+            "learner_record_id": row[2],
+        }
+
+
+def get_course_record_keys_updated_between(since: datetime, until: datetime):
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        sql = """
+            SELECT cr.course_id, cr.user_id
+            FROM course_record cr
+            WHERE cr.last_updated > %s AND cr.last_updated <= %s;
+        """
+        with metrics.db_call("get_course_record_keys_updated_between"):
+            cursor.execute(sql, (since, until))
+            rows = cursor.fetchall()
+        return {(row[0], row[1]) for row in rows}
+
+
+def get_learner_record_keys_created_between(after_id: int, up_to_id: int):
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        sql = """
+            SELECT lr.resource_id, lr.learner_id
+            FROM learner_records lr
+            WHERE lr.id > %s AND lr.id <= %s;
+        """
+        with metrics.db_call("get_learner_record_keys_created_between"):
+            cursor.execute(sql, (after_id, up_to_id))
+            rows = cursor.fetchall()
+        return {(row[0], row[1]) for row in rows}
 
 
-def get_user_course_record_counts():
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
+# has_completions is set for learner records that already have a COMPLETE_COURSE event
+def get_learner_records_for_keys(keys: List[Tuple[str, str]]):
+    logger.info(f"Fetching learner records for {len(keys)} keys")
+    keys_in = ",".join(["(%s, %s)"] * len(keys))
+    with mysql_connection() as conn, conn.cursor() as cursor:
         sql = f"""
-            select cr.user_id, count(*)
-            from course_record cr 
-            group by cr.user_id
-            order by cr.user_id asc
+            SELECT lr.resource_id as 'course_id', lr.learner_id as 'user_id', lr.id, lr.created_timestamp,
+                EXISTS(
+                    SELECT 1 FROM learner_record_events lre
+                    WHERE lre.learner_record_id = lr.id AND lre.learner_record_event_type = %s
+                ) as 'has_completions'
+            FROM learner_records lr
+            WHERE (lr.resource_id, lr.learner_id) in ({keys_in});
         """
-        cursor.execute(sql)
-        return {str(row[0]): int(row[1]) for row in cursor.fetchall()}
+        with metrics.db_call("get_learner_records_for_keys"):
+            cursor.execute(sql, [COMPLETE_COURSE] + [_id for key in keys for _id in key])
+            rows = cursor.fetchall()
+        return [LearnerRecordWithEvents(row[0], row[1], row[2], row[3], has_completions=bool(row[4])) for row in rows]
 
 
-def count_non_completed_course_records():
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
+# Fast report
+
+def get_missing_learner_record_counts_by_user(shard: Optional[Shard] = None):
+    with mysql_connection() as conn, conn.cursor(buffered=False) as cursor:
+        cursor.execute("SET SESSION net_write_timeout = 3600;")
         sql = f"""
-            select count(*) from course_record where state != 'COMPLETED'
+            SELECT cr.user_id, COUNT(*)
+            FROM course_record cr
+            LEFT OUTER JOIN learner_records lr
+                ON lr.resource_id = cr.course_id AND lr.learner_id = cr.user_id AND lr.learner_record_type = 1
+            WHERE lr.id is null
+            {f"AND {shard.mysql_condition('cr.user_id')}" if shard else ""}
+            GROUP BY cr.user_id;
         """
-        cursor.execute(sql)
-        return int(cursor.fetchone()[0])
-
-
-def get_course_records(learner_ids: List[str]):
-    logger.info(f"Fetching course records for {len(learner_ids)} learners")
-    conn = get_mysql_connection()
-    user_ids_in = ",".join([f"'{_id}'" for _id in learner_ids])
-    with conn.cursor() as cursor:
+        with metrics.db_call("get_missing_learner_record_counts_by_user"):
+            cursor.execute(sql)
+        while True:
+            with metrics.db_call("get_missing_learner_record_counts_by_user_page"):
+                rows = cursor.fetchmany(missing_record_batch_size)
+            if not rows:
+                return
+            yield from ((row[0], int(row[1])) for row in rows)
+
+
+# Every learner record in (course_id, user_id) byte order with the non-completion event its course record would get,
+# classified in MySQL the same way as script.transform_course_record_into_event_id (None for no event)
+def get_non_completion_event_types_ordered_pages(page_size: int = course_record_page_size,
+                                                 shard: Optional[Shard] = None):
+    with mysql_connection() as conn, conn.cursor(buffered=False) as cursor:
+        cursor.execute("SET SESSION net_write_timeout = 3600;")
         sql = f"""
-            SELECT cr.course_id, cr.user_id,
-            case 
-                when MIN(mr.created_at) is null then cr.last_updated
-                else LEAST(MIN(mr.created_at), cr.last_updated)
-            end as 'created_at'
-            from learner_record.course_record cr
-            LEFT OUTER JOIN learner_record.module_record mr ON mr.course_id = cr.course_id AND mr.user_id = cr.user_id
-            WHERE cr.user_id in ({user_ids_in})
-            GROUP BY cr.course_id, cr.user_id;
+            SELECT lr.resource_id, lr.learner_id,
+                CASE
+                    WHEN cr.state = 'ARCHIVED' AND NOT (lr.created_timestamp <=> cr.last_updated) THEN %s
+                    WHEN cr.state is null AND cr.preference = 'LIKED' THEN %s
+                    WHEN cr.state is null AND cr.preference = 'DISLIKED' THEN %s
+                END
+            FROM learner_records lr
+            LEFT OUTER JOIN course_record cr ON cr.course_id = lr.resource_id AND cr.user_id = lr.learner_id
+            {f"WHERE {shard.mysql_condition('lr.learner_id')}" if shard else ""}
+            ORDER BY BINARY lr.resource_id, BINARY lr.learner_id;
+        """
+        with metrics.db_call("get_non_completion_event_types_ordered"):
+            cursor.execute(sql, (REMOVE_FROM_LEARNING_PLAN, MOVE_TO_LEARNING_PLAN, REMOVE_FROM_SUGGESTIONS))
+        while True:
+            with metrics.db_call("get_non_completion_event_types_ordered_page"):
+                rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield rows
+
+
+# Snapshots
+
+def count_learner_records():
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        with metrics.db_call("count_learner_records"):
+            cursor.execute("SELECT COUNT(*) FROM learner_records")
+            return int(cursor.fetchone()[0])
+
+
+# The rows get_incomplete_course_records_pages streams
+def count_incomplete_course_records():
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        with metrics.db_call("count_incomplete_course_records"):
+            cursor.execute("SELECT COUNT(*) FROM course_record cr WHERE cr.state != 'COMPLETED' OR cr.state IS NULL")
+            return int(cursor.fetchone()[0])
+
+
+def get_incomplete_course_records_pages(page_size: int = course_record_page_size):
+    logger.info(f"Streaming incomplete course records in pages of {page_size}")
+    with mysql_connection() as conn, conn.cursor(buffered=False) as cursor:
+        cursor.execute("SET SESSION net_write_timeout = 3600;")
+        sql = """
+            SELECT cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated
+            from course_record cr
+            where cr.state != 'COMPLETED' or cr.state is null;
         """
-        cursor.execute(sql)
-        return [BasicCourseRecord(row[0], row[1], row[2]) for row in cursor.fetchall()]
+        with metrics.db_call("get_incomplete_course_records"):
+            cursor.execute(sql)
+        while True:
+            with metrics.db_call("get_incomplete_course_records_page"):
+                rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield [CourseRecord(row[0], row[1], row[2], row[3], row[4]) for row in rows]
 
 
-def get_incomplete_course_records_with_records(records_to_query: List[CourseRecordBase]):
-    logger.info(f"Fetching incomplete course records for {len(records_to_query)} learner records")
-    total_records = []
-    for _i in range(0, len(records_to_query), 1000):
-        batch = records_to_query[_i:_i + 1000]
-        logger.info(f"Finding course records {len(batch)} learner records")
-        user_id_course_ids = set()
-        for record in batch:
-            user_id_course_ids.add((record.course_id, record.user_id))
-        total_records.extend(get_incomplete_course_records_with_ids(user_id_course_ids))
-    return total_records
+def get_incomplete_course_records_with_records(records_to_query: List[CourseRecordBase],
+                                               strategy: str = course_record_lookup_strategy):
+    logger.info(f"Fetching incomplete course records for {len(records_to_query)} learner records "
+                f"using the {strategy} strategy")
+    user_id_course_ids = {(record.course_id, record.user_id) for record in records_to_query}
+    if not user_id_course_ids:
+        return []
+    return course_record_lookup_strategies[strategy](user_id_course_ids)
 
 
 def get_incomplete_course_records_with_ids(user_id_course_ids: Set[tuple[str]]):
-    logger.info("Fetching incomplete course records")
-    where = " OR ".join(
-        f"(cr.course_id = '{c_id}' and cr.user_id = '{u_id}' and cr.state != 'COMPLETED' || cr.state is null)" for
-        c_id, u_id in
-        user_id_course_ids)
-    conn = get_mysql_connection()
-    with conn.cursor() as cursor:
+    logger.info(f"Fetching incomplete course records for {len(user_id_course_ids)} keys")
+    params = [_id for key in user_id_course_ids for _id in key]
+    keys_in = ",".join(["(%s, %s)"] * len(user_id_course_ids))
+    with mysql_connection() as conn, conn.cursor() as cursor:
         sql = f"""
             SELECT cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated
             from course_record cr
-            where {where};
+            where (cr.course_id, cr.user_id) in ({keys_in})
+            and (cr.state != 'COMPLETED' or cr.state is null);
         """
-        cursor.execute(sql)
-        return [CourseRecord(row[0], row[1], row[2], row[3], row[4]) for row in cursor.fetchall()]
+        with metrics.db_call("get_incomplete_course_records_tuple_in"):
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        return [CourseRecord(row[0], row[1], row[2], row[3], row[4]) for row in rows]
+
+
+def _lookup_with_tuple_in(user_id_course_ids: Set[tuple[str]]):
+    keys = list(user_id_course_ids)
+    total_records = []
+    get_batcher("lookup_tuple_in", batch_size, **adaptive_batching).run(
+        keys, lambda batch: total_records.extend(get_incomplete_course_records_with_ids(set(batch))))
+    return total_records
+
+
+def _lookup_with_temp_table(user_id_course_ids: Set[tuple[str]]):
+    # Temporary tables are per session, so every statement here must run on the same connection.
+    # The key table copies its column definitions from course_record so the join can use the index.
+    keys = list(user_id_course_ids)
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS course_record_lookup_keys;")
+        cursor.execute("""
+            CREATE TEMPORARY TABLE course_record_lookup_keys (PRIMARY KEY (course_id, user_id))
+            SELECT cr.course_id, cr.user_id FROM course_record cr LIMIT 0;
+        """)
+        # A failed insert can't be retried on this session, so the batcher only sizes the inserts
+        batcher = get_batcher("load_course_record_lookup_keys", batch_size, **adaptive_batching)
+        for batch in batcher.batches(keys):
+            with batcher.timed(len(batch)), metrics.db_call("load_course_record_lookup_keys"):
+                cursor.executemany("INSERT IGNORE INTO course_record_lookup_keys (course_id, user_id) VALUES (%s, %s)",
+                                   batch)
+        logger.info(f"Loaded {len(keys)} keys into course_record_lookup_keys")
+        with metrics.db_call("get_incomplete_course_records_temp_table"):
+            cursor.execute("""
+                SELECT cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated
+                from course_record_lookup_keys k
+                JOIN course_record cr ON cr.course_id = k.course_id AND cr.user_id = k.user_id
+                where cr.state != 'COMPLETED' or cr.state is null;
+            """)
+            rows = cursor.fetchall()
+        records = [CourseRecord(row[0], row[1], row[2], row[3], row[4]) for row in rows]
+        cursor.execute("DROP TEMPORARY TABLE course_record_lookup_keys;")
+    return records
+
+
+def _lookup_with_or_chain(user_id_course_ids: Set[tuple[str]]):
+    # The original lookup strategy, kept for benchmarking against the tuple-IN and temp table strategies
+    keys = list(user_id_course_ids)
+    total_records = []
+    for _i in range(0, len(keys), batch_size):
+        batch = keys[_i:_i + batch_size]
+        where = " OR ".join("(cr.course_id = %s and cr.user_id = %s)" for _ in batch)
+        with mysql_connection() as conn, conn.cursor() as cursor:
+            sql = f"""
+                SELECT cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated
+                from course_record cr
+                where ({where})
+                and (cr.state != 'COMPLETED' or cr.state is null);
+            """
+            with metrics.db_call("get_incomplete_course_records_or_chain"):
+                cursor.execute(sql, [_id for key in batch for _id in key])
+                rows = cursor.fetchall()
+            total_records.extend(CourseRecord(row[0], row[1], row[2], row[3], row[4]) for row in rows)
+    return total_records
+
+
+course_record_lookup_strategies = {
+    "temp_table": _lookup_with_temp_table,
+    "tuple_in": _lookup_with_tuple_in,
+    "or_chain": _lookup_with_or_chain,
+}
@@ -0,0 +1,123 @@
+import io
+import random
+import string
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from batching import chunks
+from bulk_writer import get_bulk_writer, to_tsv_field
+from config import mysql_connection, pg_connection
+from course_completions import CourseCompletion
+from integration_test_script import TestCourseRecord, ModuleRecord, gen_course_id, generate_course_completion, \
+    teardown_course_records, teardown_learner_records, teardown_course_completions
+from log import get_logger
+from metrics import metrics
+
+logger = get_logger('load_generator')
+
+STATES = [None, 'ARCHIVED', 'IN_PROGRESS', 'COMPLETED']
+STATE_WEIGHTS = [40, 15, 25, 20]
+PREFERENCES = [None, 'LIKED', 'DISLIKED']
+PREFERENCE_WEIGHTS = [50, 35, 15]
+START = datetime(2020, 1, 1)
+SPAN_SECONDS = 5 * 365 * 24 * 3600
+
+
+def gen_synthetic_user_id(user: int):
+    return f"MIGRATION_USER_{user:010d}"
+
+
+def gen_synthetic_module_id(rng: random.Random):
+    return ''.join(rng.choices(string.ascii_letters + string.digits, k=10))
+
+
+def generate_synthetic_records(start: int, end: int, courses_per_user: int, rng: random.Random):
+    # Records start to end of a dataset where record i is course i % courses_per_user of user i // courses_per_user,
+    # so every (course_id, user_id) pair is unique and a dataset can be generated in independent chunks. Every value
+    # comes from rng, so the same seed always generates the same dataset.
+    course_records: List[TestCourseRecord] = []
+    completions: List[CourseCompletion] = []
+    for i in range(start, end):
+        state = rng.choices(STATES, STATE_WEIGHTS)[0]
+        preference = rng.choices(PREFERENCES, PREFERENCE_WEIGHTS)[0]
+        last_updated = START + timedelta(seconds=rng.randrange(SPAN_SECONDS))
+        course_id = gen_course_id(str(i % courses_per_user))
+        user_id = gen_synthetic_user_id(i // courses_per_user)
+        module_records = [ModuleRecord(gen_synthetic_module_id(rng),
+                                       last_updated - timedelta(days=rng.randrange(1, 365)), course_id, user_id)
+                          for _ in range(rng.randrange(4))]
+        course_record = TestCourseRecord(course_id, user_id, state, preference, last_updated, module_records)
+        course_records.append(course_record)
+        if state == 'COMPLETED':
+            completions.append(generate_course_completion(course_record, last_updated))
+            # Some courses are completed more than once
+            if rng.random() < 0.1:
+                completions.append(generate_course_completion(course_record, last_updated + timedelta(days=30)))
+    return course_records, completions
+
+
+def copy_course_completions(completions: List[Tuple]):
+    buffer = io.StringIO()
+    for row in completions:
+        buffer.write("\t".join(to_tsv_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    with pg_connection() as conn, metrics.db_call("copy_course_completion_events"):
+        with conn.cursor() as cursor:
+            cursor.copy_expert("""
+                COPY course_completion_events (external_id, user_id, course_id, course_title, event_timestamp,
+                                               organisation_id, profession_id)
+                FROM STDIN
+            """, buffer)
+        conn.commit()
+
+
+def load_synthetic_data(records: int, courses_per_user: int = 20, seed: int = 0, chunk_size: int = 100000):
+    # Generates and bulk loads course records and module records into MySQL and course completions into Postgres,
+    # chunk_size records at a time so that memory doesn't grow with the size of the dataset
+    writer = get_bulk_writer()
+    completions_loaded = 0
+    for start in range(0, records, chunk_size):
+        end = min(start + chunk_size, records)
+        course_records, completions = generate_synthetic_records(start, end, courses_per_user,
+                                                                 random.Random(f"{seed}-{start}"))
+        with metrics.batch("load.course_record", len(course_records)):
+            writer.write("course_record", ["course_id", "user_id", "state", "preference", "last_updated",
+                                           "course_title"],
+                         [(cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated,
+                           f"TEST_COURSE_{cr.course_id}") for cr in course_records])
+        module_records = [mr for cr in course_records for mr in cr.module_records]
+        with metrics.batch("load.module_record", len(module_records)):
+            writer.write("module_record", ["module_id", "created_at", "course_id", "user_id"],
+                         [(mr.module_id, mr.created_at, mr.course_id, mr.user_id) for mr in module_records])
+        with metrics.batch("load.course_completion_events", len(completions)):
+            for batch_number, batch in enumerate(chunks(completions, writer.batch_size * 10)):
+                copy_course_completions([(f"MIGRATE_{start}_{batch_number}_{i}", c.user_id, c.course_id,
+                                          f"TEST_COURSE_{c.course_id}", c.event_timestamp, 1, 1)
+                                         for i, c in enumerate(batch)])
+        completions_loaded += len(completions)
+        metrics.add_rows("load", len(course_records) + len(module_records) + len(completions))
+        logger.info(f"Loaded {end} of {records} course records, {completions_loaded} course completions")
+
+
+def teardown_module_records():
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM module_record WHERE course_id like 'MIGRATION_COURSE_%'")
+        conn.commit()
+
+
+def teardown_synthetic_data():
+    logger.info("Removing synthetic data")
+    with mysql_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                DELETE lre FROM learner_record_events lre
+                JOIN learner_records lr ON lr.id = lre.learner_record_id
+                WHERE lr.resource_id like 'MIGRATION_COURSE_%'
+            """)
+        conn.commit()
+    teardown_learner_records()
+    teardown_module_records()
+    teardown_course_records()
+    teardown_course_completions()
@@ -0,0 +1,163 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+# Upper bounds (seconds) of the DB round-trip latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 6),
+            "mean_seconds": round(self.total / self.count, 6) if self.count else 0.0,
+            "max_seconds": round(self.max, 6),
+            "buckets": {_format_bound(bound): count for bound, count in zip(LATENCY_BUCKETS, self.counts)},
+        }
+
+
+class PhaseStats:
+    def __init__(self):
+        self.seconds = 0.0
+        self.rows = 0
+        self.batches = Histogram()
+
+    def as_dict(self):
+        return {
+            "seconds": round(self.seconds, 6),
+            "rows": self.rows,
+            "rows_per_second": round(self.rows / self.seconds, 2) if self.seconds else 0.0,
+            "batches": self.batches.as_dict(),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.db_calls = {}
+
+    def _phase(self, name: str) -> PhaseStats:
+        if name not in self.phases:
+            self.phases[name] = PhaseStats()
+        return self.phases[name]
+
+    # Times a whole phase. Rows processed in the phase are added with add_rows.
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._phase(name).seconds += elapsed
+
+    # Times one batch of a phase and counts its rows towards the phase's rows/sec
+    @contextmanager
+    def batch(self, name: str, rows: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._phase(name)
+                stats.batches.observe(elapsed)
+                stats.rows += rows
+
+    def add_rows(self, name: str, rows: int):
+        with self._lock:
+            self._phase(name).rows += rows
+
+    # Times a single DB round-trip
+    @contextmanager
+    def db_call(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                if name not in self.db_calls:
+                    self.db_calls[name] = Histogram()
+                self.db_calls[name].observe(elapsed)
+
+    def report(self, extra: Optional[dict] = None):
+        with self._lock:
+            report = {
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "wall_seconds": round(time.perf_counter() - self.started, 6),
+                "peak_rss_bytes": get_peak_rss_bytes(),
+                "phases": {name: stats.as_dict() for name, stats in self.phases.items()},
+                "db_calls": {name: histogram.as_dict() for name, histogram in self.db_calls.items()},
+            }
+        report.update(extra or {})
+        return report
+
+    def write_json(self, path: str, extra: Optional[dict] = None):
+        with open(path, 'w') as f:
+            json.dump(self.report(extra), f, indent=2)
+
+    # Prometheus node_exporter textfile collector format
+    def write_prometheus(self, path: str):
+        report = self.report()
+        lines = [
+            "# TYPE migration_wall_seconds gauge",
+            f"migration_wall_seconds {report['wall_seconds']}",
+            "# TYPE migration_peak_rss_bytes gauge",
+            f"migration_peak_rss_bytes {report['peak_rss_bytes']}",
+            "# TYPE migration_phase_seconds gauge",
+            *[f'migration_phase_seconds{{phase="{name}"}} {stats["seconds"]}'
+              for name, stats in report["phases"].items()],
+            "# TYPE migration_phase_rows gauge",
+            *[f'migration_phase_rows{{phase="{name}"}} {stats["rows"]}' for name, stats in report["phases"].items()],
+            "# TYPE migration_db_call_seconds histogram",
+        ]
+        with self._lock:
+            db_calls = list(self.db_calls.items())
+        for name, histogram in db_calls:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'migration_db_call_seconds_bucket{{call="{name}",le="{_format_bound(bound)}"}} '
+                             f'{cumulative}')
+            lines.append(f'migration_db_call_seconds_sum{{call="{name}"}} {histogram.total}')
+            lines.append(f'migration_db_call_seconds_count{{call="{name}"}} {histogram.count}')
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def _format_bound(bound: float):
+    return "+Inf" if bound == float('inf') else str(bound)
+
+
+def get_peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+metrics = Metrics()
@@ -1,7 +1,11 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
 
 class CourseRecordBase:
+    # Millions of these are held at once, so every record class declares __slots__ to avoid a per-instance __dict__
+    __slots__ = ('course_id', 'user_id')
+
     def __init__(self, course_id: str, user_id: str):
         self.course_id = course_id
         self.user_id = user_id
@@ -10,5 +14,133 @@ class CourseRecordBase:
         return f"{self.course_id},{self.user_id}"
 
 
-def course_records_to_map(records: List[CourseRecordBase]):
+class LearnerRecord(CourseRecordBase):
+    __slots__ = ('lr_id', 'created_timestamp')
+
+    def __init__(self, course_id, user_id, lr_id: int, created_timestamp: datetime):
+        super().__init__(course_id, user_id)
+        self.lr_id = lr_id
+        self.created_timestamp = created_timestamp
+
+
+class LearnerRecordEvent:
+    __slots__ = ('learner_record_id', 'event_id', 'event_timestamp')
+
+    def __init__(self, learner_record_id, event_id: int, event_timestamp: datetime):
+        self.learner_record_id = learner_record_id
+        self.event_id = event_id
+        self.event_timestamp = event_timestamp
+
+
+class LearnerRecordWithEvents(LearnerRecord):
+    __slots__ = ('events', 'has_completions')
+
+    def __init__(self, course_id, user_id, lr_id: int, created_timestamp: datetime,
+                 events: List[LearnerRecordEvent] = None, has_completions: bool = False):
+        super().__init__(course_id, user_id, lr_id, created_timestamp)
+        if events is None:
+            events = []
+        self.events = events
+        self.has_completions = has_completions
+
+    def sort_events(self):
+        self.events.sort(key=lambda x: x.event_timestamp)
+
+
+class BasicCourseRecord(CourseRecordBase):
+    __slots__ = ('created_at',)
+
+    def __init__(self, course_id, user_id, created_at: datetime):
+        super().__init__(course_id, user_id)
+        self.created_at = created_at
+
+
+class CourseRecord(BasicCourseRecord):
+    __slots__ = ('state', 'preference', 'last_updated')
+
+    def __init__(self, course_id, user_id, state: Optional[str], preference: Optional[str], last_updated: datetime):
+        super().__init__(course_id, user_id, last_updated)
+        self.state = state
+        self.preference = preference
+        self.last_updated = last_updated
+
+
+class CombinedRecord(CourseRecordBase):
+    __slots__ = ('learner_record_with_events', 'course_record')
+
+    def __init__(self, course_id: str, user_id: str, learner_record_with_events: LearnerRecordWithEvents,
+                 course_record: CourseRecord):
+        super().__init__(course_id, user_id)
+        self.learner_record_with_events = learner_record_with_events
+        self.course_record = course_record
+
+
+class CourseCompletion(CourseRecordBase):
+    __slots__ = ('event_timestamp',)
+
+    def __init__(self, course_id, user_id, event_timestamp):
+        super().__init__(course_id, user_id)
+        self.event_timestamp = event_timestamp
+
+
+# Event ids of learner_record_events
+
+MOVE_TO_LEARNING_PLAN = 1
+REMOVE_FROM_LEARNING_PLAN = 2
+REMOVE_FROM_SUGGESTIONS = 3
+COMPLETE_COURSE = 4
+
+
+class KeyIndex:
+    # Interns course ids and user ids as dense ints so that a (course_id, user_id) key is a single packed int,
+    # which is cheaper to build and hash than a formatted string and can't be confused by commas in ids
+    __slots__ = ('course_ids', 'user_ids')
+
+    def __init__(self):
+        self.course_ids = {}
+        self.user_ids = {}
+
+    def key(self, course_id: str, user_id: str) -> int:
+        course = self.course_ids.get(course_id)
+        if course is None:
+            course = self.course_ids[course_id] = len(self.course_ids)
+        user = self.user_ids.get(user_id)
+        if user is None:
+            user = self.user_ids[user_id] = len(self.user_ids)
+        return (course << 32) | user
+
+    # Doesn't intern unseen ids, so probing with records that can't match doesn't grow the index
+    def lookup(self, course_id: str, user_id: str) -> Optional[int]:
+        course = self.course_ids.get(course_id)
+        if course is None:
+            return None
+        user = self.user_ids.get(user_id)
+        if user is None:
+            return None
+        return (course << 32) | user
+
+    # key_of and lookup_of are called once per record in the join loops, so they repeat the bodies of key and
+    # lookup rather than paying for a second method call
+    def key_of(self, record: CourseRecordBase) -> int:
+        course = self.course_ids.get(record.course_id)
+        if course is None:
+            course = self.course_ids[record.course_id] = len(self.course_ids)
+        user = self.user_ids.get(record.user_id)
+        if user is None:
+            user = self.user_ids[record.user_id] = len(self.user_ids)
+        return (course << 32) | user
+
+    def lookup_of(self, record: CourseRecordBase) -> Optional[int]:
+        course = self.course_ids.get(record.course_id)
+        if course is None:
+            return None
+        user = self.user_ids.get(record.user_id)
+        if user is None:
+            return None
+        return (course << 32) | user
+
+
+def course_records_to_map(records: List[CourseRecordBase], key_index: Optional[KeyIndex] = None):
+    if key_index:
+        return {key_index.key_of(r): r for r in records}
     return {r.get_id(): r for r in records}
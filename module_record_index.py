@@ -0,0 +1,120 @@
+import argparse
+from datetime import datetime, timedelta
+from config import mysql_connection, close_pools, module_record_index_overlap_seconds
+from log import get_logger
+from metrics import metrics
+
+logger = get_logger('module_record_index')
+
+# The earliest module record created_at of each (course_id, user_id), which is what a learner record's
+# created_timestamp is derived from, so the learner_records phase can look it up by key instead of aggregating
+# module_record on every batch and every rerun. The module_record created_at it is up to date with is kept in the
+# table comment, so the index and its watermark are always swapped in together.
+MODULE_RECORD_INDEX_TABLE = "module_record_first_created"
+
+
+def get_module_record_index_watermark():
+    # None if the index doesn't exist
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT TABLE_COMMENT FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, (MODULE_RECORD_INDEX_TABLE,))
+        row = cursor.fetchone()
+    if row is None or not row[0]:
+        return None
+    return datetime.fromisoformat(row[0])
+
+
+def _get_module_record_watermark():
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT MAX(created_at) FROM module_record")
+        return cursor.fetchone()[0] or datetime.min
+
+
+def rebuild_module_record_index():
+    # Builds the index into a new table and swaps it in, so lookups never see a partial index
+    watermark = _get_module_record_watermark()
+    # Read before the connection below is checked out, as a nested checkout could wait forever on a pool of one
+    exists = get_module_record_index_watermark() is not None
+    logger.info(f"Building {MODULE_RECORD_INDEX_TABLE} from module records created up to {watermark}")
+    new_table = f"{MODULE_RECORD_INDEX_TABLE}_new"
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {new_table}")
+        with metrics.db_call("build_module_record_index"):
+            cursor.execute(f"""
+                CREATE TABLE {new_table} (PRIMARY KEY (course_id, user_id)) COMMENT = '{watermark.isoformat()}'
+                SELECT course_id, user_id, MIN(created_at) AS first_created_at
+                FROM module_record
+                WHERE created_at <= %s AND course_id IS NOT NULL AND user_id IS NOT NULL
+                GROUP BY course_id, user_id
+            """, (watermark,))
+        if not exists:
+            cursor.execute(f"RENAME TABLE {new_table} TO {MODULE_RECORD_INDEX_TABLE}")
+        else:
+            cursor.execute(f"RENAME TABLE {MODULE_RECORD_INDEX_TABLE} TO {MODULE_RECORD_INDEX_TABLE}_old, "
+                           f"{new_table} TO {MODULE_RECORD_INDEX_TABLE}")
+            cursor.execute(f"DROP TABLE {MODULE_RECORD_INDEX_TABLE}_old")
+        cursor.execute(f"SELECT COUNT(*) FROM {MODULE_RECORD_INDEX_TABLE}")
+        logger.info(f"Built {MODULE_RECORD_INDEX_TABLE} with {cursor.fetchone()[0]} keys")
+
+
+def refresh_module_record_index(overlap_seconds: float = module_record_index_overlap_seconds):
+    # Merges in the module records created since the index was last built or refreshed. Module records are only ever
+    # inserted by the learner record service; if they are deleted or their created_at changes, rebuild the index.
+    # A module record can commit after one with a later created_at, i.e. after a refresh whose watermark is already past
+    # it, so every refresh rescans the overlap_seconds before the previous watermark too. Merging a module record again
+    # is a no-op, as the upsert keeps the earliest created_at.
+    previous = get_module_record_index_watermark()
+    if previous is None:
+        logger.info(f"{MODULE_RECORD_INDEX_TABLE} doesn't exist yet")
+        rebuild_module_record_index()
+        return
+    watermark = max(_get_module_record_watermark(), previous)
+    overlap = timedelta(seconds=overlap_seconds)
+    since = max(previous, datetime.min + overlap) - overlap
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        with metrics.db_call("refresh_module_record_index"):
+            cursor.execute(f"""
+                INSERT INTO {MODULE_RECORD_INDEX_TABLE} (course_id, user_id, first_created_at)
+                SELECT course_id, user_id, MIN(created_at)
+                FROM module_record
+                WHERE created_at > %s AND created_at <= %s AND course_id IS NOT NULL AND user_id IS NOT NULL
+                GROUP BY course_id, user_id
+                ON DUPLICATE KEY UPDATE first_created_at =
+                    LEAST(COALESCE(first_created_at, VALUES(first_created_at)), VALUES(first_created_at))
+            """, (since, watermark))
+            rows = cursor.rowcount
+        conn.commit()
+        if watermark > previous:
+            cursor.execute(f"ALTER TABLE {MODULE_RECORD_INDEX_TABLE} COMMENT = '{watermark.isoformat()}'")
+    logger.info(f"Refreshed {MODULE_RECORD_INDEX_TABLE} with module records created from {since} to {watermark} "
+                f"({rows} rows affected)")
+
+
+def drop_module_record_index():
+    with mysql_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {MODULE_RECORD_INDEX_TABLE}")
+    logger.info(f"Dropped {MODULE_RECORD_INDEX_TABLE}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Manage the index of the earliest module record of each course "
+                                                 "record, used by the learner_records phase with MODULE_RECORD_INDEX")
+    parser.add_argument("action", choices=["rebuild", "refresh", "drop"],
+                        help="rebuild the index from scratch, merge in module records created since it was last "
+                             "built or refreshed (building it if it doesn't exist), or drop it")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    try:
+        if args.action == "rebuild":
+            rebuild_module_record_index()
+        elif args.action == "refresh":
+            refresh_module_record_index()
+        else:
+            drop_module_record_index()
+    finally:
+        close_pools()
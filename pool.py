@@ -0,0 +1,110 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from mysql.connector.pooling import MySQLConnectionPool
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.open_connections = 0
+
+    def as_dict(self):
+        return {
+            "checkouts": self.checkouts,
+            "wait_seconds": round(self.wait_seconds, 6),
+            "max_wait_seconds": round(self.max_wait_seconds, 6),
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+            "open_connections": self.open_connections,
+        }
+
+
+# Callers block until a connection is free rather than getting a pool exhausted error,
+# and the time spent waiting is recorded in the pool metrics
+class ConnectionPool:
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.metrics = PoolMetrics()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        self._slots.acquire()
+        try:
+            conn = self._get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.metrics.checkouts += 1
+            self.metrics.wait_seconds += waited
+            self.metrics.max_wait_seconds = max(self.metrics.max_wait_seconds, waited)
+            self.metrics.in_use += 1
+            self.metrics.peak_in_use = max(self.metrics.peak_in_use, self.metrics.in_use)
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self.metrics.in_use -= 1
+            self._put_connection(conn)
+            self._slots.release()
+
+    def close(self):
+        self._close_connections()
+        self.metrics.open_connections = 0
+
+    def _get_connection(self):
+        raise NotImplementedError
+
+    def _put_connection(self, conn):
+        raise NotImplementedError
+
+    def _close_connections(self):
+        raise NotImplementedError
+
+
+class MySQLPool(ConnectionPool):
+    def __init__(self, name: str, size: int, **connection_args):
+        super().__init__(name, size)
+        # Opens all connections up front; returned connections have their session reset
+        self._pool = MySQLConnectionPool(pool_name=name, pool_size=size, pool_reset_session=True, **connection_args)
+        self.metrics.open_connections = size
+
+    def _get_connection(self):
+        return self._pool.get_connection()
+
+    def _put_connection(self, conn):
+        # Closing a pooled connection hands it back to the pool
+        conn.close()
+
+    def _close_connections(self):
+        self._pool._remove_connections()
+
+
+class PostgresPool(ConnectionPool):
+    def __init__(self, name: str, size: int, **connection_args):
+        super().__init__(name, size)
+        # minconn == maxconn so that returned connections are kept open instead of being closed and reopened
+        self._pool = ThreadedConnectionPool(size, size, **connection_args)
+        self.metrics.open_connections = size
+
+    def _get_connection(self):
+        return self._pool.getconn()
+
+    def _put_connection(self, conn):
+        # psycopg2 rolls back any transaction left open before the connection is reused
+        self._pool.putconn(conn)
+
+    def _close_connections(self):
+        self._pool.closeall()
@@ -0,0 +1,95 @@
+import heapq
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from course_completions import get_course_completion_counts
+from learner_record import get_missing_learner_record_counts_by_user, count_non_completed_course_records, \
+    get_non_completion_event_types_ordered_pages, COMPLETE_COURSE, MOVE_TO_LEARNING_PLAN, REMOVE_FROM_LEARNING_PLAN, \
+    REMOVE_FROM_SUGGESTIONS
+from log import get_logger
+from metrics import metrics
+from sharding import Shard
+
+logger = get_logger('report')
+
+EVENT_TYPE_NAMES = {
+    MOVE_TO_LEARNING_PLAN: "MOVE_TO_LEARNING_PLAN",
+    REMOVE_FROM_LEARNING_PLAN: "REMOVE_FROM_LEARNING_PLAN",
+    REMOVE_FROM_SUGGESTIONS: "REMOVE_FROM_SUGGESTIONS",
+    COMPLETE_COURSE: "COMPLETE_COURSE",
+}
+
+
+def count_missing_learner_records(user_counts: Iterable[Tuple[str, int]], top_users: int = 10):
+    total = 0
+    users = 0
+    top = []
+    for user_id, count in user_counts:
+        total += count
+        users += 1
+        if len(top) < top_users:
+            heapq.heappush(top, (count, user_id))
+        elif count > top[0][0]:
+            heapq.heapreplace(top, (count, user_id))
+    return {
+        "missing_learner_records": total,
+        "users_with_missing_learner_records": users,
+        "top_users": [{"user_id": user_id, "missing_learner_records": count}
+                      for count, user_id in sorted(top, reverse=True)],
+    }
+
+
+def count_events(event_type_pages: Iterable[List[tuple]], completion_counts: Iterable[tuple]):
+    # Merge joins (course_id, user_id, non-completion event type) rows with (course_id, user_id, completion count)
+    # rows, both in (course_id, user_id) order, counting the events the event migration would create without building
+    # them: completions for learner records that have them, otherwise the non-completion event, if any
+    events = Counter()
+    learner_records = 0
+    orphaned = 0
+    completions = iter(completion_counts)
+    pending = next(completions, None)
+    last_key = None
+    for page in event_type_pages:
+        for course_id, user_id, event_type in page:
+            key = (course_id, user_id)
+            # The event migration keys learner records by (course_id, user_id), so duplicates only count once
+            if key == last_key:
+                continue
+            last_key = key
+            learner_records += 1
+            while pending is not None and (pending[0], pending[1]) < key:
+                orphaned += pending[2]
+                pending = next(completions, None)
+            if pending is not None and (pending[0], pending[1]) == key:
+                events[COMPLETE_COURSE] += pending[2]
+                pending = next(completions, None)
+            elif event_type is not None:
+                events[event_type] += 1
+    while pending is not None:
+        orphaned += pending[2]
+        pending = next(completions, None)
+    return {
+        "learner_records": learner_records,
+        "events_to_create": sum(events.values()),
+        "completion_events_to_create": events[COMPLETE_COURSE],
+        "events_by_type": {name: events[event_type] for event_type, name in EVENT_TYPE_NAMES.items()},
+        "orphaned_completions": orphaned,
+    }
+
+
+def run_fast_report(data: List[str], shard: Optional[Shard] = None):
+    # Counts what a report run would find with aggregates computed by the databases and streamed into counters,
+    # rather than fetching course records and extracting every event
+    report = {}
+    if "learner_records" in data:
+        with metrics.phase("report.learner_records"):
+            report["learner_records"] = count_missing_learner_records(get_missing_learner_record_counts_by_user(shard))
+            if not shard:
+                report["learner_records"]["non_completed_course_records"] = count_non_completed_course_records()
+        logger.info(f"Learner records report: {report['learner_records']}")
+    if "events" in data:
+        with metrics.phase("report.events"):
+            report["events"] = count_events(get_non_completion_event_types_ordered_pages(shard=shard),
+                                            get_course_completion_counts(shard=shard))
+        logger.info(f"Events report: {report['events']}")
+    return report
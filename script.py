@@ -1,153 +1,324 @@
 import argparse
-from typing import List, Dict
-
-from course_completions import get_course_completions, CourseCompletion
-from learner_record import get_course_records, CourseRecord, LearnerRecord, \
-    LearnerRecordWithEvents, get_all_learner_records, LearnerRecordEvent, COMPLETE_COURSE, \
-    get_incomplete_course_records_with_records, REMOVE_FROM_LEARNING_PLAN, MOVE_TO_LEARNING_PLAN, \
-    REMOVE_FROM_SUGGESTIONS, insert_learner_record_events, insert_learner_records, delete_learner_records, \
-    delete_learner_record_events, get_user_course_record_counts, get_user_learner_record_counts
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, List, Dict, Optional, Tuple
+
+import async_io
+from batching import AdaptiveBatcher, chunks, prefetch, with_retries, pipeline, read_ahead, get_batcher, \
+    get_batch_sizes
+from checkpoint import Checkpoint
+from config import close_pools, get_pool_metrics, batch_retries, workers as default_workers, \
+    course_record_page_size, checkpoint_file, metrics_file, prometheus_file, watermark_file, \
+    missing_record_batch_size, teardown_chunk_size, teardown_throttle_seconds, pipeline_depth, \
+    snapshot_dir, module_record_index, adaptive_batching, mysql_pool_size
+from course_completions import get_course_completion_pages, CourseCompletion
+from engine import transform_course_records_into_learner_records, merge_indexed_course_completions, \
+    find_course_completion_events, find_non_completion_events, collect_events
+from learner_record import CourseRecord, LearnerRecordWithEvents, get_incomplete_course_records_with_records, \
+    insert_learner_record_events, insert_learner_records, delete_learner_records, delete_learner_record_events, \
+    get_learner_records_ordered_pages, get_missing_course_record_keys, get_course_records_for_keys, \
+    get_learner_record_watermarks
 from log import get_logger
+from metrics import metrics
+from models import KeyIndex, course_records_to_map
+from module_record_index import refresh_module_record_index, get_module_record_index_watermark
+from report import run_fast_report
+from sharding import Shard
+from snapshot import Snapshot, get_snapshot
+from watermark import WatermarkStore, parse_watermark
 
 logger = get_logger('script')
 
 
-def transform_course_records_into_learner_records(course_records: List[CourseRecord]):
-    return [LearnerRecord(record.course_id, record.user_id, 0, record.created_at) for record in
-            course_records]
-
-
-def get_missing_user_ids_to_fetch():
-    logger.info("Counting user course records")
-    course_record_counts = get_user_course_record_counts()
-    learner_record_counts = get_user_learner_record_counts()
-    missing_learner_ids = []
-    logger.info("Finding missing records via learner_id")
-    for learner_id, course_record_count in course_record_counts.items():
-        learner_record_count = learner_record_counts.get(learner_id)
-        if not learner_record_count or learner_record_count > course_record_count:
-            missing_learner_ids.append(learner_id)
-
-    logger.info(f"{len(missing_learner_ids)} missing learner ids")
-    return missing_learner_ids
+def fetch_course_records_for_keys_batch(keys: List[Tuple[str, str]], use_index: bool = module_record_index,
+                                        batcher: Optional[AdaptiveBatcher] = None):
+    batcher = batcher or get_batcher("missing_course_records", missing_record_batch_size)
+    with batcher.timed(len(keys)):
+        return with_retries(get_course_records_for_keys, keys, use_index, attempts=batch_retries,
+                            description=f"Fetching course records for {len(keys)} keys")
+
+
+def insert_missing_course_records(execute=False, workers: int = default_workers,
+                                  checkpoint: Optional[Checkpoint] = None,
+                                  changed_since: Optional[Tuple[datetime, datetime]] = None,
+                                  shard: Optional[Shard] = None, use_index: bool = module_record_index):
+    # Only the (course_id, user_id) pairs without a learner record are read and inserted. Pairs are diffed in MySQL,
+    # so a resumed run doesn't see the pairs that earlier batches already inserted.
+    # Incremental runs pass the (course_record.last_updated, module_record.created_at) watermarks of the previous run.
+    # The number of keys per batch adapts to the latency of their course record lookups.
+    progress = checkpoint.get("learner_records") if checkpoint else {}
+    batches_committed = progress.get("batches_committed", 0)
+    total_learner_records = 0
+    batcher = get_batcher("missing_course_records", missing_record_batch_size, **adaptive_batching)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='course-records') as executor:
+        missing_keys = get_missing_course_record_keys(changed_since=changed_since, shard=shard, batcher=batcher)
+        batches = prefetch(executor, lambda keys: fetch_course_records_for_keys_batch(keys, use_index, batcher),
+                           missing_keys, workers)
+        for batch_number, result in enumerate(batches, 1):
+            learner_records = transform_course_records_into_learner_records(result)
+            total_learner_records += len(learner_records)
+            metrics.add_rows("learner_records", len(learner_records))
+            logger.info(f"Batch {batch_number}: {len(learner_records)} missing learner records")
+            if execute:
+                with metrics.batch("learner_records.insert", len(learner_records)):
+                    with_retries(insert_learner_records, learner_records, attempts=batch_retries,
+                                 description=f"Inserting batch {batch_number}")
+                batches_committed += 1
+                if checkpoint:
+                    checkpoint.update("learner_records", batches_committed=batches_committed)
+            else:
+                logger.info("execute flag not passed. Not inserting")
+    logger.info(f"{total_learner_records} missing learner records found")
 
 
-def insert_course_records_for_missing_users(missing_learner_ids: List[str], execute=False):
-    for _i in range(0, len(missing_learner_ids), 2000):
-        batch = missing_learner_ids[_i:_i + 2000]
-        result = get_course_records(batch)
-        learner_records = transform_course_records_into_learner_records(result)
+# lookup fetches the incomplete course records of learner records, from the database unless reading a snapshot
+def apply_non_completion_events(learner_records: Dict[str, LearnerRecordWithEvents],
+                                key_index: Optional[KeyIndex] = None,
+                                lookup: Callable[[List[LearnerRecordWithEvents]], List[CourseRecord]] =
+                                get_incomplete_course_records_with_records):
+    non_completion_records = [lr for lr in learner_records.values() if not lr.has_completions]
+    incomplete_records = lookup(non_completion_records)
+    return find_non_completion_events(learner_records, incomplete_records, key_index)
+
+
+def join_page_completions(_map: Dict[str, LearnerRecordWithEvents], page_completions: List[CourseCompletion],
+                          key_index: Optional[KeyIndex] = None):
+    with metrics.batch("events.completion_join", len(page_completions)):
+        return find_course_completion_events(_map, page_completions, key_index)
+
+
+def classify_page(_map: Dict[str, LearnerRecordWithEvents], key_index: Optional[KeyIndex] = None,
+                  lookup: Callable = get_incomplete_course_records_with_records):
+    with metrics.batch("events.non_completion", len(_map)):
+        _map = apply_non_completion_events(_map, key_index, lookup)
+        return _map, collect_events(_map)
+
+
+def extract_page_events(_map: Dict[str, LearnerRecordWithEvents], page_completions: List[CourseCompletion],
+                        key_index: Optional[KeyIndex] = None):
+    _map = join_page_completions(_map, page_completions, key_index)
+    return classify_page(_map, key_index)[1]
+
+
+def run_events(execute: bool, checkpoint: Optional[Checkpoint] = None, shard: Optional[Shard] = None,
+               snapshot: Optional[Snapshot] = None):
+    # The checkpoint records the last key of the last fully inserted page. On resume both streams restart after that
+    # key, and the events of the partially inserted page that were already committed are skipped by the insert.
+    progress = checkpoint.get("events") if checkpoint else {}
+    after_key = tuple(progress["last_key"]) if progress.get("last_key") else None
+    page_size = progress.get("page_size", course_record_page_size)
+    pages_committed = progress.get("pages_committed", 0)
+    if checkpoint:
+        checkpoint.update("events", page_size=page_size)
+    if after_key:
+        logger.info(f"Resuming after {after_key} ({pages_committed} pages already committed)")
+
+    # Reading and merging, the completion join, the non-completion lookup and classification, and the insert each
+    # run in their own thread on consecutive pages, with at most pipeline_depth pages queued between them.
+    # Each page is keyed by a KeyIndex of its own, which is dropped once the page has been classified.
+    total_learner_records = 0
+    total_events = 0
+    if snapshot:
+        pages = merge_indexed_course_completions(snapshot.learner_record_pages(page_size),
+                                                 snapshot.course_completions())
+        lookup = snapshot.get_incomplete_course_records
+    else:
+        # The completions are read ahead in their own thread, so the Postgres round-trips overlap with the MySQL ones
+        # of the learner record pages being merged with them
+        completions = read_ahead(get_course_completion_pages(after_key=after_key, shard=shard), pipeline_depth,
+                                 name='course-completions')
+        pages = merge_indexed_course_completions(get_learner_records_ordered_pages(page_size, after_key, shard),
+                                                 completions)
+        lookup = get_incomplete_course_records_with_records
+    stages = [
+        lambda page: (join_page_completions(*page), page[2]),
+        lambda joined: classify_page(*joined, lookup=lookup),
+    ]
+    for _map, events in pipeline(pages, stages, pipeline_depth, name='events'):
+        total_learner_records += len(_map)
+        metrics.add_rows("events", len(_map))
+        total_events += len(events)
+        logger.info(f"{len(events)} events ready to be inserted for page of {len(_map)} learner records")
         if execute:
-            logger.info(f"Inserting {len(learner_records)} learner records")
-            insert_learner_records(learner_records)
+            with metrics.batch("events.insert", len(events)):
+                insert_learner_record_events(events)
+            pages_committed += 1
+            if checkpoint:
+                last_lr = next(reversed(_map.values()))
+                checkpoint.update("events", last_key=[last_lr.course_id, last_lr.user_id],
+                                  pages_committed=pages_committed)
         else:
             logger.info("execute flag not passed. Not inserting")
 
-
-def fetch_all_lr_map():
-    learner_records = get_all_learner_records()
-    logger.info(f"Fetched {len(learner_records)} learner records")
-    return {lr.get_id(): lr for lr in learner_records}
-
-
-def transform_course_record_into_event_id(lr: LearnerRecord, course_record: CourseRecord):
-    if course_record.state == 'ARCHIVED':
-        if lr.created_timestamp != course_record.created_at:
-            return REMOVE_FROM_LEARNING_PLAN
-    elif course_record.state is None:
-        if course_record.preference == 'LIKED':
-            return MOVE_TO_LEARNING_PLAN
-        elif course_record.preference == 'DISLIKED':
-            return REMOVE_FROM_SUGGESTIONS
-    return None
-
-
-def apply_course_completion_events(learner_records: Dict[str, LearnerRecordWithEvents]):
-    course_completions = get_course_completions()
-    return find_course_completion_events(learner_records, course_completions)
-
-
-def find_course_completion_events(learner_records: Dict[str, LearnerRecordWithEvents],
-                                  course_completions: List[CourseCompletion]):
-    logger.info(f"Processing {len(course_completions)} course completion events")
-    completions_processed = 0
-    for completion in course_completions:
-        course_record_id = completion.get_id()
-        lr = learner_records.get(course_record_id)
-        if lr:
-            lre = LearnerRecordEvent(lr.lr_id, COMPLETE_COURSE, completion.event_timestamp)
-            lr.events.append(lre)
-            lr.has_completions = True
-            learner_records[course_record_id] = lr
-            completions_processed += 1
+    if total_learner_records:
+        logger.info(f"{total_events} events extracted from {total_learner_records} learner records")
+    else:
+        logger.warning("0 learner records found. Not inserting any events")
+
+
+async def get_events_watermarks_async():
+    # The MySQL and Postgres watermarks are read concurrently
+    learner_record_watermarks, completion_watermark = await asyncio.gather(
+        async_io.get_learner_record_watermarks(), async_io.get_course_completion_watermark())
+    return {
+        "course_completion_event_timestamp": completion_watermark,
+        "course_record_last_updated": learner_record_watermarks["course_record_last_updated"],
+        "learner_record_id": learner_record_watermarks["learner_record_id"],
+    }
+
+
+def get_events_watermarks():
+    return asyncio.run(get_events_watermarks_async())
+
+
+def get_learner_records_watermarks():
+    learner_record_watermarks = get_learner_record_watermarks()
+    return {
+        "course_record_last_updated": learner_record_watermarks["course_record_last_updated"],
+        "module_record_created_at": learner_record_watermarks["module_record_created_at"],
+        "learner_record_id": learner_record_watermarks["learner_record_id"],
+    }
+
+
+async def run_incremental_events_async(execute: bool, previous: dict, current: dict, shard: Optional[Shard] = None,
+                                       workers: int = default_workers):
+    # Only learner records with a course completion event, a course record update or a learner record created between
+    # the previous and the current watermarks are processed. Completion events are only created for completions after
+    # the previous watermark, apart from new learner records which get all of their completions.
+    # The changed keys are read from both databases concurrently, and for up to workers batches at a time the learner
+    # records and course completions are fetched concurrently while earlier batches are extracted and inserted.
+    since_completion = previous["course_completion_event_timestamp"] or datetime.min
+    until_completion = current["course_completion_event_timestamp"] or datetime.min
+    since_lr_id = previous["learner_record_id"] or 0
+    completion_keys, course_record_keys, learner_record_keys = await asyncio.gather(
+        async_io.get_course_completion_keys_between(since_completion, until_completion),
+        async_io.get_course_record_keys_updated_between(previous["course_record_last_updated"] or datetime.min,
+                                                        current["course_record_last_updated"] or datetime.min),
+        async_io.get_learner_record_keys_created_between(since_lr_id, current["learner_record_id"] or 0),
+    )
+    keys = completion_keys | course_record_keys | learner_record_keys
+    if shard:
+        keys = {key for key in keys if shard.contains(key[1])}
+    logger.info(f"{len(keys)} learner records changed since {previous}")
+
+    async def fetch_batch(batch: List[Tuple[str, str]]):
+        return await asyncio.gather(async_io.get_learner_records_for_keys(batch),
+                                    async_io.get_course_completions_for_keys(batch, until_completion))
+
+    def extract_batch_events(learner_records: List[LearnerRecordWithEvents], completions: List[CourseCompletion]):
+        # A KeyIndex per batch, so it only holds the ids of one batch
+        key_index = KeyIndex()
+        _map = course_records_to_map(learner_records, key_index)
+        new_learner_records = {key_index.lookup_of(lr) for lr in learner_records if lr.lr_id > since_lr_id}
+        completions = [completion for completion in completions
+                       if completion.event_timestamp > since_completion or
+                       key_index.lookup_of(completion) in new_learner_records]
+        with metrics.batch("events.extract", len(_map)):
+            return extract_page_events(_map, completions, key_index)
+
+    total_learner_records = 0
+    total_events = 0
+    batches = chunks(sorted(keys), missing_record_batch_size)
+    async for learner_records, completions in async_io.map_in_flight(fetch_batch, batches, workers):
+        # Extraction looks up incomplete course records, so it runs on the executor rather than the event loop
+        events = await async_io.run_blocking(extract_batch_events, learner_records, completions)
+        total_learner_records += len(learner_records)
+        metrics.add_rows("events", len(learner_records))
+        total_events += len(events)
+        logger.info(f"{len(events)} events ready to be inserted for {len(learner_records)} changed learner records")
+        if execute:
+            with metrics.batch("events.insert", len(events)):
+                await async_io.insert_learner_record_events(events)
         else:
-            logger.warning(f"Learner record with id {course_record_id} doesn't exist")
-    logger.info(f"Processed {completions_processed} out of {len(course_completions)} course completion events")
-    return learner_records
+            logger.info("execute flag not passed. Not inserting")
+    logger.info(f"{total_events} events extracted from {total_learner_records} changed learner records")
 
 
-def apply_non_completion_events(learner_records: Dict[str, LearnerRecordWithEvents]):
-    non_completion_records = [lr for lr in learner_records.values() if not lr.has_completions]
-    incomplete_records = get_incomplete_course_records_with_records(non_completion_records)
-    return find_non_completion_events(learner_records, incomplete_records)
-
-
-def find_non_completion_events(learner_records: Dict[str, LearnerRecordWithEvents],
-                               incomplete_records: List[CourseRecord]):
-    logger.info(f"Processing other events for {len(incomplete_records)} incomplete course records")
-    events_processed = 0
-    for incomplete_record in incomplete_records:
-        course_record_id = incomplete_record.get_id()
-        lr = learner_records.get(course_record_id)
-        if lr:
-            event_id = transform_course_record_into_event_id(lr, incomplete_record)
-            if event_id:
-                lre = LearnerRecordEvent(lr.lr_id, event_id, incomplete_record.last_updated)
-                lr.events.append(lre)
-                learner_records[course_record_id] = lr
-                events_processed += 1
-        else:
-            logger.warning(f"Learner record with id {course_record_id} doesn't exist")
-    logger.info(f"Processed {events_processed} out of {len(incomplete_records)} incomplete course records")
-    return learner_records
+def run_incremental_events(execute: bool, previous: dict, current: dict, shard: Optional[Shard] = None,
+                           workers: int = default_workers):
+    asyncio.run(run_incremental_events_async(execute, previous, current, shard, workers))
 
 
-def extract_events(_map: Dict[str, LearnerRecordWithEvents]):
-    _map = apply_course_completion_events(_map)
-    _map = apply_non_completion_events(_map)
-    events = []
-    for learner_record in _map.values():
-        learner_record.sort_events()
-        events.extend(learner_record.events)
-    return events
+def get_phase_watermarks(phase: str, capture, checkpoint: Optional[Checkpoint] = None):
+    # The watermarks are captured before the phase reads anything, so rows changed while it runs are picked up by the
+    # next incremental run. A resumed run keeps the watermarks captured by the run it resumes.
+    progress = checkpoint.get(phase) if checkpoint else {}
+    if progress.get("watermarks"):
+        return {name: parse_watermark(value) for name, value in progress["watermarks"].items()}
+    watermarks = capture()
+    if checkpoint:
+        checkpoint.update(phase, watermarks=watermarks)
+    return watermarks
 
 
-def run(data: List[str], execute: bool):
+def run(data: List[str], execute: bool, workers: int = default_workers, checkpoint: Optional[Checkpoint] = None,
+        watermarks: Optional[WatermarkStore] = None, incremental: bool = False, shard: Optional[Shard] = None,
+        snapshot: Optional[Snapshot] = None):
+    # Execute runs save the watermarks of each completed phase to the watermark store. Incremental runs only process
+    # rows that changed since the watermarks of the previous run, falling back to a full run when there are none.
     if "learner_records" in data:
         logger.info("learner_records flag found")
-        missing_learner_ids = get_missing_user_ids_to_fetch()
-        insert_course_records_for_missing_users(missing_learner_ids, execute)
+        if checkpoint and checkpoint.is_complete("learner_records"):
+            logger.info("learner_records already completed according to the checkpoint. Skipping")
+        else:
+            with metrics.phase("learner_records"):
+                current = get_phase_watermarks("learner_records", get_learner_records_watermarks, checkpoint) \
+                    if watermarks else None
+                previous = watermarks.get("learner_records") if watermarks and incremental else None
+                changed_since = None
+                if previous:
+                    changed_since = (previous["course_record_last_updated"] or datetime.min,
+                                     previous["module_record_created_at"] or datetime.min)
+                elif incremental:
+                    logger.info("No previous learner_records watermarks. Running a full diff")
+                # Only execute runs refresh the index. Sharded runs share one, which run_shards refreshes before
+                # starting them. Reports use it read-only if it exists, and the correlated lookup if it doesn't.
+                use_index = module_record_index
+                if module_record_index and execute and not shard:
+                    refresh_module_record_index()
+                elif module_record_index and not execute:
+                    use_index = get_module_record_index_watermark() is not None
+                    if not use_index:
+                        logger.info("The module record index doesn't exist. Reporting without it")
+                insert_missing_course_records(execute, workers, checkpoint, changed_since, shard, use_index)
+            if checkpoint:
+                checkpoint.complete("learner_records")
+            if execute and watermarks:
+                watermarks.save("learner_records", current)
 
     if "events" in data:
         logger.info("events flag found")
-        _map = fetch_all_lr_map()
-        if _map.values():
-            events = extract_events(_map)
-            logger.info(f"{len(events)} events ready to be inserted")
-            if execute:
-                insert_learner_record_events(events)
-            else:
-                logger.info("execute flag not passed. Not inserting")
+        if checkpoint and checkpoint.is_complete("events"):
+            logger.info("events already completed according to the checkpoint. Skipping")
         else:
-            logger.warning("0 learner records found. Not inserting any events")
-
-
-def teardown(data: List[str]):
+            with metrics.phase("events"):
+                current = get_phase_watermarks("events", get_events_watermarks, checkpoint) if watermarks else None
+                previous = watermarks.get("events") if watermarks and incremental else None
+                if previous:
+                    run_incremental_events(execute, previous, current, shard, workers)
+                else:
+                    if incremental:
+                        logger.info("No previous events watermarks. Running a full extraction")
+                    run_events(execute, checkpoint, shard, snapshot)
+            if checkpoint:
+                checkpoint.complete("events")
+            if execute and watermarks:
+                watermarks.save("events", current)
+
+
+def teardown(data: List[str], chunk_size: int = teardown_chunk_size,
+             throttle_seconds: float = teardown_throttle_seconds, migrated_only: bool = False):
+    # With migrated_only only events with the migration's EVENT_SOURCE_ID are deleted. Learner records have no such
+    # marker, and the application can insert them between the migration's own inserts, so they can only be torn down
+    # all together.
     logger.info("Tearing down data")
     if "events" in data:
-        delete_learner_record_events()
+        with metrics.phase("teardown.learner_record_events"):
+            delete_learner_record_events(chunk_size, throttle_seconds, source_only=migrated_only)
     if "learner_records" in data:
-        delete_learner_records()
+        with metrics.phase("teardown.learner_records"):
+            delete_learner_records(chunk_size, throttle_seconds)
 
 
 def get_args():
@@ -168,12 +339,194 @@ def get_args():
         help=f"Specify the action to perform: valid choices are {valid_action_choices}."
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=default_workers,
+        help="Number of worker threads fetching course records ahead of the insert of the current batch"
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume a failed execute run from its checkpoint file, skipping work that was already committed"
+    )
+
+    parser.add_argument(
+        "--checkpoint-file",
+        default=checkpoint_file,
+        help="File that execute runs record their progress in"
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        default=metrics_file,
+        help="File that report and execute runs write their JSON run report (timings, throughput, peak RSS) to"
+    )
+
+    parser.add_argument(
+        "--prometheus-file",
+        default=prometheus_file,
+        help="Optional file to also write the run metrics to in the Prometheus textfile format"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process rows that changed since the watermarks saved by the previous execute run"
+    )
+
+    parser.add_argument(
+        "--watermark-file",
+        default=watermark_file,
+        help="File that execute runs save the watermarks of their completed phases to"
+    )
+
+    parser.add_argument(
+        "--teardown-chunk-size",
+        type=int,
+        default=teardown_chunk_size,
+        help="Number of primary key ids covered by each teardown DELETE"
+    )
+
+    parser.add_argument(
+        "--teardown-throttle",
+        type=float,
+        default=teardown_throttle_seconds,
+        help="Seconds to sleep between teardown DELETE chunks"
+    )
+
+    parser.add_argument(
+        "--migrated-only",
+        action="store_true",
+        help="Only tear down events the migration created, with EVENT_SOURCE_ID. Not supported for learner_records"
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Split report and execute runs into this many shards by a hash of user_id. Without --shard-index, "
+             "every shard is run in its own local process"
+    )
+
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        help="Only process this shard (0 based) of --shards"
+    )
+
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Report counts (missing learner records per user, events to create by type, orphaned completions) with "
+             "server-side aggregates instead of extracting every event"
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="Run an events report from a local snapshot of the source tables in --snapshot-dir, building it first if "
+             "it is missing or the source tables have changed since it was built"
+    )
+
+    parser.add_argument(
+        "--refresh-snapshot",
+        action="store_true",
+        help="Rebuild the snapshot even if the source tables haven't changed"
+    )
+
+    parser.add_argument(
+        "--snapshot-dir",
+        default=snapshot_dir,
+        help="Directory the snapshot is kept in"
+    )
+
+    args = parser.parse_args()
+    if args.shard_index is not None and not args.shards:
+        parser.error("--shard-index requires --shards")
+    # Teardown deletes by primary key range across every user, so it can't be limited to a shard
+    if args.shards and args.action == "teardown":
+        parser.error("--shards is not supported for teardown runs")
+    if args.fast and (args.action != "report" or args.incremental or args.snapshot):
+        parser.error("--fast is only supported for non-incremental report runs without --snapshot")
+    if args.snapshot and (args.action != "report" or args.shards or args.incremental or "events" not in args.data_types):
+        parser.error("--snapshot is only supported for unsharded, non-incremental events report runs")
+    if args.migrated_only and (args.action != "teardown" or "learner_records" in args.data_types):
+        parser.error("--migrated-only is only supported for events teardown runs")
+    # The learner_records run holds one MySQL connection for its missing key stream while up to --workers lookups and
+    # the insert borrow others, and the events run holds one for its learner record stream while its stages borrow
+    # others. A smaller pool would wait forever for a connection.
+    if "learner_records" in args.data_types and args.action != "teardown" and not args.fast \
+            and mysql_pool_size < args.workers + 2:
+        parser.error(f"learner_records runs with {args.workers} workers need MYSQL_POOL_SIZE of at least "
+                     f"{args.workers + 2}")
+    if "events" in args.data_types and args.action != "teardown" and not args.fast and not args.snapshot \
+            and mysql_pool_size < 2:
+        parser.error("events runs need MYSQL_POOL_SIZE of at least 2")
+    return args
+
+
+def main(args):
+    shard = Shard(args.shards, args.shard_index) if args.shards and args.shard_index is not None else None
+    # Each shard has its own checkpoint, watermark and report files
+    metrics_path = shard.path(args.metrics_file) if shard else args.metrics_file
+    fast_report = None
+    try:
+        if args.action == "teardown":
+            teardown(args.data_types, args.teardown_chunk_size, args.teardown_throttle, args.migrated_only)
+        elif args.fast:
+            fast_report = run_fast_report(args.data_types, shard)
+        else:
+            execute = args.action == "execute"
+            # Only execute runs commit work, so only they are checkpointed
+            checkpoint = Checkpoint(shard.path(args.checkpoint_file) if shard else args.checkpoint_file,
+                                    args.resume) if execute else None
+            watermarks = WatermarkStore(shard.path(args.watermark_file) if shard else args.watermark_file) \
+                if execute or args.incremental else None
+            snapshot = get_snapshot(args.snapshot_dir, args.refresh_snapshot) if args.snapshot else None
+            run(args.data_types, execute, args.workers, checkpoint, watermarks, args.incremental, shard, snapshot)
+    finally:
+        metrics.write_json(metrics_path, {"action": args.action, "data_types": args.data_types,
+                                          "incremental": args.incremental, "shard": repr(shard) if shard else None,
+                                          "report": fast_report, "pools": get_pool_metrics(),
+                                          "batch_sizes": get_batch_sizes()})
+        logger.info(f"Run report written to {metrics_path}")
+        if args.prometheus_file:
+            metrics.write_prometheus(shard.path(args.prometheus_file) if shard else args.prometheus_file)
+        logger.info(f"Connection pool metrics: {get_pool_metrics()}")
+        async_io.shutdown_executor()
+        close_pools()
+
+
+def run_shard(args, shard_index: int):
+    args = argparse.Namespace(**{**vars(args), "shard_index": shard_index})
+    main(args)
+
+
+def run_shards(args):
+    # Runs every shard in its own process, each with its own connection pools
+    logger.info(f"Running {args.shards} shards in local processes")
+    if module_record_index and "learner_records" in args.data_types and args.action == "execute":
+        refresh_module_record_index()
+        # The shard processes are forked from this one, so they must not inherit the refresh's open connections
+        close_pools()
+    with ProcessPoolExecutor(max_workers=args.shards) as executor:
+        futures = {executor.submit(run_shard, args, index): index for index in range(args.shards)}
+        failed = []
+        for future in as_completed(futures):
+            try:
+                future.result()
+                logger.info(f"Shard {futures[future]} of {args.shards} finished")
+            except Exception as e:
+                logger.error(f"Shard {futures[future]} of {args.shards} failed: {e}")
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"Shards {sorted(failed)} failed. Rerun them with --shard-index and --resume")
 
 
 if __name__ == "__main__":
     args = get_args()
-    if args.action == "teardown":
-        teardown(args.data_types)
+    if args.shards and args.shard_index is None:
+        run_shards(args)
     else:
-        run(args.data_types, args.action == "execute")
+        main(args)
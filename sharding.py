@@ -0,0 +1,36 @@
+import hashlib
+import os
+
+
+def shard_of(user_id: str, shards: int):
+    return int(hashlib.md5(user_id.encode('utf-8')).hexdigest()[:8], 16) % shards
+
+
+class Shard:
+    # One of count partitions of the data by a stable hash of user_id: the first 32 bits of its MD5, which MySQL,
+    # Postgres and Python all compute the same way, so a user's learner records, course records and course completions
+    # all land in the same shard
+    __slots__ = ('count', 'index')
+
+    def __init__(self, count: int, index: int):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        self.count = count
+        self.index = index
+
+    def __repr__(self):
+        return f"shard {self.index} of {self.count}"
+
+    def mysql_condition(self, column: str):
+        return f"CONV(SUBSTRING(MD5({column}), 1, 8), 16, 10) % {self.count} = {self.index}"
+
+    def pg_condition(self, column: str):
+        return f"('x' || substr(md5({column}), 1, 8))::bit(32)::bigint % {self.count} = {self.index}"
+
+    def contains(self, user_id: str):
+        return shard_of(user_id, self.count) == self.index
+
+    # Per-shard checkpoint, watermark and report files, e.g. migration_checkpoint.shard-0-of-4.json
+    def path(self, path: str):
+        root, ext = os.path.splitext(path)
+        return f"{root}.shard-{self.index}-of-{self.count}{ext}"
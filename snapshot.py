@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import async_io
+from config import course_record_page_size
+from course_completions import CourseCompletion, get_course_completions
+from engine import EventSource
+from learner_record import LearnerRecordWithEvents, CourseRecord, get_learner_records_ordered_pages, \
+    get_incomplete_course_records_pages
+from log import get_logger
+from metrics import metrics
+from models import CourseRecordBase
+
+logger = get_logger('snapshot')
+
+SNAPSHOT_VERSION = 1
+MANIFEST = "manifest.json"
+
+# Timestamps are stored as int64 microseconds since the epoch, with numpy's NaT value for NULL, so that a column can be
+# viewed as datetime64[us] and converted back to datetimes (and None) in one call
+NAT = np.iinfo(np.int64).min
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def _to_micros(value: Optional[datetime]):
+    return NAT if value is None else (value - EPOCH) // ONE_MICROSECOND
+
+
+def _from_micros(values: np.ndarray):
+    return np.asarray(values).view('datetime64[us]').tolist()
+
+
+async def get_invalidation_key_async():
+    # An insert or delete of the snapshotted rows changes one of the counts, and an insert or update of a course
+    # record moves the course_record last_updated watermark. A change that does neither, e.g. an update that doesn't
+    # set last_updated, isn't detected: use --refresh-snapshot after one.
+    learner_record_watermarks, completion_watermark, learner_records, course_completions, course_records = \
+        await asyncio.gather(async_io.get_learner_record_watermarks(), async_io.get_course_completion_watermark(),
+                             async_io.count_learner_records(), async_io.count_course_completions(),
+                             async_io.count_incomplete_course_records())
+    sources = {
+        **learner_record_watermarks,
+        "course_completion_event_timestamp": completion_watermark,
+        "learner_records": learner_records,
+        "course_completions": course_completions,
+        "incomplete_course_records": course_records,
+    }
+    key = hashlib.sha256(json.dumps(sources, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return key, sources
+
+
+def get_invalidation_key():
+    return asyncio.run(get_invalidation_key_async())
+
+
+class _StringTable:
+    # Interns strings as dense int codes, in order of first appearance
+    __slots__ = ('codes', 'values')
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def _save_column(path: str, table: str, column: str, values, dtype):
+    np.save(os.path.join(path, f"{table}.{column}.npy"), np.frombuffer(values, dtype=dtype))
+
+
+def build_snapshot(path: str, page_size: int = course_record_page_size):
+    # Source tables are written as one .npy file per column, ids as int codes into string tables and timestamps as
+    # int64 microseconds, and loaded back as memory maps. The manifest is written last and the directory swapped in
+    # whole, so a failed build never leaves a snapshot that looks valid.
+    key, sources = get_invalidation_key()
+    logger.info(f"Building snapshot in {path} for sources {sources}")
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    course_ids, user_ids, values = _StringTable(), _StringTable(), _StringTable()
+    values.code(None)
+    rows = {}
+
+    course, user, lr_id, created = array('i'), array('i'), array('q'), array('q')
+    for page in get_learner_records_ordered_pages(page_size):
+        for lr in page:
+            course.append(course_ids.code(lr.course_id))
+            user.append(user_ids.code(lr.user_id))
+            lr_id.append(lr.lr_id)
+            created.append(_to_micros(lr.created_timestamp))
+        logger.info(f"Snapshotted {len(course)} learner records")
+    for column, data, dtype in (("course", course, np.int32), ("user", user, np.int32), ("id", lr_id, np.int64),
+                                ("created_timestamp", created, np.int64)):
+        _save_column(tmp_path, "learner_records", column, data, dtype)
+    rows["learner_records"] = len(course)
+
+    course, user, timestamp = array('i'), array('i'), array('q')
+    for completion in get_course_completions(page_size):
+        course.append(course_ids.code(completion.course_id))
+        user.append(user_ids.code(completion.user_id))
+        timestamp.append(_to_micros(completion.event_timestamp))
+    for column, data, dtype in (("course", course, np.int32), ("user", user, np.int32),
+                                ("event_timestamp", timestamp, np.int64)):
+        _save_column(tmp_path, "course_completions", column, data, dtype)
+    rows["course_completions"] = len(course)
+    logger.info(f"Snapshotted {len(course)} course completions")
+
+    course, user, state, preference, last_updated = array('i'), array('i'), array('b'), array('b'), array('q')
+    for page in get_incomplete_course_records_pages(page_size):
+        for record in page:
+            course.append(course_ids.code(record.course_id))
+            user.append(user_ids.code(record.user_id))
+            state.append(values.code(record.state))
+            preference.append(values.code(record.preference))
+            last_updated.append(_to_micros(record.last_updated))
+    # Incomplete course records are looked up by key, so they are sorted by their packed (course, user) code
+    keys = (np.frombuffer(course, dtype=np.int32).astype(np.int64) << 32) | np.frombuffer(user, dtype=np.int32)
+    order = np.argsort(keys, kind='stable')
+    np.save(os.path.join(tmp_path, "course_records.key.npy"), keys[order])
+    for column, data, dtype in (("state", state, np.int8), ("preference", preference, np.int8),
+                                ("last_updated", last_updated, np.int64)):
+        np.save(os.path.join(tmp_path, f"course_records.{column}.npy"), np.frombuffer(data, dtype=dtype)[order])
+    rows["course_records"] = len(course)
+    logger.info(f"Snapshotted {len(course)} incomplete course records")
+
+    np.save(os.path.join(tmp_path, "course_ids.npy"), np.array(course_ids.values, dtype=str))
+    np.save(os.path.join(tmp_path, "user_ids.npy"), np.array(user_ids.values, dtype=str))
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "invalidation_key": key,
+        "sources": sources,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "rows": rows,
+        "values": values.values,
+    }
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    logger.info(f"Snapshot written to {path}: {rows}")
+
+
+class Snapshot(EventSource):
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.values = self.manifest["values"]
+        self.course_ids = self._load("course_ids")
+        self.user_ids = self._load("user_ids")
+        self._course_codes: Optional[Dict[str, int]] = None
+        self._user_codes: Optional[Dict[str, int]] = None
+
+    def _load(self, name: str):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+
+    @property
+    def invalidation_key(self):
+        return self.manifest["invalidation_key"] if self.manifest.get("version") == SNAPSHOT_VERSION else None
+
+    def learner_record_pages(self, page_size: int = course_record_page_size):
+        course, user = self._load("learner_records.course"), self._load("learner_records.user")
+        lr_id, created = self._load("learner_records.id"), self._load("learner_records.created_timestamp")
+        for start in range(0, len(course), page_size):
+            end = start + page_size
+            yield [LearnerRecordWithEvents(*row) for row in zip(
+                self.course_ids[course[start:end]].tolist(), self.user_ids[user[start:end]].tolist(),
+                lr_id[start:end].tolist(), _from_micros(created[start:end]))]
+
+    def course_completions(self, chunk_size: int = course_record_page_size):
+        course, user = self._load("course_completions.course"), self._load("course_completions.user")
+        timestamp = self._load("course_completions.event_timestamp")
+        for start in range(0, len(course), chunk_size):
+            end = start + chunk_size
+            for row in zip(self.course_ids[course[start:end]].tolist(), self.user_ids[user[start:end]].tolist(),
+                           _from_micros(timestamp[start:end])):
+                yield CourseCompletion(*row)
+
+    # Snapshot equivalent of learner_record.get_incomplete_course_records_with_records
+    def get_incomplete_course_records(self, records_to_query: List[CourseRecordBase]):
+        if self._course_codes is None:
+            self._course_codes = {value: code for code, value in enumerate(self.course_ids.tolist())}
+            self._user_codes = {value: code for code, value in enumerate(self.user_ids.tolist())}
+        keys = {(record.course_id, record.user_id) for record in records_to_query}
+        keys = [key for key in keys if key[0] in self._course_codes and key[1] in self._user_codes]
+        if not keys:
+            return []
+        packed = np.fromiter(((self._course_codes[course_id] << 32) | self._user_codes[user_id]
+                              for course_id, user_id in keys), dtype=np.int64, count=len(keys))
+        sorted_keys = self._load("course_records.key")
+        if not len(sorted_keys):
+            return []
+        positions = np.minimum(np.searchsorted(sorted_keys, packed), len(sorted_keys) - 1)
+        found = np.flatnonzero(sorted_keys[positions] == packed).tolist()
+        rows = positions[found]
+        states = self._load("course_records.state")[rows].tolist()
+        preferences = self._load("course_records.preference")[rows].tolist()
+        last_updated = _from_micros(self._load("course_records.last_updated")[rows])
+        return [CourseRecord(keys[i][0], keys[i][1], self.values[state], self.values[preference], updated)
+                for i, state, preference, updated in zip(found, states, preferences, last_updated)]
+
+
+def get_snapshot(path: str, refresh: bool = False):
+    # Loads the snapshot in path, rebuilding it first if it is missing, was built from different source data or
+    # refresh is set
+    if not refresh and os.path.exists(os.path.join(path, MANIFEST)):
+        snapshot = Snapshot(path)
+        key, sources = get_invalidation_key()
+        if snapshot.invalidation_key == key:
+            logger.info(f"Using snapshot in {path} created at {snapshot.manifest['created_at']}")
+            return snapshot
+        logger.info(f"Snapshot in {path} is stale: source tables are now {sources}")
+    with metrics.phase("snapshot"):
+        build_snapshot(path)
+    return Snapshot(path)
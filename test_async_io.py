@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+from async_io import iterate, map_in_flight, run_blocking, to_async
+
+
+def test_to_async_runs_on_executor():
+    def blocking_sum(a, b):
+        time.sleep(0.05)
+        return a + b
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(to_async(blocking_sum)(i, i) for i in range(4)))
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(run())
+    assert results == [0, 2, 4, 6]
+    # The four calls overlap rather than running one after another
+    assert elapsed < 0.15
+
+
+def test_iterate():
+    async def run():
+        return [item async for item in iterate(iter([1, 2, 3]))]
+
+    assert asyncio.run(run()) == [1, 2, 3]
+
+
+def test_map_in_flight_keeps_order():
+    async def slow_square(i):
+        await asyncio.sleep(0.01 * (5 - i))
+        return i * i
+
+    async def run():
+        return [result async for result in map_in_flight(slow_square, range(5), 3)]
+
+    assert asyncio.run(run()) == [0, 1, 4, 9, 16]
+
+
+def test_run_blocking_raises():
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        asyncio.run(run_blocking(fail))
@@ -0,0 +1,149 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from batching import chunks, prefetch, with_retries, pipeline, read_ahead, AdaptiveBatcher
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunks([], 2)) == []
+
+
+def test_prefetch_keeps_order():
+    def slow_square(i):
+        time.sleep(0.01 * (5 - i))
+        return i * i
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert list(prefetch(executor, slow_square, range(5), 3)) == [0, 1, 4, 9, 16]
+
+
+def test_read_ahead_overlaps_with_the_caller():
+    def slow_pages():
+        for i in range(4):
+            time.sleep(0.05)
+            yield [i * 2, i * 2 + 1]
+
+    start = time.perf_counter()
+    items = []
+    for item in read_ahead(slow_pages(), depth=2):
+        time.sleep(0.025)
+        items.append(item)
+    assert items == list(range(8))
+    # Reading the pages and the work on their items overlap rather than adding up to 0.4s
+    assert time.perf_counter() - start < 0.35
+
+
+def test_pipeline_keeps_order():
+    def slow_double(i):
+        time.sleep(0.001 * (i % 3))
+        return i * 2
+
+    assert list(pipeline(range(20), [slow_double, lambda i: i + 1], depth=2)) == [i * 2 + 1 for i in range(20)]
+
+
+def test_pipeline_raises_stage_errors():
+    def fail_on_three(i):
+        if i == 3:
+            raise ValueError("three")
+        return i
+
+    results = []
+    with pytest.raises(ValueError):
+        for result in pipeline(range(10), [fail_on_three], depth=1):
+            results.append(result)
+    assert results == [0, 1, 2]
+
+
+def test_pipeline_stops_when_closed():
+    consumed = []
+
+    def source():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    results = pipeline(source(), [lambda i: i], depth=1)
+    assert next(results) == 0
+    results.close()
+    assert len(consumed) < 10
+
+
+def test_with_retries():
+    calls = []
+
+    def flaky(value):
+        calls.append(value)
+        if len(calls) < 3:
+            raise RuntimeError("boom")
+        return value
+
+    assert with_retries(flaky, "ok", attempts=3, description="flaky", backoff_seconds=0) == "ok"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(RuntimeError):
+        with_retries(flaky, "ok", attempts=2, description="flaky", backoff_seconds=0)
+    assert len(calls) == 2
+
+
+class MySQLError(Exception):
+    def __init__(self, errno):
+        super().__init__(f"error {errno}")
+        self.errno = errno
+
+
+def test_adaptive_batcher_moves_towards_target():
+    batcher = AdaptiveBatcher("test", 1000, target_seconds=1.0, min_size=100, max_size=5000)
+    batcher.observe(1000, 0.1)
+    assert batcher.size == 2000
+    batcher.observe(2000, 1.6)
+    assert batcher.size == 1250
+    batcher.observe(1250, 100)
+    assert batcher.size == 625
+    for _ in range(10):
+        batcher.observe(batcher.size, 0.01)
+    assert batcher.size == 5000
+
+
+def test_adaptive_batcher_retries_smaller_batches_on_errors():
+    batcher = AdaptiveBatcher("test", 8, target_seconds=60, min_size=1, backoff_seconds=0)
+    written = []
+
+    def write(batch):
+        if len(batch) > 2:
+            raise MySQLError(1153 if len(batch) > 4 else 1205)
+        written.extend(batch)
+
+    batcher.run(list(range(10)), write)
+    assert written == list(range(10))
+    assert batcher.max_size == 4
+
+
+def test_adaptive_batcher_does_not_cap_size_on_server_gone_away():
+    batcher = AdaptiveBatcher("test", 8, target_seconds=60, min_size=1, backoff_seconds=0)
+    failures = [MySQLError(2006)]
+    written = []
+
+    def write(batch):
+        if failures:
+            raise failures.pop()
+        written.extend(batch)
+
+    batcher.run(list(range(10)), write)
+    assert written == list(range(10))
+    assert batcher.max_size == 8
+
+
+def test_fixed_batcher_raises_errors():
+    batcher = AdaptiveBatcher("test", 4)
+
+    def write(batch):
+        raise MySQLError(1205)
+
+    with pytest.raises(MySQLError):
+        batcher.run(list(range(10)), write)
+    batcher.observe(4, 100)
+    assert list(batcher.batches(list(range(10)))) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
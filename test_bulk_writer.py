@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from bulk_writer import ExecuteManyWriter, LoadDataWriter, to_tsv_field
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.statements = []
+        self.infile = None
+
+    def executemany(self, sql, rows):
+        self.statements.append((sql, rows))
+
+    def execute(self, sql, params):
+        with open(params[0], encoding="utf-8") as f:
+            self.infile = f.read()
+        self.statements.append((sql, params))
+
+
+def test_to_tsv_field():
+    assert to_tsv_field(None) == "\\N"
+    assert to_tsv_field("a\tb\nc\\d") == "a\\tb\\nc\\\\d"
+    assert to_tsv_field(datetime(2024, 1, 1, 10, 0, 0)) == "2024-01-01 10:00:00"
+
+
+def test_execute_many_writer_sql():
+    cursor = RecordingCursor()
+    rows = [("user's", "course_1")]
+    ExecuteManyWriter(10)._write_batch(cursor, "learner_records", ["learner_id", "resource_id"], rows, True,
+                                       {"learner_record_uid": "UUID()"})
+    sql, written = cursor.statements[0]
+    assert sql == "INSERT IGNORE INTO learner_records (learner_id, resource_id, learner_record_uid) " \
+                  "VALUES (%s, %s, UUID())"
+    assert written == rows
+
+
+def test_load_data_writer_writes_tsv():
+    cursor = RecordingCursor()
+    LoadDataWriter(10)._write_batch(cursor, "learner_record_events", ["learner_record_id", "event_timestamp"],
+                                    [(1, None), (2, "x\ty")], False, {})
+    assert cursor.infile == "1\t\\N\n2\tx\\ty\n"
+    assert "LOAD DATA LOCAL INFILE %s INTO TABLE learner_record_events" in cursor.statements[0][0]
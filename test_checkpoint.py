@@ -0,0 +1,33 @@
+import json
+
+from checkpoint import Checkpoint
+
+
+def test_checkpoint_saves_progress(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path)
+    checkpoint.update("events", last_key=["course_1", "user_1"], pages_committed=1)
+    checkpoint.update("events", pages_committed=2)
+    checkpoint.complete("learner_records")
+
+    with open(path) as f:
+        assert json.load(f) == {
+            "events": {"last_key": ["course_1", "user_1"], "pages_committed": 2},
+            "learner_records": {"complete": True},
+        }
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    Checkpoint(path).update("events", pages_committed=3)
+
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.get("events") == {"pages_committed": 3}
+    assert not resumed.is_complete("events")
+
+    fresh = Checkpoint(path)
+    assert fresh.get("events") == {}
+
+
+def test_checkpoint_resume_without_file(tmp_path):
+    assert Checkpoint(str(tmp_path / "missing.json"), resume=True).get("events") == {}
@@ -0,0 +1,71 @@
+import datetime
+
+import pytest
+
+from engine import InMemorySource, InMemorySink, derive_events
+from engine_files import FileSource, FileEventSink, write_sources, read_table, file_formats, TABLES
+from models import CourseCompletion, CourseRecord, LearnerRecordWithEvents, COMPLETE_COURSE, MOVE_TO_LEARNING_PLAN, \
+    REMOVE_FROM_LEARNING_PLAN, REMOVE_FROM_SUGGESTIONS
+
+created = datetime.datetime(2024, 1, 1, 9, 30)
+later = datetime.datetime(2024, 2, 1, 12, 0, 0, 500)
+
+
+def source_data():
+    learner_records = [
+        LearnerRecordWithEvents("course2", "user1", 2, created),
+        LearnerRecordWithEvents("course1", "user1", 1, created),
+        LearnerRecordWithEvents("course3", "user1", 3, created),
+        LearnerRecordWithEvents("course4", "user1", 4, created),
+        LearnerRecordWithEvents("course5", "user1", 5, created),
+    ]
+    completions = [
+        CourseCompletion("course1", "user1", later),
+        CourseCompletion("course1", "user1", created),
+        CourseCompletion("course9", "user1", later),
+    ]
+    course_records = [
+        CourseRecord("course1", "user1", "COMPLETED", None, later),
+        CourseRecord("course2", "user1", None, "LIKED", later),
+        CourseRecord("course3", "user1", None, "DISLIKED", later),
+        CourseRecord("course4", "user1", "ARCHIVED", None, later),
+        CourseRecord("course5", "user1", "IN_PROGRESS", None, later),
+    ]
+    return learner_records, completions, course_records
+
+
+expected_events = [
+    (1, COMPLETE_COURSE, created),
+    (1, COMPLETE_COURSE, later),
+    (2, MOVE_TO_LEARNING_PLAN, later),
+    (3, REMOVE_FROM_SUGGESTIONS, later),
+    (4, REMOVE_FROM_LEARNING_PLAN, later),
+]
+
+
+def as_tuples(events):
+    return [(e.learner_record_id, e.event_id, e.event_timestamp) for e in events]
+
+
+def test_derive_events_in_memory():
+    sink = InMemorySink()
+    totals = derive_events(InMemorySource(*source_data()), sink, page_size=2)
+    assert as_tuples(sink.events) == expected_events
+    assert totals.learner_records == 5
+    assert totals.events == 5
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_derive_events_from_files(tmp_path, file_format):
+    if file_format == "parquet":
+        pytest.importorskip("pyarrow")
+    memory_source = InMemorySource(*source_data())
+    write_sources(str(tmp_path), file_format, memory_source.learner_record_pages(2), memory_source.course_completions(),
+                  [source_data()[2]], page_size=2)
+
+    events_path = str(tmp_path / f"events.{file_format}")
+    derive_events(FileSource(str(tmp_path), file_format), FileEventSink(events_path, file_format), page_size=3)
+    rows = [row for batch in read_table(str(tmp_path), "learner_records", file_format) for row in batch]
+    assert rows[0] == ("course1", "user1", 1, created)
+    events = file_formats[file_format].read(events_path, TABLES["learner_record_events"], 100)
+    assert [row for batch in events for row in batch] == expected_events
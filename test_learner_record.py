@@ -0,0 +1,216 @@
+from datetime import datetime, timedelta
+
+import learner_record
+from batching import AdaptiveBatcher
+from learner_record import LearnerRecordEvent, remove_existing_learner_record_events, COMPLETE_COURSE, \
+    MOVE_TO_LEARNING_PLAN, normalize_timestamp, EventTableSchema, insert_learner_record_events, \
+    get_missing_course_record_keys, delete_in_id_chunks, delete_learner_record_events, \
+    course_record_lookup_strategies
+
+datetime_2024 = datetime(2024, 1, 1, 10, 0, 0)
+datetime_2025 = datetime(2025, 1, 1, 10, 0, 0)
+
+
+def test_remove_existing_learner_record_events(monkeypatch):
+    monkeypatch.setattr(learner_record, "get_existing_learner_record_event_keys",
+                        lambda ids: {(1, COMPLETE_COURSE, datetime_2024)})
+    events = [
+        LearnerRecordEvent(1, COMPLETE_COURSE, datetime_2024),
+        LearnerRecordEvent(1, COMPLETE_COURSE, datetime_2025),
+        LearnerRecordEvent(2, MOVE_TO_LEARNING_PLAN, datetime_2024),
+        LearnerRecordEvent(2, MOVE_TO_LEARNING_PLAN, datetime_2024),
+    ]
+
+    new_events = remove_existing_learner_record_events(events)
+
+    assert [(e.learner_record_id, e.event_id, e.event_timestamp) for e in new_events] == [
+        (1, COMPLETE_COURSE, datetime_2025),
+        (2, MOVE_TO_LEARNING_PLAN, datetime_2024),
+    ]
+
+
+def test_remove_existing_learner_record_events_compares_at_column_precision(monkeypatch):
+    monkeypatch.setattr(learner_record, "get_existing_learner_record_event_keys",
+                        lambda ids: {(1, COMPLETE_COURSE, datetime_2024)})
+    events = [
+        LearnerRecordEvent(1, COMPLETE_COURSE, datetime_2024 + timedelta(microseconds=400000)),
+        LearnerRecordEvent(1, COMPLETE_COURSE, datetime_2024 + timedelta(microseconds=500000)),
+    ]
+
+    new_events = remove_existing_learner_record_events(events, precision=0)
+
+    assert [e.event_timestamp for e in new_events] == [datetime_2024 + timedelta(microseconds=500000)]
+    assert normalize_timestamp(datetime_2024 + timedelta(microseconds=999999), 0) == \
+        datetime_2024 + timedelta(seconds=1)
+    assert normalize_timestamp(datetime_2024 + timedelta(microseconds=123456), 3) == \
+        datetime_2024 + timedelta(microseconds=123000)
+
+
+class RecordingWriter:
+    name = "recording"
+    batch_size = 100
+
+    def write(self, table, columns, rows, ignore=False, set_expressions=None, on_batch_committed=None):
+        self.rows = rows
+        self.ignore = ignore
+
+
+def test_insert_learner_record_events_uses_insert_ignore_with_unique_event_key(monkeypatch):
+    monkeypatch.setattr(learner_record, "get_event_table_schema", lambda: EventTableSchema(0, True))
+    def get_existing_learner_record_event_keys(ids):
+        raise AssertionError("existing events should not be read")
+
+    monkeypatch.setattr(learner_record, "get_existing_learner_record_event_keys",
+                        get_existing_learner_record_event_keys)
+    writer = RecordingWriter()
+    event = LearnerRecordEvent(1, COMPLETE_COURSE, datetime_2024 + timedelta(microseconds=600000))
+
+    insert_learner_record_events([event], writer)
+
+    assert writer.ignore
+    assert [row[3] for row in writer.rows] == [datetime_2024 + timedelta(seconds=1)]
+
+
+class FakeConnection:
+    def __init__(self, rows=()):
+        self.statements = []
+        self.fetch_sizes = []
+        self.rows = list(rows)
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self, **kwargs):
+        return self
+
+    def execute(self, sql, params=None):
+        self.statements.append((" ".join(sql.split()), params))
+
+    def executemany(self, sql, params):
+        self.statements.append((" ".join(sql.split()), list(params)))
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def commit(self):
+        pass
+
+
+def test_get_missing_course_record_keys_fetches_the_current_batcher_size(monkeypatch):
+    connection = FakeConnection([(f"course{i}", "user") for i in range(5)])
+    monkeypatch.setattr(learner_record, "mysql_connection", lambda: connection)
+    batcher = AdaptiveBatcher("missing_course_records", 2)
+
+    batches = []
+    for keys in get_missing_course_record_keys(batcher=batcher):
+        batches.append(keys)
+        batcher.size = 3
+
+    assert batches == [[("course0", "user"), ("course1", "user")],
+                       [("course2", "user"), ("course3", "user"), ("course4", "user")]]
+    assert connection.fetch_sizes == [2, 3, 3]
+
+
+def delete_ranges(connection):
+    return [params[:2] for sql, params in connection.statements]
+
+
+def test_delete_in_id_chunks_covers_first_and_last_id(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(learner_record, "mysql_connection", lambda: connection)
+
+    delete_in_id_chunks("learner_records", 5, 24, 10)
+
+    assert connection.statements[0][0] == "DELETE FROM learner_records WHERE id BETWEEN %s AND %s"
+    assert delete_ranges(connection) == [(5, 14), (15, 24)]
+
+
+def test_delete_in_id_chunks_ends_the_last_chunk_at_max_id(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(learner_record, "mysql_connection", lambda: connection)
+
+    delete_in_id_chunks("learner_records", 1, 25, 10)
+
+    assert delete_ranges(connection) == [(1, 10), (11, 20), (21, 25)]
+
+
+def test_delete_learner_record_events_source_only_adds_event_source_condition(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(learner_record, "mysql_connection", lambda: connection)
+    monkeypatch.setattr(learner_record, "get_id_bounds", lambda table: (1, 3))
+
+    delete_learner_record_events(chunk_size=2, throttle_seconds=0, source_only=True)
+
+    assert connection.statements == [
+        ("DELETE FROM learner_record_events WHERE id BETWEEN %s AND %s AND learner_record_event_source = %s",
+         (1, 2, learner_record.event_source_id)),
+        ("DELETE FROM learner_record_events WHERE id BETWEEN %s AND %s AND learner_record_event_source = %s",
+         (3, 3, learner_record.event_source_id)),
+    ]
+
+
+def lookup_rows():
+    return [("course1", "user1", None, "LIKED", datetime_2024)]
+
+
+def test_lookup_with_tuple_in_queries_each_batch_of_keys(monkeypatch):
+    connection = FakeConnection(lookup_rows())
+    monkeypatch.setattr(learner_record, "mysql_connection", lambda: connection)
+    monkeypatch.setattr(learner_record, "batch_size", 2)
+    monkeypatch.setattr(learner_record, "adaptive_batching", {})
+    keys = {("course1", "user1"), ("course2", "user1"), ("course3", "user2")}
+
+    records = course_record_lookup_strategies["tuple_in"](keys)
+
+    sqls = [sql for sql, params in connection.statements]
+    assert sqls[0] == ("SELECT cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated "
+                       "from course_record cr where (cr.course_id, cr.user_id) in ((%s, %s),(%s, %s)) "
+                       "and (cr.state != 'COMPLETED' or cr.state is null);")
+    assert sqls[1] == sqls[0].replace("((%s, %s),(%s, %s))", "((%s, %s))")
+    params = [params for sql, params in connection.statements]
+    assert {tuple(batch[i:i + 2]) for batch in params for i in range(0, len(batch), 2)} == keys
+    assert [(r.course_id, r.user_id, r.state, r.preference) for r in records] == [("course1", "user1", None, "LIKED")]
+
+
+def test_lookup_with_temp_table_loads_keys_and_joins_on_one_connection(monkeypatch):
+    connection = FakeConnection(lookup_rows())
+    connections = []
+
+    def mysql_connection():
+        connections.append(connection)
+        return connection
+
+    monkeypatch.setattr(learner_record, "mysql_connection", mysql_connection)
+    monkeypatch.setattr(learner_record, "batch_size", 2)
+    monkeypatch.setattr(learner_record, "adaptive_batching", {})
+    keys = {("course1", "user1"), ("course2", "user1"), ("course3", "user2")}
+
+    records = course_record_lookup_strategies["temp_table"](keys)
+
+    assert len(connections) == 1
+    sqls = [sql for sql, params in connection.statements]
+    assert sqls == [
+        "DROP TEMPORARY TABLE IF EXISTS course_record_lookup_keys;",
+        "CREATE TEMPORARY TABLE course_record_lookup_keys (PRIMARY KEY (course_id, user_id)) "
+        "SELECT cr.course_id, cr.user_id FROM course_record cr LIMIT 0;",
+        "INSERT IGNORE INTO course_record_lookup_keys (course_id, user_id) VALUES (%s, %s)",
+        "INSERT IGNORE INTO course_record_lookup_keys (course_id, user_id) VALUES (%s, %s)",
+        "SELECT cr.course_id, cr.user_id, cr.state, cr.preference, cr.last_updated from course_record_lookup_keys k "
+        "JOIN course_record cr ON cr.course_id = k.course_id AND cr.user_id = k.user_id "
+        "where cr.state != 'COMPLETED' or cr.state is null;",
+        "DROP TEMPORARY TABLE course_record_lookup_keys;",
+    ]
+    inserted = connection.statements[2][1] + connection.statements[3][1]
+    assert [len(connection.statements[2][1]), len(connection.statements[3][1])] == [2, 1]
+    assert set(inserted) == keys
+    assert [(r.course_id, r.user_id, r.state, r.preference) for r in records] == [("course1", "user1", None, "LIKED")]
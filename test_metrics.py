@@ -0,0 +1,42 @@
+import json
+
+from metrics import Metrics, Histogram
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in (0.0005, 0.003, 0.003, 120.0):
+        histogram.observe(value)
+    result = histogram.as_dict()
+    assert result["count"] == 4
+    assert result["buckets"]["0.001"] == 1
+    assert result["buckets"]["0.005"] == 2
+    assert result["buckets"]["+Inf"] == 1
+    assert result["max_seconds"] == 120.0
+
+
+def test_metrics_report(tmp_path):
+    metrics = Metrics()
+    with metrics.phase("events"):
+        with metrics.batch("events.insert", 1000):
+            pass
+        metrics.add_rows("events", 500)
+    with metrics.db_call("get_course_records"):
+        pass
+
+    path = tmp_path / "report.json"
+    metrics.write_json(str(path), {"action": "report"})
+    report = json.loads(path.read_text())
+    assert report["action"] == "report"
+    assert report["phases"]["events"]["rows"] == 500
+    assert report["phases"]["events.insert"]["batches"]["count"] == 1
+    assert report["phases"]["events.insert"]["rows"] == 1000
+    assert report["db_calls"]["get_course_records"]["count"] == 1
+    assert report["peak_rss_bytes"] > 0
+
+    prometheus_path = tmp_path / "metrics.prom"
+    metrics.write_prometheus(str(prometheus_path))
+    text = prometheus_path.read_text()
+    assert 'migration_phase_rows{phase="events"} 500' in text
+    assert 'migration_db_call_seconds_bucket{call="get_course_records",le="+Inf"} 1' in text
+    assert 'migration_db_call_seconds_count{call="get_course_records"} 1' in text
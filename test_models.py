@@ -0,0 +1,24 @@
+from models import CourseRecordBase, KeyIndex, course_records_to_map
+
+
+def test_key_index():
+    key_index = KeyIndex()
+    key = key_index.key("course_1", "user_1")
+    assert key_index.key("course_1", "user_1") == key
+    assert key_index.lookup("course_1", "user_1") == key
+    assert key_index.key("course_1", "user_2") != key
+    assert key_index.lookup("course_2", "user_1") is None
+    assert "course_2" not in key_index.course_ids
+
+
+def test_key_index_is_not_ambiguous_with_commas():
+    key_index = KeyIndex()
+    assert key_index.key("a,b", "c") != key_index.key("a", "b,c")
+
+
+def test_course_records_to_map():
+    records = [CourseRecordBase("course_1", "user_1"), CourseRecordBase("course_2", "user_1")]
+    assert list(course_records_to_map(records).keys()) == ["course_1,user_1", "course_2,user_1"]
+    key_index = KeyIndex()
+    _map = course_records_to_map(records, key_index)
+    assert _map[key_index.lookup("course_2", "user_1")] is records[1]
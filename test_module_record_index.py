@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import module_record_index
+from module_record_index import refresh_module_record_index, rebuild_module_record_index
+
+
+def test_refresh_builds_missing_index(monkeypatch):
+    calls = []
+    monkeypatch.setattr(module_record_index, "get_module_record_index_watermark", lambda: None)
+    monkeypatch.setattr(module_record_index, "rebuild_module_record_index", lambda: calls.append("rebuild"))
+
+    refresh_module_record_index()
+
+    assert calls == ["rebuild"]
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        self.statements.append((" ".join(sql.split()), params))
+
+    def commit(self):
+        pass
+
+
+def test_refresh_rescans_overlap_before_previous_watermark(monkeypatch):
+    previous = datetime(2024, 1, 1, 12, 0)
+    connection = FakeConnection()
+    monkeypatch.setattr(module_record_index, "get_module_record_index_watermark", lambda: previous)
+    monkeypatch.setattr(module_record_index, "_get_module_record_watermark", lambda: previous)
+    monkeypatch.setattr(module_record_index, "mysql_connection", lambda: connection)
+
+    refresh_module_record_index(overlap_seconds=600)
+
+    # Module records that committed late are merged in even though the watermark hasn't moved, and the watermark in
+    # the table comment is left as it is
+    [(sql, params)] = connection.statements
+    assert sql.startswith("INSERT INTO module_record_first_created")
+    assert params == (datetime(2024, 1, 1, 11, 50), previous)
+
+
+def test_rebuild_holds_one_connection_at_a_time(monkeypatch):
+    # With MYSQL_POOL_SIZE=1 a nested checkout would wait forever
+    connection = FakeConnection()
+    checked_out = []
+
+    class Checkout:
+        def __enter__(self):
+            assert not checked_out, "a second connection was checked out"
+            checked_out.append(connection)
+            return connection
+
+        def __exit__(self, *args):
+            checked_out.pop()
+            return False
+
+    monkeypatch.setattr(module_record_index, "mysql_connection", Checkout)
+    monkeypatch.setattr(module_record_index, "_get_module_record_watermark", lambda: datetime(2024, 1, 1))
+    # The index doesn't exist yet, so information_schema has no row for it
+    connection.fetchone = lambda: None if "information_schema" in connection.statements[-1][0] else (3,)
+
+    rebuild_module_record_index()
+
+    assert connection.statements[-2][0] == "RENAME TABLE module_record_first_created_new TO module_record_first_created"
@@ -0,0 +1,84 @@
+import pytest
+
+import config
+from config import mysql_connection, pg_connection
+from pool import ConnectionPool, MySQLPool, PostgresPool
+
+
+class FakeConnection:
+    def __init__(self, driver_pool):
+        self.driver_pool = driver_pool
+
+    def close(self):
+        self.driver_pool.returned.append(self)
+
+
+class FakeDriverPool:
+    # Stands in for both MySQLConnectionPool and psycopg2's ThreadedConnectionPool
+    def __init__(self):
+        self.returned = []
+
+    def get_connection(self):
+        return FakeConnection(self)
+
+    getconn = get_connection
+
+    def putconn(self, conn):
+        self.returned.append(conn)
+
+
+def fake_pool(pool_class, name: str, size: int = 1):
+    pool = pool_class.__new__(pool_class)
+    ConnectionPool.__init__(pool, name, size)
+    pool._pool = FakeDriverPool()
+    return pool
+
+
+def assert_returned(pool: ConnectionPool, conn):
+    assert pool._pool.returned == [conn]
+    assert pool.metrics.in_use == 0
+    # The slot was released too, so a pool of one doesn't block the next checkout
+    assert pool._slots.acquire(blocking=False)
+    pool._slots.release()
+
+
+@pytest.mark.parametrize("pool_class", [MySQLPool, PostgresPool])
+def test_connection_is_returned_when_the_caller_raises(pool_class):
+    pool = fake_pool(pool_class, "test")
+
+    with pytest.raises(RuntimeError):
+        with pool.connection() as conn:
+            raise RuntimeError("query failed")
+
+    assert_returned(pool, conn)
+    assert pool.metrics.checkouts == 1
+
+
+def test_slot_is_released_when_getting_a_connection_raises():
+    pool = fake_pool(MySQLPool, "test")
+
+    def get_connection():
+        raise RuntimeError("can't connect")
+
+    pool._pool.get_connection = get_connection
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            pass
+
+    assert pool._slots.acquire(blocking=False)
+    assert pool.metrics.checkouts == 0
+
+
+@pytest.mark.parametrize("name, pool_class, connection", [
+    ("mysql", MySQLPool, mysql_connection),
+    ("pg", PostgresPool, pg_connection),
+])
+def test_config_connections_are_returned_when_the_caller_raises(monkeypatch, name, pool_class, connection):
+    pool = fake_pool(pool_class, name)
+    monkeypatch.setattr(config, "_pools", {name: pool})
+
+    with pytest.raises(RuntimeError):
+        with connection() as conn:
+            raise RuntimeError("query failed")
+
+    assert_returned(pool, conn)
@@ -0,0 +1,40 @@
+from learner_record import MOVE_TO_LEARNING_PLAN, REMOVE_FROM_LEARNING_PLAN, REMOVE_FROM_SUGGESTIONS
+from report import count_events, count_missing_learner_records
+
+
+def test_count_missing_learner_records():
+    result = count_missing_learner_records([("user_1", 3), ("user_2", 1), ("user_3", 5)], top_users=2)
+    assert result == {
+        "missing_learner_records": 9,
+        "users_with_missing_learner_records": 3,
+        "top_users": [{"user_id": "user_3", "missing_learner_records": 5},
+                      {"user_id": "user_1", "missing_learner_records": 3}],
+    }
+
+
+def test_count_events():
+    event_type_pages = [
+        [("course_1", "user_1", MOVE_TO_LEARNING_PLAN), ("course_1", "user_2", REMOVE_FROM_LEARNING_PLAN)],
+        [("course_1", "user_2", REMOVE_FROM_LEARNING_PLAN), ("course_2", "user_1", REMOVE_FROM_SUGGESTIONS),
+         ("course_3", "user_1", None)],
+    ]
+    completion_counts = [
+        ("course_0", "user_1", 1),
+        ("course_1", "user_1", 2),
+        ("course_1", "user_1a", 1),
+        ("course_3", "user_1", 1),
+        ("course_4", "user_1", 3),
+    ]
+    result = count_events(event_type_pages, completion_counts)
+    assert result == {
+        "learner_records": 4,
+        "events_to_create": 5,
+        "completion_events_to_create": 3,
+        "events_by_type": {
+            "MOVE_TO_LEARNING_PLAN": 0,
+            "REMOVE_FROM_LEARNING_PLAN": 1,
+            "REMOVE_FROM_SUGGESTIONS": 1,
+            "COMPLETE_COURSE": 3,
+        },
+        "orphaned_completions": 5,
+    }
@@ -1,9 +1,14 @@
 import datetime
-from copy import copy
+from copy import deepcopy
 
-from course_completions import CourseCompletion
-from learner_record import LearnerRecordWithEvents, CourseRecord
-from script import find_course_completion_events, find_non_completion_events
+import pytest
+
+import learner_record
+import script
+from engine import find_course_completion_events, find_non_completion_events, merge_course_completions, \
+    merge_indexed_course_completions
+from models import CourseCompletion, LearnerRecordWithEvents, CourseRecord, COMPLETE_COURSE, MOVE_TO_LEARNING_PLAN
+from watermark import WatermarkStore
 
 created = datetime.datetime.now()
 
@@ -20,7 +25,7 @@ def test_find_events():
         CourseCompletion("course_1", "user_1", created),
         CourseCompletion("course_2", "user_1", created)
     ]
-    result = find_course_completion_events(copy(learner_records), completions)
+    result = find_course_completion_events(deepcopy(learner_records), completions)
     assert len(result["course_1,user_1"].events) == 2
     assert result["course_1,user_1"].has_completions == True
 
@@ -32,16 +37,171 @@ def test_find_events():
 
 
 def test_find_non_completion_events():
-    records = copy(learner_records)
+    records = deepcopy(learner_records)
     course_records = [
-        CourseRecord("course_1", "user_1", "ARCHIVED", None, created),
+        CourseRecord("course_1", "user_1", "ARCHIVED", None, created + datetime.timedelta(days=1)),
         CourseRecord("course_2", "user_1", None, "LIKED", created),
-        CourseRecord("course1", "user_1", "IN_PROGRESS", None, created),
+        CourseRecord("course_3", "user_2", "IN_PROGRESS", None, created),
     ]
 
     result = find_non_completion_events(records, course_records)
     assert len(result["course_1,user_1"].events) == 1
     assert result["course_1,user_1"].events[0].event_id == 2
     assert len(result["course_2,user_1"].events) == 1
-    assert result["course_1,user_1"].events[0].event_id == 1
+    assert result["course_2,user_1"].events[0].event_id == 1
     assert len(result["course_3,user_2"].events) == 0
+
+
+def test_merge_course_completions():
+    pages = [
+        [LearnerRecordWithEvents("course_1", "user_1", 1, created), LearnerRecordWithEvents("course_1", "user_2", 2, created)],
+        [LearnerRecordWithEvents("course_2", "user_1", 3, created)],
+    ]
+    completions = [
+        CourseCompletion("course_1", "user_1", created),
+        CourseCompletion("course_1", "user_1a", created),
+        CourseCompletion("course_2", "user_1", created),
+        CourseCompletion("course_3", "user_1", created),
+    ]
+    result = list(merge_course_completions(pages, completions))
+    assert list(result[0][0].keys()) == ["course_1,user_1", "course_1,user_2"]
+    assert [c.get_id() for c in result[0][1]] == ["course_1,user_1", "course_1,user_1a"]
+    assert [c.get_id() for c in result[1][1]] == ["course_2,user_1"]
+
+
+def test_merge_indexed_course_completions_keys_each_page_by_its_own_index():
+    pages = [
+        [LearnerRecordWithEvents("course_1", "user_1", 1, created), LearnerRecordWithEvents("course_1", "user_2", 2, created)],
+        [LearnerRecordWithEvents("course_2", "user_1", 3, created)],
+    ]
+    completions = [CourseCompletion("course_1", "user_2", created), CourseCompletion("course_2", "user_1", created)]
+    result = list(merge_indexed_course_completions(pages, completions))
+    (first_map, first_completions, first_index), (second_map, second_completions, second_index) = result
+    assert first_index is not second_index
+    assert list(second_index.course_ids) == ["course_2"] and list(second_index.user_ids) == ["user_1"]
+    assert [lr.lr_id for lr in first_map.values()] == [1, 2]
+    assert first_map[first_index.lookup_of(first_completions[0])].lr_id == 2
+    assert second_map[second_index.lookup_of(second_completions[0])].lr_id == 3
+
+
+def test_merge_course_completions_rejects_unordered_input():
+    pages = [[LearnerRecordWithEvents("course_2", "user_1", 1, created)]]
+    completions = [CourseCompletion("course_2", "user_1", created), CourseCompletion("course_1", "user_1", created)]
+    with pytest.raises(ValueError):
+        list(merge_course_completions(pages, completions))
+
+
+@pytest.mark.parametrize("argv, pool_size, rejected", [
+    (["learner_records", "execute", "--workers", "2"], 3, True),
+    (["learner_records", "execute", "--workers", "2"], 4, False),
+    (["events", "report"], 1, True),
+    (["learner_records", "events", "teardown"], 1, False),
+])
+def test_get_args_checks_mysql_pool_size(monkeypatch, argv, pool_size, rejected):
+    monkeypatch.setattr(script, "mysql_pool_size", pool_size)
+    monkeypatch.setattr("sys.argv", ["script.py"] + argv)
+    if rejected:
+        with pytest.raises(SystemExit):
+            script.get_args()
+    else:
+        script.get_args()
+
+
+@pytest.mark.parametrize("argv, rejected", [
+    (["events", "teardown", "--shards", "4"], True),
+    (["events", "teardown", "--shards", "4", "--shard-index", "0"], True),
+    (["events", "execute", "--shards", "4"], False),
+])
+def test_get_args_rejects_sharded_teardown(monkeypatch, argv, rejected):
+    monkeypatch.setattr(script, "mysql_pool_size", 10)
+    monkeypatch.setattr("sys.argv", ["script.py"] + argv)
+    if rejected:
+        with pytest.raises(SystemExit):
+            script.get_args()
+    else:
+        script.get_args()
+
+
+def as_async(result, calls=None):
+    async def fn(*args):
+        if calls is not None:
+            calls.append(args)
+        return result
+
+    return fn
+
+
+def test_run_incremental_events_only_derives_events_changed_since_the_previous_watermarks(monkeypatch):
+    since = datetime.datetime(2024, 1, 1)
+    until = datetime.datetime(2024, 2, 1)
+    old = since - datetime.timedelta(days=1)
+    new = since + datetime.timedelta(days=1)
+    previous = {"course_completion_event_timestamp": since, "course_record_last_updated": since,
+                "learner_record_id": 2}
+    current = {"course_completion_event_timestamp": until, "course_record_last_updated": until,
+               "learner_record_id": 3}
+    completion_calls, course_record_calls, learner_record_calls, fetched, inserted = [], [], [], [], []
+    monkeypatch.setattr(script.async_io, "get_course_completion_keys_between",
+                        as_async({("course_1", "user_1")}, completion_calls))
+    monkeypatch.setattr(script.async_io, "get_course_record_keys_updated_between",
+                        as_async({("course_2", "user_1")}, course_record_calls))
+    monkeypatch.setattr(script.async_io, "get_learner_record_keys_created_between",
+                        as_async({("course_3", "user_2")}, learner_record_calls))
+    monkeypatch.setattr(script.async_io, "get_learner_records_for_keys", as_async([
+        LearnerRecordWithEvents("course_1", "user_1", 1, created),
+        LearnerRecordWithEvents("course_2", "user_1", 2, created),
+        LearnerRecordWithEvents("course_3", "user_2", 3, created),
+    ], fetched))
+    monkeypatch.setattr(script.async_io, "get_course_completions_for_keys", as_async([
+        # Already migrated by the previous run
+        CourseCompletion("course_1", "user_1", old),
+        CourseCompletion("course_1", "user_1", new),
+        # Before the previous run, but its learner record is new
+        CourseCompletion("course_3", "user_2", old),
+    ]))
+    monkeypatch.setitem(learner_record.course_record_lookup_strategies, learner_record.course_record_lookup_strategy,
+                        lambda keys: [CourseRecord(course_id, user_id, None, "LIKED", new)
+                                      for course_id, user_id in keys if course_id == "course_2"])
+
+    async def insert_learner_record_events(events):
+        inserted.extend((e.learner_record_id, e.event_id, e.event_timestamp) for e in events)
+
+    monkeypatch.setattr(script.async_io, "insert_learner_record_events", insert_learner_record_events)
+
+    script.run_incremental_events(True, previous, current)
+
+    assert completion_calls == [(since, until)]
+    assert course_record_calls == [(since, until)]
+    assert learner_record_calls == [(2, 3)]
+    assert fetched == [([("course_1", "user_1"), ("course_2", "user_1"), ("course_3", "user_2")],)]
+    assert sorted(inserted) == [(1, COMPLETE_COURSE, new), (2, MOVE_TO_LEARNING_PLAN, new), (3, COMPLETE_COURSE, old)]
+
+
+def test_run_is_incremental_only_with_previous_watermarks(monkeypatch, tmp_path):
+    learner_records_current = {"course_record_last_updated": datetime.datetime(2024, 2, 1),
+                               "module_record_created_at": None, "learner_record_id": 3}
+    events_current = {"course_completion_event_timestamp": datetime.datetime(2024, 2, 1),
+                      "course_record_last_updated": datetime.datetime(2024, 2, 1), "learner_record_id": 3}
+    calls = []
+    monkeypatch.setattr(script, "module_record_index", False)
+    monkeypatch.setattr(script, "get_learner_records_watermarks", lambda: learner_records_current)
+    monkeypatch.setattr(script, "get_events_watermarks", lambda: events_current)
+    monkeypatch.setattr(script, "insert_missing_course_records",
+                        lambda execute, workers, checkpoint, changed_since, shard, use_index:
+                        calls.append(("learner_records", changed_since)))
+    monkeypatch.setattr(script, "run_incremental_events",
+                        lambda execute, previous, current, shard, workers: calls.append(("incremental", previous)))
+    monkeypatch.setattr(script, "run_events",
+                        lambda execute, checkpoint, shard, snapshot: calls.append(("full", None)))
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+
+    script.run(["learner_records", "events"], True, watermarks=store, incremental=True)
+    script.run(["learner_records", "events"], True, watermarks=store, incremental=True)
+
+    assert calls == [
+        ("learner_records", None),
+        ("full", None),
+        ("learner_records", (datetime.datetime(2024, 2, 1), datetime.datetime.min)),
+        ("incremental", events_current),
+    ]
+    assert store.get("events") == events_current
@@ -0,0 +1,32 @@
+import pytest
+
+from sharding import Shard, shard_of
+
+
+def test_shard_of_is_stable():
+    # First 32 bits of MD5('user_1') are 0x3f49044c, of MD5('user_2') 0x15e1576a
+    assert shard_of("user_1", 4) == 0x3f49044c % 4
+    assert shard_of("user_2", 4) == 0x15e1576a % 4
+
+
+def test_shards_partition_users():
+    user_ids = [f"user_{i}" for i in range(1000)]
+    shards = [Shard(4, index) for index in range(4)]
+    for user_id in user_ids:
+        assert sum(shard.contains(user_id) for shard in shards) == 1
+    assert all(any(shard.contains(user_id) for user_id in user_ids) for shard in shards)
+
+
+def test_shard_conditions():
+    shard = Shard(4, 1)
+    assert shard.mysql_condition("lr.learner_id") == "CONV(SUBSTRING(MD5(lr.learner_id), 1, 8), 16, 10) % 4 = 1"
+    assert shard.pg_condition("cce.user_id") == "('x' || substr(md5(cce.user_id), 1, 8))::bit(32)::bigint % 4 = 1"
+
+
+def test_shard_path():
+    assert Shard(4, 1).path("migration_checkpoint.json") == "migration_checkpoint.shard-1-of-4.json"
+
+
+def test_invalid_shard():
+    with pytest.raises(ValueError):
+        Shard(4, 4)
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import snapshot
+from course_completions import CourseCompletion
+from learner_record import LearnerRecordWithEvents, CourseRecord, CourseRecordBase
+from snapshot import Snapshot, build_snapshot
+
+datetime_2024 = datetime(2024, 1, 1, 10, 0, 0, 123456)
+datetime_2025 = datetime(2025, 1, 1, 10, 0, 0)
+
+
+def build_test_snapshot(monkeypatch, path):
+    monkeypatch.setattr(snapshot, "get_invalidation_key", lambda: ("key", {}))
+    monkeypatch.setattr(snapshot, "get_learner_records_ordered_pages", lambda page_size: iter([
+        [LearnerRecordWithEvents("course_1", "user_1", 1, datetime_2024),
+         LearnerRecordWithEvents("course_1", "user_2", 2, None)],
+        [LearnerRecordWithEvents("course_2", "user_1", 3, datetime_2025)],
+    ]))
+    monkeypatch.setattr(snapshot, "get_course_completions", lambda page_size: iter([
+        CourseCompletion("course_1", "user_1", datetime_2025),
+    ]))
+    monkeypatch.setattr(snapshot, "get_incomplete_course_records_pages", lambda page_size: iter([[
+        CourseRecord("course_2", "user_1", None, "LIKED", datetime_2025),
+        CourseRecord("course_1", "user_2", "ARCHIVED", None, datetime_2024),
+    ]]))
+    build_snapshot(path)
+    return Snapshot(path)
+
+
+def test_snapshot_round_trip(monkeypatch, tmp_path):
+    loaded = build_test_snapshot(monkeypatch, str(tmp_path / "snapshot"))
+
+    assert loaded.invalidation_key == "key"
+    pages = list(loaded.learner_record_pages(2))
+    assert [[(lr.course_id, lr.user_id, lr.lr_id, lr.created_timestamp) for lr in page] for page in pages] == [
+        [("course_1", "user_1", 1, datetime_2024), ("course_1", "user_2", 2, None)],
+        [("course_2", "user_1", 3, datetime_2025)],
+    ]
+    assert [(c.course_id, c.user_id, c.event_timestamp) for c in loaded.course_completions()] == [
+        ("course_1", "user_1", datetime_2025),
+    ]
+
+
+def test_snapshot_incomplete_course_record_lookup(monkeypatch, tmp_path):
+    loaded = build_test_snapshot(monkeypatch, str(tmp_path / "snapshot"))
+
+    records = loaded.get_incomplete_course_records([
+        CourseRecordBase("course_1", "user_1"),
+        CourseRecordBase("course_1", "user_2"),
+        CourseRecordBase("course_2", "user_1"),
+        CourseRecordBase("course_3", "user_1"),
+    ])
+    assert sorted((r.course_id, r.user_id, r.state, r.preference, r.last_updated, r.created_at) for r in records) == [
+        ("course_1", "user_2", "ARCHIVED", None, datetime_2024, datetime_2024),
+        ("course_2", "user_1", None, "LIKED", datetime_2025, datetime_2025),
+    ]
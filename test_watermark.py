@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from watermark import WatermarkStore
+
+
+def test_watermark_store_saves_watermarks(tmp_path):
+    path = str(tmp_path / "watermarks.json")
+    store = WatermarkStore(path)
+    assert store.get("events") is None
+    store.save("events", {"course_completion_event_timestamp": datetime(2024, 1, 1, 10, 0, 0, 123000),
+                          "learner_record_id": 42})
+
+    assert WatermarkStore(path).get("events") == {
+        "course_completion_event_timestamp": datetime(2024, 1, 1, 10, 0, 0, 123000),
+        "learner_record_id": 42,
+    }
+
+
+def test_watermark_store_keeps_other_phases(tmp_path):
+    path = str(tmp_path / "watermarks.json")
+    WatermarkStore(path).save("learner_records", {"course_record_last_updated": datetime(2024, 1, 1)})
+    WatermarkStore(path).save("events", {"course_record_last_updated": None})
+
+    store = WatermarkStore(path)
+    assert store.get("learner_records") == {"course_record_last_updated": datetime(2024, 1, 1)}
+    assert store.get("events") == {"course_record_last_updated": None}
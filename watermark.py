@@ -0,0 +1,43 @@
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+from log import get_logger
+
+logger = get_logger('watermark')
+
+
+def parse_watermark(value):
+    # Timestamps are saved as strings, ids as ints
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class WatermarkStore:
+    # High watermarks of the source columns each phase has processed up to, saved after a phase of an execute run
+    # completes. Incremental runs only process rows that changed after the previous run's watermarks.
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, phase: str) -> Optional[dict]:
+        watermarks = self.state.get(phase)
+        if watermarks is None:
+            return None
+        return {name: parse_watermark(value) for name, value in watermarks.items()}
+
+    def save(self, phase: str, watermarks: dict):
+        self.state[phase] = watermarks
+        self._save()
+        logger.info(f"Saved {phase} watermarks: {watermarks}")
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, default=str)
+        os.replace(tmp_path, self.path)